@@ -0,0 +1,194 @@
+from db.db import Database
+from join_rewrite import parse_query, identifier_name
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import psycopg2
+import sqlglot
+from sqlglot import exp
+import time
+
+# Comparisons between a column and a value or another column, and whether an index can use them as equalities
+_COMPARISONS = {exp.EQ: True, exp.In: True, exp.NEQ: False, exp.LT: False, exp.LTE: False, exp.GT: False,
+                exp.GTE: False, exp.Like: False, exp.ILike: False, exp.Between: False}
+# Postgres caps identifiers at 63 bytes
+_MAX_NAME_LENGTH = 63
+
+
+# Function to map every alias or table name of a parsed query to its catalog table
+def table_aliases(tree: exp.Expression, catalog: list[dict]):
+    tables = {entry['table'].lower() for entry in catalog}
+    aliases = {name: name for name in tables}
+    for table in tree.find_all(exp.Table):
+        name = identifier_name(table.this) if isinstance(table.this, exp.Identifier) else None
+        if name in tables:
+            aliases[identifier_name(table.args['alias'].this) if table.args.get('alias') else name] = name
+    return aliases
+
+
+# Function to resolve a column reference (column or alias.column) to its (table, column)
+def resolve_column(column: exp.Column, catalog: list[dict], aliases: dict):
+    name = identifier_name(column.this)
+    qualifier = identifier_name(column.args.get('table'))
+    if qualifier:
+        table = aliases.get(qualifier)
+        for entry in catalog:
+            if entry['table'].lower() == table and name in (other.lower() for other in entry['columns']):
+                return table, name
+        return None
+    owners = [entry['table'].lower() for entry in catalog if name in (other.lower() for other in entry['columns'])]
+    # An unqualified column is only usable if exactly one table has it
+    return (owners[0], name) if len(owners) == 1 else None
+
+
+# Function to collect the filtered and joined columns of a query per table from its parse tree
+def predicate_columns(query: str, catalog: list[dict]):
+    try:
+        tree = parse_query(query)
+    except sqlglot.errors.ParseError:
+        return {}, {}
+    aliases = table_aliases(tree, catalog)
+    filters, joins = {}, {}
+    # In the order the predicates are written, which orders the columns of a composite index
+    for comparison in tree.find_all(*_COMPARISONS, bfs=False):
+        # NOT IN and NOT LIKE cannot be looked up in an index as equalities
+        equality = _COMPARISONS[type(comparison)] and not isinstance(comparison.parent, exp.Not)
+        left, right = comparison.this, comparison.args.get('expression')
+        left_column = resolve_column(left, catalog, aliases) if isinstance(left, exp.Column) else None
+        right_column = resolve_column(right, catalog, aliases) if isinstance(right, exp.Column) else None
+        if left_column and right_column:
+            # A join predicate makes both sides candidates for an index lookup
+            for table, column in (left_column, right_column):
+                joins.setdefault(table, []).append(column)
+        elif left_column or right_column:
+            table, column = left_column or right_column
+            filters.setdefault(table, []).append((column, equality))
+    return filters, joins
+
+
+# Function to load the leading columns of every existing index
+def existing_indexes(db: Database):
+    query = """
+        SELECT c.relname, array_agg(a.attname::text ORDER BY k.ordinality)
+        FROM pg_index x
+        JOIN pg_class c ON c.oid = x.indrelid
+        CROSS JOIN LATERAL unnest(x.indkey) WITH ORDINALITY AS k(attnum, ordinality)
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum
+        GROUP BY x.indexrelid, c.relname;
+    """
+    result, _, error, _ = db.execute_query(query)
+    return [(table.lower(), tuple(column.lower() for column in columns)) for table, columns in result or []]
+
+
+# Function to generate the candidate indexes of a query
+def candidate_indexes(query: str, catalog: list[dict], indexes: list[tuple] = ()):
+    filters, joins = predicate_columns(query, catalog)
+    candidates = []
+    for table, columns in joins.items():
+        for column in dict.fromkeys(columns):
+            candidates.append((table, (column,)))
+    for table, columns in filters.items():
+        for column, _ in columns:
+            candidates.append((table, (column,)))
+        # Equality columns lead a composite index, range columns can only follow them
+        composite = tuple(dict.fromkeys([column for column, equality in columns if equality] +
+                                        [column for column, equality in columns if not equality]))
+        if len(composite) > 1:
+            candidates.append((table, composite))
+
+    # Skip duplicates and indexes whose columns already lead an existing index
+    unique = []
+    for table, columns in dict.fromkeys(candidates):
+        if not any(table == index_table and index_columns[:len(columns)] == columns
+                   for index_table, index_columns in indexes):
+            unique.append((table, columns))
+    return unique
+
+
+# Function to name a candidate index uniquely within the 63 byte identifier limit
+def index_name(table: str, columns: tuple):
+    name = f"advisor_{table}_{'_'.join(columns)}"
+    if len(name) > _MAX_NAME_LENGTH:
+        digest = hashlib.blake2b(name.encode(), digest_size=4).hexdigest()
+        name = f"{name[:_MAX_NAME_LENGTH - len(digest) - 1]}_{digest}"
+    return name
+
+
+# Function to check whether a plan uses an index
+def uses_index(plan: dict, name: str):
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        if node.get('Index Name') == name:
+            return True
+        stack.extend(node.get('Plans', []))
+    return False
+
+
+# Function to build a candidate index in a transaction, explain the query with it and roll it back
+def evaluate_index(db: Database, query: str, table: str, columns: tuple, settings: dict = None):
+    name = index_name(table, columns)
+    definition = f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"
+    # The what-if settings are scoped to the transaction, as in the base plan of get_qep
+    set_local = "".join(f"SET LOCAL {setting} = {value}; " for setting, value in (settings or {}).items())
+    start_time = time.time()
+    with db.session() as session:
+        try:
+            # The index only exists inside this transaction, so it is neither committed nor seen by other sessions
+            session.cursor.execute(f"{set_local}{definition}; EXPLAIN (FORMAT JSON) {query}")
+            plan = session.cursor.fetchone()[0][0]['Plan']
+            session.cursor.execute("SELECT pg_relation_size(%s::regclass)", (name,))
+            size = session.cursor.fetchone()[0]
+            return plan['Total Cost'], size, uses_index(plan, name), definition, time.time() - start_time, None
+        except psycopg2.Error as e:
+            return None, None, False, definition, time.time() - start_time, str(e)
+        finally:
+            if not session.conn.closed:
+                session.conn.rollback()
+
+
+# Function to rank the candidate indexes of a query by cost reduction per MB of index
+def advise_indexes(db: Database, query: str, catalog: list[dict], max_workers: int = None, settings: dict = None):
+    # The base plan and every candidate are planned under the same what-if settings
+    _, base_cost, _, _, error = db.get_qep(query, settings)
+    if error:
+        return [], error
+    candidates = candidate_indexes(query, catalog, existing_indexes(db))
+
+    # every candidate builds its index on its own pooled connection, a shared connection can only build one at a time
+    if db.pool is None:
+        max_workers = 1
+    max_workers = max_workers or db.pool_max
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(evaluate_index, db, query, table, columns, settings): (table, columns)
+                   for table, columns in candidates}
+        for future in as_completed(futures):
+            table, columns = futures[future]
+            cost, size, used, definition, execution_time, error = future.result()
+            reduction = base_cost - cost if cost is not None else None
+            results.append({
+                'table': table,
+                'columns': columns,
+                'definition': definition,
+                'cost': cost,
+                'cost_reduction': reduction,
+                'size': size,
+                # Cost saved per MB of index, an index that costs nothing to store is ranked on its reduction alone
+                'score': reduction / max(size / 2 ** 20, 1e-3) if reduction is not None else None,
+                'used': used,
+                'time': execution_time,
+                'error': error
+            })
+
+    # best reduction per MB first, failed candidates last
+    results.sort(key=lambda result: (result['score'] is None, -(result['score'] or 0)))
+    return results, None
+
+
+if __name__ == '__main__':
+    catalog = [{'table': 'orders', 'columns': ['o_orderkey', 'o_custkey', 'o_orderdate']},
+               {'table': 'customer', 'columns': ['c_custkey', 'c_mktsegment']}]
+    query = ("SELECT * FROM customer c, orders o WHERE c.c_custkey = o.o_custkey "
+             "AND c_mktsegment = 'BUILDING' AND o.o_orderdate < date '1995-03-15'")
+    print(candidate_indexes(query, catalog))
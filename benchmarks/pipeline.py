@@ -0,0 +1,153 @@
+from preprocessing import Graph
+from interface_components import graph_plot
+from interface_components.graph_plot import GraphPlot
+import argparse
+import json
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+
+SHAPES = ['deep', 'wide', 'tpch']
+SIZES = [10, 100, 1000, 10000]
+STAGES = ['parse_qep', 'build_graph', 'hierarchy_pos', 'plot_graph']
+TPCH_TABLES = ['lineitem', 'orders', 'customer', 'partsupp', 'part', 'supplier', 'nation', 'region']
+
+
+# Function to make a plan node with the fields EXPLAIN (FORMAT JSON) reports
+def plan_node(node_type: str, rng: random.Random, plans: list = None, **fields):
+    child_cost = sum(plan['Total Cost'] for plan in plans or [])
+    node = {
+        'Node Type': node_type,
+        'Parallel Aware': False,
+        'Startup Cost': round(child_cost, 2),
+        'Total Cost': round(child_cost + rng.uniform(1, 1000), 2),
+        'Plan Rows': rng.randint(1, 1000000),
+        'Plan Width': rng.randint(4, 200),
+        **fields
+    }
+    if plans:
+        node['Plans'] = plans
+    return node
+
+
+# Function to make a scan of a random TPC-H table
+def scan_node(rng: random.Random):
+    table = rng.choice(TPCH_TABLES)
+    return plan_node('Seq Scan', rng, **{'Relation Name': table, 'Alias': table})
+
+
+# A chain of single-child nodes, the worst case for recursion and layout depth
+def deep_plan(size: int, rng: random.Random):
+    plan = scan_node(rng)
+    for _ in range(size - 1):
+        plan = plan_node(rng.choice(['Sort', 'Materialize', 'Limit', 'Result']), rng, [plan])
+    return plan
+
+
+# An Append over many scans, the worst case for the width of one level
+def wide_plan(size: int, rng: random.Random):
+    return plan_node('Append', rng, [scan_node(rng) for _ in range(size - 1)])
+
+
+# Left-deep hash joins under an aggregate, repeated under an Append like a UNION ALL of TPC-H queries
+def tpch_plan(size: int, rng: random.Random):
+    subqueries = []
+    # The Append takes one node
+    remaining = size - 1
+    while remaining > 0:
+        # Every subquery has Gather Merge, Sort and Aggregate on top of joins of 3 nodes plus an outer scan
+        joins = min(rng.randint(2, 7), max((remaining - 4) // 3, 0))
+        plan = scan_node(rng)
+        for _ in range(joins):
+            hash_node = plan_node('Hash', rng, [scan_node(rng)])
+            plan = plan_node('Hash Join', rng, [plan, hash_node], **{'Join Type': 'Inner'})
+        used = 1 + 3 * joins
+        for node_type in ['Aggregate', 'Sort', 'Gather Merge']:
+            if used < remaining:
+                plan = plan_node(node_type, rng, [plan])
+                used += 1
+        subqueries.append(plan)
+        remaining -= used
+    return plan_node('Append', rng, subqueries)
+
+
+generators = {'deep': deep_plan, 'wide': wide_plan, 'tpch': tpch_plan}
+
+
+# Function to clear the layout cache so hierarchy_pos computes the layout again
+def clear_layout_cache():
+    with graph_plot._layout_lock:
+        graph_plot._layout_cache.clear()
+
+
+# Function to run the visualisation pipeline on a plan, yielding each stage to be called in turn
+def run_stages(qep: list):
+    graph = Graph()
+    yield 'parse_qep', lambda: graph.parse_qep(qep)
+    yield 'build_graph', graph.build_graph
+    plot = GraphPlot(graph.build_graph())
+    clear_layout_cache()
+    yield 'hierarchy_pos', lambda: plot.hierarchy_pos(plot.tree)
+    # plot_graph reuses the layout from the cache, as the app does after the first draw
+    yield 'plot_graph', plot.plot_graph
+
+
+# Function to time every stage on a plan, then measure each stage's peak memory in a separate traced run
+def measure(qep: list, repeat: int):
+    timings = {stage: [] for stage in STAGES}
+    for _ in range(repeat):
+        for stage, fn in run_stages(qep):
+            start_time = time.perf_counter()
+            fn()
+            timings[stage].append((time.perf_counter() - start_time) * 1000)
+
+    # tracemalloc slows allocation down, so memory is measured apart from the timings
+    peaks = {}
+    tracemalloc.start()
+    for stage, fn in run_stages(qep):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        fn()
+        peaks[stage] = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    return {stage: {
+        'median_ms': statistics.median(timings[stage]),
+        'min_ms': min(timings[stage]),
+        'max_ms': max(timings[stage]),
+        'peak_memory_bytes': peaks[stage]
+    } for stage in STAGES}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the plan visualisation pipeline on synthetic plans")
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=SHAPES)
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES, help="number of nodes of each plan")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_output.json', help="where to write the JSON results")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'Shape':<6} {'Nodes':>7} " + " ".join(f"{stage + ' (ms)':>18}" for stage in STAGES) +
+          f" {'Peak (KB)':>10}")
+    for shape in args.shapes:
+        for size in args.sizes:
+            qep = [{'Plan': generators[shape](size, random.Random(args.seed))}]
+            stages = measure(qep, args.repeat)
+            results.append({'shape': shape, 'nodes': size, 'stages': stages})
+            peak = max(stage['peak_memory_bytes'] for stage in stages.values())
+            print(f"{shape:<6} {size:>7,} " + " ".join(f"{stages[stage]['median_ms']:>18.2f}" for stage in STAGES) +
+                  f" {peak / 1024:>10,.0f}")
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'results': results
+        }, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,74 @@
+from db.db import Database
+from whatif import build_settings, format_settings
+from db.query_list import query_template_list
+from dotenv import load_dotenv
+import statistics
+import time
+import os
+load_dotenv()
+
+# Settings restored after every what-if by the per-statement path
+reset_commands = [
+    "SET enable_bitmapscan = on;\n",
+    "SET enable_gathermerge = on;\n",
+    "SET enable_hashagg = on;\n",
+    "SET enable_hashjoin = on;\n",
+    "SET enable_indexscan = on;\n",
+    "SET enable_indexonlyscan = on;\n",
+    "SET enable_material = on;\n",
+    "SET enable_mergejoin = on;\n",
+    "SET enable_nestloop = on;\n",
+    "SET enable_seqscan = on;\n",
+    "SET enable_sort = on;\n",
+    "SET enable_tidscan = on;\n",
+    'RESET join_collapse_limit;\n'
+]
+
+
+# Previous what-if path: one round trip per SET, then the EXPLAIN, then one per reset
+def per_statement_whatif(db: Database, query: str, settings: dict):
+    for command in format_settings(settings):
+        db.cursor.execute(command)
+    db.conn.commit()
+    db.cursor.execute(f"EXPLAIN (FORMAT JSON) {query}")
+    db.cursor.fetchall()
+    for command in reset_commands:
+        db.cursor.execute(command)
+    db.conn.commit()
+
+
+# Current what-if path: SET LOCAL and EXPLAIN in one round trip, then a rollback (the round trip of get_qep,
+# without its plan cache and plan history)
+def batched_whatif(db: Database, query: str, settings: dict):
+    db.cursor.execute("".join(format_settings(settings, local=True)) + f"EXPLAIN (FORMAT JSON) {query}")
+    db.cursor.fetchall()
+    db.conn.rollback()
+
+
+def measure(fn, db: Database, query: str, settings: dict, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        fn(db, query, settings)
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return timings
+
+
+if __name__ == '__main__':
+    db = Database(os.getenv('DB_HOST'), os.getenv('DB_PORT'), os.getenv('DB_NAME'), os.getenv('DB_USER'),
+                  os.getenv('DB_PASSWORD'))
+    db.connect()
+    repeat = int(os.getenv('BENCH_REPEAT', 20))
+    # Worst case for the old path: every dropdown changed and the join order fixed
+    settings = build_settings('nested', 'index', 'no_hash', True)
+
+    print(f"{'Query':<55} {'Per-statement (ms)':>20} {'Batched (ms)':>15} {'Speed-up':>10}")
+    for template in query_template_list:
+        query = template['value']
+        # Warm up both paths once so connection and catalog caches are hot
+        per_statement_whatif(db, query, settings)
+        batched_whatif(db, query, settings)
+        old = statistics.median(measure(per_statement_whatif, db, query, settings, repeat))
+        new = statistics.median(measure(batched_whatif, db, query, settings, repeat))
+        print(f"{template['label'][:55]:<55} {old:>20.2f} {new:>15.2f} {old / new:>9.1f}x")
+    db.close()
@@ -0,0 +1,392 @@
+from db.db import Database, DEFAULT_POOL_MAX
+from db.query_list import query_template_list
+from preprocessing import PlanTree
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import combinations
+from dotenv import load_dotenv
+import numpy as np
+import argparse
+import json
+import os
+import statistics
+import time
+load_dotenv()
+
+# Planner cost constants that are fitted, in the order of the fitted coefficients
+COST_CONSTANTS = ['seq_page_cost', 'random_page_cost', 'cpu_tuple_cost', 'cpu_index_tuple_cost', 'cpu_operator_cost']
+# Every calibration query runs serially and without JIT, whose costs and timings the fitted constants do not model
+CALIBRATION_SETTINGS = {'max_parallel_workers_per_gather': 0, 'jit': 'off'}
+# Micro-queries that read a table through each access path
+SEQ_SCAN_SETTINGS = {}
+INDEX_SCAN_SETTINGS = {'enable_seqscan': 'off', 'enable_bitmapscan': 'off', 'enable_indexonlyscan': 'off'}
+BITMAP_SCAN_SETTINGS = {'enable_seqscan': 'off', 'enable_indexscan': 'off', 'enable_indexonlyscan': 'off'}
+# Fractions of an index's key range read by the index and bitmap micro-queries
+MICRO_SELECTIVITIES = [0.001, 0.01, 0.1]
+# Tables smaller than this are left out of the micro-queries, their runtimes are mostly overhead
+MIN_MICRO_ROWS = 10000
+# Relative changes of a constant used to find how much of a plan's cost it accounts for, smaller ones are
+# tried when a larger one changes the plan
+PERTURBATIONS = [0.1, 0.01]
+# Cost the planner adds to paths disabled by enable_* = off, plans that include it are not fitted
+DISABLE_COST = 1e10
+# Samples faster than this (ms) are left out of the fit, their runtimes are mostly noise
+MIN_SAMPLE_TIME = 0.5
+# Hit ratio above which the random page fetches of a sample were served from shared buffers, not read
+CACHED_HIT_RATIO = 0.99
+DEFAULT_REPEAT = 3
+DEFAULT_WARMUP = 1
+# Seconds after which a calibration query is cancelled
+DEFAULT_TIMEOUT = 120
+
+
+@dataclass
+class Sample:
+    """
+    A query measured with EXPLAIN ANALYZE, with the share of its estimated cost owed to each cost constant
+    """
+    label: str
+    query: str
+    settings: dict
+    time: float = None
+    cost: float = None
+    shape: str = None
+    hit_ratio: float = None
+    # Units of each cost constant in the plan's cost: cost = sum(constant * count) + the rest
+    counts: list = None
+    after_cost: float = None
+    after_time: float = None
+    plan_changed: bool = False
+    error: str = None
+
+    @property
+    def fitted(self):
+        return (self.error is None and self.counts is not None and self.cost < DISABLE_COST
+                and self.time >= MIN_SAMPLE_TIME)
+
+
+# Function to get the current value of every cost constant
+def current_constants(db: Database):
+    result, _, error, _ = db.execute_query("SELECT name, setting::float8 FROM pg_settings WHERE name = ANY(%s);",
+                                           (COST_CONSTANTS,))
+    if error:
+        raise RuntimeError(error)
+    return {name: value for name, value in result}
+
+
+# Function to list the query templates as samples
+def template_samples():
+    return [Sample(template['label'], template['value'], dict(CALIBRATION_SETTINGS))
+            for template in query_template_list]
+
+
+# Function to build micro-queries that scan every large table sequentially and range-scan its integer btree indexes
+def micro_samples(db: Database):
+    query = """
+        SELECT n.nspname, c.relname, a.attname, c.reltuples::bigint
+        FROM pg_index x
+        JOIN pg_class c ON c.oid = x.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_am am ON am.oid = i.relam
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = x.indkey[0]
+        WHERE am.amname = 'btree'
+          AND a.atttypid IN ('int2'::regtype, 'int4'::regtype, 'int8'::regtype)
+          AND c.reltuples >= %s
+          AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+        ORDER BY n.nspname, c.relname, a.attname;
+    """
+    result, _, error, _ = db.execute_query(query, (MIN_MICRO_ROWS,))
+    if error:
+        raise RuntimeError(error)
+    samples = []
+    catalog, _, _ = db.load_catalog()
+    for table in catalog:
+        if (table['rows'] or 0) >= MIN_MICRO_ROWS:
+            samples.append(Sample(f"seq scan {table['table']}",
+                                  f"SELECT count(*) FROM {table['schema']}.{table['table']}",
+                                  dict(CALIBRATION_SETTINGS, **SEQ_SCAN_SETTINGS)))
+    for schema, table, column, _ in dict.fromkeys(result or []):
+        bounds, _, error, _ = db.execute_query(f"SELECT min({column}), max({column}) FROM {schema}.{table};")
+        if error or bounds[0][0] is None:
+            continue
+        low, high = bounds[0]
+        for selectivity in MICRO_SELECTIVITIES:
+            upper = low + int((high - low) * selectivity)
+            query = f"SELECT count(*) FROM {schema}.{table} WHERE {column} BETWEEN {low} AND {upper}"
+            for name, settings in [('index scan', INDEX_SCAN_SETTINGS), ('bitmap scan', BITMAP_SCAN_SETTINGS)]:
+                samples.append(Sample(f"{name} {table}.{column} {selectivity:.1%}", query,
+                                      dict(CALIBRATION_SETTINGS, **settings)))
+    return samples
+
+
+# Function to run a query with EXPLAIN ANALYZE and get its median execution time, cost and plan shape
+def measure(db: Database, query: str, settings: dict, repeat: int = DEFAULT_REPEAT, warmup: int = DEFAULT_WARMUP):
+    times = []
+    for run in range(warmup + repeat):
+        qep, cost, _, _, error = db.get_qep(query, settings, analyze=True, record=False)
+        if error:
+            return None, None, None, None, error
+        if run >= warmup:
+            times.append(qep.execution_time)
+    root = qep.plan
+    blocks = root.get('Shared Hit Blocks', 0) + root.get('Shared Read Blocks', 0)
+    hit_ratio = root.get('Shared Hit Blocks', 0) / blocks if blocks else None
+    return statistics.median(times), cost, PlanTree.from_plan(root).fingerprint(), hit_ratio, None
+
+
+# Function to measure a sample in place
+def measure_sample(db: Database, sample: Sample, repeat: int = DEFAULT_REPEAT, warmup: int = DEFAULT_WARMUP):
+    sample.time, sample.cost, sample.shape, sample.hit_ratio, sample.error = measure(db, sample.query,
+                                                                                    sample.settings, repeat, warmup)
+
+
+# Function to plan a query and get its cost and plan shape, plans made under perturbed constants are not kept
+def explain(db: Database, query: str, settings: dict):
+    qep, cost, _, _, error = db.get_qep(query, settings, record=False, cache=False)
+    if error:
+        return None, None, error
+    return cost, PlanTree.from_plan(qep.plan).fingerprint(), None
+
+
+# Function to find how many units of each cost constant the measured plan of a sample costs
+def cost_counts(db: Database, sample: Sample, constants: dict):
+    """
+    The cost of a fixed plan is linear in the cost constants, so raising one constant a little and
+    re-planning gives its count as the cost difference over the constant difference, as long as the plan
+    stays the same. None if every perturbation of a constant changes the plan.
+    """
+    counts = []
+    for name in COST_CONSTANTS:
+        for perturbation in PERTURBATIONS:
+            value = float(f"{constants[name] * (1 + perturbation):.6g}")
+            cost, shape, error = explain(db, sample.query, dict(sample.settings, **{name: value}))
+            if error:
+                return None
+            if shape == sample.shape:
+                counts.append((cost - sample.cost) / (value - constants[name]))
+                break
+        else:
+            return None
+    return counts
+
+
+# Function to fit the milliseconds each unit of every cost constant takes by least squares
+def fit_constants(samples: list[Sample]):
+    """
+    Solve time = sum(ms_per_unit * count) for non-negative ms_per_unit, weighting every sample by 1 / time so
+    the fit minimizes relative errors and long queries do not drown out short ones.
+    With five unknowns every subset of them is solved and the best non-negative solution kept (exact NNLS).
+    """
+    counts = np.array([sample.counts for sample in samples], dtype=float)
+    times = np.array([sample.time for sample in samples], dtype=float)
+    a = counts / times[:, None]
+    b = np.ones(len(samples))
+    best, best_residual = np.zeros(len(COST_CONSTANTS)), float(np.sum(b ** 2))
+    for size in range(1, len(COST_CONSTANTS) + 1):
+        for subset in combinations(range(len(COST_CONSTANTS)), size):
+            solution = np.linalg.lstsq(a[:, subset], b, rcond=None)[0]
+            if np.any(solution < 0):
+                continue
+            residual = float(np.sum((a[:, subset] @ solution - b) ** 2))
+            if residual < best_residual:
+                best, best_residual = np.zeros(len(COST_CONSTANTS)), residual
+                best[list(subset)] = solution
+    return best
+
+
+# Function to find the cost constants the samples cannot identify
+def unidentified_constants(ms_per_unit, samples: list[Sample]):
+    """
+    Constants fitted as zero could not be told apart from zero. random_page_cost is not identifiable either
+    when every sample with random page fetches found its pages in shared buffers, as its fitted time is then
+    the time of a buffer hit rather than a read.
+    """
+    unidentified = [name for name, ms in zip(COST_CONSTANTS, ms_per_unit) if ms <= 0]
+    random_reads = [sample for sample in samples if sample.counts[1] > 0]
+    if 'random_page_cost' not in unidentified and all(sample.hit_ratio is None or
+                                                      sample.hit_ratio >= CACHED_HIT_RATIO
+                                                      for sample in random_reads):
+        unidentified.append('random_page_cost')
+    return unidentified
+
+
+# Function to turn the fitted milliseconds per unit into cost constants, keeping seq_page_cost as the cost unit
+def suggest_constants(ms_per_unit, constants: dict, unidentified: list = ()):
+    """
+    Costs are in units of one sequential page fetch, so every constant is scaled by the same factor, the one
+    that keeps seq_page_cost at its value (cpu_tuple_cost if seq_page_cost is not identified). Constants that
+    are not identified are left out, and random_page_cost is kept at least as high as seq_page_cost.
+    """
+    identified = [name for name in COST_CONSTANTS if name not in unidentified]
+    anchor = next((name for name in ['seq_page_cost', 'cpu_tuple_cost'] if name in identified), None)
+    if anchor is None:
+        return {}
+    scale = constants[anchor] / ms_per_unit[COST_CONSTANTS.index(anchor)]
+    suggested = {name: float(f"{ms_per_unit[COST_CONSTANTS.index(name)] * scale:.4g}") for name in identified}
+    if 'random_page_cost' in suggested and 'seq_page_cost' in suggested:
+        suggested['random_page_cost'] = max(suggested['random_page_cost'], suggested['seq_page_cost'])
+    return suggested
+
+
+# Function to get the Pearson correlation of log cost and log time and the Spearman rank correlation
+def correlation(costs, times):
+    if len(costs) < 3:
+        return None, None
+    costs, times = np.array(costs, dtype=float), np.array(times, dtype=float)
+    pearson = float(np.corrcoef(np.log(np.maximum(costs, 1e-9)), np.log(np.maximum(times, 1e-9)))[0, 1])
+    spearman = float(np.corrcoef(costs.argsort().argsort(), times.argsort().argsort())[0, 1])
+    return pearson, spearman
+
+
+# Function to calibrate the cost constants on the query templates and micro-queries
+def calibrate(db: Database, templates: bool = True, micro: bool = True, repeat: int = DEFAULT_REPEAT,
+              warmup: int = DEFAULT_WARMUP, verify: bool = False, max_workers: int = None, log=print):
+    constants = current_constants(db)
+    samples = (template_samples() if templates else []) + (micro_samples(db) if micro else [])
+
+    # Timings are taken one query at a time so they do not compete for the machine
+    for i, sample in enumerate(samples):
+        log(f"[{i + 1}/{len(samples)}] {sample.label}")
+        measure_sample(db, sample, repeat, warmup)
+
+    # Re-planning is cheap, so it runs concurrently on the pool
+    if db.pool is None:
+        max_workers = 1
+    max_workers = max_workers or db.pool_max
+    measured = [sample for sample in samples if sample.error is None]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for sample, counts in zip(measured, executor.map(lambda sample: cost_counts(db, sample, constants),
+                                                         measured)):
+            sample.counts = counts
+    fitted = [sample for sample in samples if sample.fitted]
+    if len(fitted) < len(COST_CONSTANTS):
+        raise RuntimeError(f"Only {len(fitted)} samples could be fitted, at least {len(COST_CONSTANTS)} are needed")
+
+    ms_per_unit = fit_constants(fitted)
+    unidentified = unidentified_constants(ms_per_unit, fitted)
+    suggested = suggest_constants(ms_per_unit, constants, unidentified)
+
+    # Re-plan with the suggested constants, plans that change are only compared if they are measured again
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        plans = list(executor.map(lambda sample: explain(db, sample.query, dict(sample.settings, **suggested)),
+                                  fitted))
+    for sample, (cost, shape, error) in zip(fitted, plans):
+        if error:
+            continue
+        sample.after_cost = cost
+        sample.plan_changed = shape != sample.shape
+        if not sample.plan_changed:
+            sample.after_time = sample.time
+        elif verify:
+            log(f"Measuring the new plan of {sample.label}")
+            sample.after_time = measure(db, sample.query, dict(sample.settings, **suggested), repeat, warmup)[0]
+
+    # Before and after are compared on the same samples
+    compared = [sample for sample in fitted if sample.after_cost is not None and sample.after_time is not None]
+    before = correlation([sample.cost for sample in compared], [sample.time for sample in compared])
+    after = correlation([sample.after_cost for sample in compared], [sample.after_time for sample in compared])
+    predicted = np.array([sample.counts for sample in fitted]) @ ms_per_unit
+    relative_errors = [abs(prediction - sample.time) / sample.time for prediction, sample in zip(predicted, fitted)]
+    changed = [sample for sample in fitted if sample.plan_changed and sample.after_time is not None]
+    return {
+        'current': constants,
+        'suggested': suggested,
+        'unidentified': unidentified,
+        'ms_per_unit': dict(zip(COST_CONSTANTS, ms_per_unit.tolist())),
+        'median_relative_error': statistics.median(relative_errors),
+        'before': before,
+        'after': after,
+        # The suggested constants are only worth applying if they make cost follow time more closely
+        'improved': bool(suggested) and before[0] is not None and after[0] is not None and after[0] > before[0],
+        'fitted': len(fitted),
+        'compared': len(compared),
+        'plans_changed': sum(sample.plan_changed for sample in fitted),
+        # Total measured time of the queries whose plan changed, before and after (with verify)
+        'changed_time_before': sum(sample.time for sample in changed) if verify else None,
+        'changed_time_after': sum(sample.after_time for sample in changed) if verify else None,
+        'samples': [{
+            'label': sample.label,
+            'time_ms': sample.time,
+            'cost': sample.cost,
+            'after_cost': sample.after_cost,
+            'after_time_ms': sample.after_time,
+            'plan_changed': sample.plan_changed,
+            'hit_ratio': sample.hit_ratio,
+            'counts': dict(zip(COST_CONSTANTS, sample.counts)) if sample.counts else None,
+            'fitted': sample.fitted,
+            'error': sample.error,
+        } for sample in samples],
+    }
+
+
+# Function to format the suggested constants as postgresql.conf lines
+def postgresql_conf(suggested: dict):
+    lines = [f"# Cost constants calibrated by python -m calibrate on {time.strftime('%Y-%m-%d')}"]
+    lines += [f"{name} = {value:g}" for name, value in suggested.items()]
+    return "\n".join(lines)
+
+
+def format_correlation(pair):
+    pearson, spearman = pair
+    if pearson is None:
+        return "not enough samples"
+    return f"Pearson (log-log) {pearson:.3f}, Spearman {spearman:.3f}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fit the planner cost constants to runtimes measured with "
+                                                 "EXPLAIN ANALYZE and suggest postgresql.conf values")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="timed runs of every query")
+    parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP, help="untimed runs before them")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help="seconds before a query is cancelled")
+    parser.add_argument('--no-templates', action='store_true', help="leave out the query templates")
+    parser.add_argument('--no-micro', action='store_true', help="leave out the micro-queries")
+    parser.add_argument('--verify', action='store_true',
+                        help="measure the queries whose plan changes under the suggested constants")
+    parser.add_argument('--output', help="where to write the JSON results")
+    args = parser.parse_args()
+
+    db = Database(os.getenv('DB_HOST'), os.getenv('DB_PORT'), os.getenv('DB_NAME'), os.getenv('DB_USER'),
+                  os.getenv('DB_PASSWORD'), pool_min=1, pool_max=DEFAULT_POOL_MAX,
+                  statement_timeout=args.timeout * 1000)
+    db.connect()
+    try:
+        report = calibrate(db, not args.no_templates, not args.no_micro, args.repeat, args.warmup, args.verify)
+    finally:
+        db.close()
+
+    print(f"\n{'Sample':<45} {'Time (ms)':>12} {'Cost':>14} {'New cost':>14} {'Hit ratio':>10}")
+    for sample in report['samples']:
+        if sample['error']:
+            print(f"{sample['label'][:45]:<45} {sample['error'].splitlines()[0]}")
+            continue
+        new_cost = f"{sample['after_cost']:,.2f}" if sample['after_cost'] is not None else "-"
+        hit_ratio = f"{sample['hit_ratio']:.1%}" if sample['hit_ratio'] is not None else "-"
+        flags = (" (new plan)" if sample['plan_changed'] else "") + ("" if sample['fitted'] else " (not fitted)")
+        print(f"{sample['label'][:45]:<45} {sample['time_ms']:>12,.2f} {sample['cost']:>14,.2f} {new_cost:>14} "
+              f"{hit_ratio:>10}{flags}")
+
+    print(f"\n{'Constant':<22} {'Current':>10} {'Suggested':>10} {'ms / unit':>12}")
+    for name in COST_CONSTANTS:
+        suggested = f"{report['suggested'][name]:g}" if name in report['suggested'] else "-"
+        print(f"{name:<22} {report['current'][name]:>10g} {suggested:>10} {report['ms_per_unit'][name]:>12.3g}")
+    if report['unidentified']:
+        print(f"Not identifiable from these samples: {', '.join(report['unidentified'])}")
+    print(f"\nFitted on {report['fitted']} samples, median relative error of the predicted time "
+          f"{report['median_relative_error']:.1%}")
+    print(f"Cost / time correlation before: {format_correlation(report['before'])}")
+    print(f"Cost / time correlation after:  {format_correlation(report['after'])} "
+          f"({report['compared']} samples, {report['plans_changed']} plans changed)")
+    if report['changed_time_before'] is not None:
+        print(f"Queries with a new plan: {report['changed_time_before']:,.2f} ms before, "
+              f"{report['changed_time_after']:,.2f} ms after")
+    if report['improved']:
+        print(f"\n{postgresql_conf(report['suggested'])}")
+    else:
+        print("\nThe suggested constants do not improve the correlation, no postgresql.conf lines are suggested")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
@@ -1,62 +1,367 @@
 import psycopg2
+import psycopg2.extras
+from psycopg2 import pool
+from contextlib import contextmanager
 import json
+import os
+import threading
 import time
+import uuid
+import re
+import sqlite3
+from db.plan_cache import PlanCache
+from db.shared_cache import get_shared_cache
+from db.plan import QueryPlan
+from db.plan_history import get_plan_history, event_kind
+from metrics import span, timed, DB_ROUND_TRIP, JSON_DECODE
+
+# Default size of the connection pool used by the interface
+DEFAULT_POOL_MIN = 1
+DEFAULT_POOL_MAX = 10
+# Seconds to wait for a pooled connection when all of them are borrowed
+POOL_WAIT_TIMEOUT = 30
+# Most pooled connections borrowed at once by all the sessions of a process (overridden by $QEP_MAX_CONNECTIONS),
+# so a process stays within its share of the server's max_connections however many sessions it serves
+MAX_CONNECTIONS_ENV = "QEP_MAX_CONNECTIONS"
+DEFAULT_MAX_CONNECTIONS = 20
+_connection_budget = threading.BoundedSemaphore(int(os.environ.get(MAX_CONNECTIONS_ENV, DEFAULT_MAX_CONNECTIONS)))
+# Idle connections older than this (in seconds) are pinged before being handed out
+HEALTH_CHECK_INTERVAL = 30
+# Rows shown per page of the result grid, and rows fetched per round trip when streaming
+DEFAULT_PAGE_SIZE = 100
+STREAM_ITERSIZE = 2000
+# Statements after which cached plans can no longer be trusted
+_INVALIDATING_REGEX = re.compile(r"^\s*(analyze|vacuum|create|alter|drop|truncate|reindex|cluster)\b", re.IGNORECASE)
+# Planner settings changed through SET / RESET
+# The value is kept as typed (quoted strings, lists and units included), so it can be SET again as it is
+_SET_REGEX = re.compile(r"^\s*set\s+(?:session\s+)?(\w+)\s*(?:=|\bto\b)\s*((?:'(?:[^']|'')*'|[^';\s]|\s+(?=[^;\s]))+)"
+                        r"\s*;?\s*$", re.IGNORECASE)
+_RESET_REGEX = re.compile(r"^\s*reset\s+(\w+)\s*;?\s*$", re.IGNORECASE)
+
+# Decode json and jsonb columns (e.g. EXPLAIN (FORMAT JSON) plans) in a span of their own,
+# it runs while rows are fetched so the DB round trip span includes it
+decode_json = timed(JSON_DECODE)(json.loads)
+psycopg2.extras.register_default_json(globally=True, loads=decode_json)
+psycopg2.extras.register_default_jsonb(globally=True, loads=decode_json)
+
+
+def is_setting_command(query):
+    """
+    Check whether a statement is a SET / RESET of a setting, see Database.track_setting
+    """
+    return _SET_REGEX.match(query) is not None or _RESET_REGEX.match(query) is not None
+
+
+def is_row_query(query):
+    """
+    Check whether a query returns rows, i.e. whether it can be opened as a server-side cursor
+    """
+    query = re.sub(r"^(\s*(--[^\n]*\n|/\*.*?\*/))*", "", query, flags=re.DOTALL)
+    return re.match(r"\s*(select|with|values|table)\b", query, re.IGNORECASE) is not None
 
 
 class Database:
-    def __init__(self, host, port, dbname, user, password):
+    def __init__(self, host, port, dbname, user, password, pool_min=None, pool_max=None, statement_timeout=None):
         self.db_name = dbname
         self.db_user = user
         self.db_password = password
         self.db_host = host
         self.db_port = port
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        # Statements running longer than this many milliseconds are aborted by the server
+        self.statement_timeout = statement_timeout
+        self.pool = None
+        # One slot per pooled connection, borrowers wait on it instead of getting a PoolError from an empty pool
+        self._slots = None
         self.conn = None
         self.cursor = None
+        # Plans are shared with the other worker processes per database, if the process shares its caches
+        self.plan_cache = PlanCache(shared=get_shared_cache(), namespace=f"{host}:{port}/{dbname}")
+        # Every new plan and every statement that may change plans is recorded, see db/plan_history.py
+        self.plan_history = get_plan_history()
+        # Planner settings changed on this connection, part of the plan cache key
+        self.settings = {}
+        # Time each pooled connection was last returned, keyed by id(conn)
+        self._last_used = {}
+        self._lock = threading.Lock()
 
-    def connect(self):
-        """
-        Connect to the database
-        """
-        self.conn = psycopg2.connect(
+    def _connect_kwargs(self):
+        kwargs = dict(
             dbname=self.db_name,
             user=self.db_user,
             password=self.db_password,
             host=self.db_host,
             port=self.db_port
         )
-        self.cursor = self.conn.cursor()
+        if self.statement_timeout:
+            # A session default, so RESET ALL on pooled connections keeps it
+            kwargs['options'] = f"-c statement_timeout={int(self.statement_timeout)}"
+        return kwargs
+
+    def connect(self):
+        """
+        Connect to the database.
+        Opens a threaded connection pool when pool_max is set, otherwise a single connection and cursor.
+        """
+        if self.pool_max:
+            self.pool = pool.ThreadedConnectionPool(1 if self.pool_min is None else self.pool_min, self.pool_max,
+                                                    **self._connect_kwargs())
+            self._slots = threading.BoundedSemaphore(self.pool_max)
+            # Borrow one connection straight away so that bad credentials fail here, unless pool_min is 0 and
+            # connections are only opened when they are first needed
+            if self.pool_min != 0:
+                with self.session():
+                    pass
+        else:
+            self.conn = psycopg2.connect(**self._connect_kwargs())
+            self.cursor = self.conn.cursor()
+            self.apply_settings(self.conn)
+
+    def apply_settings(self, conn):
+        """
+        Run the tracked SET commands on a connection, so what runs there is planned like the QEP shown.
+        Pooled connections are reset when they are returned, so they get them every time they are borrowed.
+        """
+        if not self.settings:
+            return
+        with conn.cursor() as cursor:
+            cursor.execute("".join(f"SET {name} = {value}; " for name, value in self.settings.items()))
+        conn.commit()
 
     def close(self):
         """
         Close the database connection
         """
+        if self.pool:
+            self.pool.closeall()
+            self.pool = None
         if self.cursor:
             self.cursor.close()
         if self.conn:
             self.conn.close()
 
+    def detached(self, statement_timeout=None):
+        """
+        Open a separate unpooled connection with the same credentials, sharing the plan cache.
+        Used by work running in a child process, which must not touch the pooled connections it inherited.
+        """
+        db = Database(self.db_host, self.db_port, self.db_name, self.db_user, self.db_password,
+                      statement_timeout=statement_timeout or self.statement_timeout)
+        db.plan_cache = self.plan_cache
+        db.settings = dict(self.settings)
+        db.connect()
+        return db
+
+    def backend_pid(self):
+        """
+        Get the process ID of the server backend serving this connection
+        """
+        return self.conn.get_backend_pid()
+
+    def cancel_backend(self, pid):
+        """
+        Cancel the statement running on another backend with pg_cancel_backend
+        """
+        result, _, error, _ = self.execute_query("SELECT pg_cancel_backend(%s);", (pid,))
+        return bool(result and result[0][0]), error
+
+    def _is_healthy(self, conn):
+        """
+        Check that a pooled connection is still usable.
+        Connections that have been idle for a while are pinged with SELECT 1.
+        """
+        if conn.closed:
+            return False
+        if time.time() - self._last_used.get(id(conn), 0) < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _borrow(self):
+        """
+        Borrow a healthy connection from the pool, replacing broken ones.
+        Waits up to POOL_WAIT_TIMEOUT seconds in all for a connection of the pool and for the process-wide budget
+        when all of them are borrowed.
+        """
+        deadline = time.time() + POOL_WAIT_TIMEOUT
+        if not self._slots.acquire(timeout=POOL_WAIT_TIMEOUT):
+            raise pool.PoolError(f"No connection was returned to the pool within {POOL_WAIT_TIMEOUT} seconds")
+        if not _connection_budget.acquire(timeout=max(deadline - time.time(), 0)):
+            self._slots.release()
+            raise pool.PoolError(f"The sessions of this process kept all their connections for {POOL_WAIT_TIMEOUT} "
+                                 f"seconds (raise ${MAX_CONNECTIONS_ENV} if the server allows more)")
+        try:
+            for _ in range(self.pool_max):
+                conn = self.pool.getconn()
+                if self._is_healthy(conn):
+                    return conn
+                with self._lock:
+                    self._last_used.pop(id(conn), None)
+                self.pool.putconn(conn, close=True)
+            # Every pooled connection was broken, so the server is likely unreachable
+            return self.pool.getconn()
+        except BaseException:
+            _connection_budget.release()
+            self._slots.release()
+            raise
+
+    def _release(self, conn):
+        """
+        Return a borrowed connection to the pool with its session settings cleared
+        """
+        broken = conn.closed
+        if not broken:
+            try:
+                conn.reset()
+            except psycopg2.Error:
+                broken = True
+        with self._lock:
+            if broken:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.time()
+        self.pool.putconn(conn, close=broken)
+        _connection_budget.release()
+        self._slots.release()
+
+    @contextmanager
+    def session(self):
+        """
+        Borrow a connection for a unit of work.
+        Yields a Database bound to a single connection and cursor, so session settings
+        (e.g. SET enable_*) apply to every statement run inside the block.
+        Without a pool the shared connection itself is yielded.
+        """
+        if self.pool is None:
+            if self.conn is not None and self.conn.closed:
+                # Reconnect if the server dropped the connection
+                self.connect()
+            yield self
+            return
+
+        conn = self._borrow()
+        session = Database(self.db_host, self.db_port, self.db_name, self.db_user, self.db_password)
+        session.conn = conn
+        session.cursor = conn.cursor()
+        session.plan_cache = self.plan_cache
+        session.plan_history = self.plan_history
+        # SET / RESET run on the borrowed connection are tracked for the whole pool
+        session.settings = self.settings
+        try:
+            self.apply_settings(conn)
+            yield session
+        finally:
+            if not session.cursor.closed:
+                session.cursor.close()
+            self._release(conn)
+
     def execute_query(self, query, params=None):
         """
         Execute a query and return the result
         """
+        result, _, execution_time, error, row_count = self.execute_statement(query, params)
+        return result, execution_time, error, row_count
+
+    def execute_statement(self, query, params=None):
+        """
+        Execute a query and return the result with its column names (None if it returns no rows)
+        """
+        if self.pool is not None:
+            # Retry once on a fresh connection if the borrowed one turns out to be dead
+            for attempt in range(2):
+                with self.session() as session:
+                    outcome = session.execute_statement(query, params)
+                    if not session.conn.closed or attempt:
+                        return outcome
+
         try:
             start_time = time.time()
-            self.cursor.execute(query, params)
+            with span(DB_ROUND_TRIP):
+                self.cursor.execute(query, params)
 
-            if self.cursor.description:
-                result = self.cursor.fetchall()
-                row_count = self.cursor.rowcount
-            else:
-                self.conn.commit()
-                result = None
-                row_count = 0
+                if self.cursor.description:
+                    result = self.cursor.fetchall()
+                    columns = [desc[0] for desc in self.cursor.description]
+                    row_count = self.cursor.rowcount
+                else:
+                    self.conn.commit()
+                    result, columns = None, None
+                    row_count = 0
+
+            if _INVALIDATING_REGEX.match(query):
+                self.plan_cache.invalidate()
+                self.record_event(event_kind(query), query)
+            # A SET does not outlive the borrowed connection, get_qep applies it again with SET LOCAL
+            self.track_setting(query)
 
             execution_time = time.time() - start_time
-            return result, execution_time, None, row_count
+            return result, columns, execution_time, None, row_count
         except psycopg2.Error as e:
             print(f"Error executing query: {e}")
-            return None, 0, str(e), 0
+            if not self.conn.closed:
+                self.conn.rollback()
+            return None, None, 0, str(e), 0
+
+    def stream_query(self, query, itersize=STREAM_ITERSIZE, offset=0):
+        """
+        Stream the result of a query through a named (server-side) cursor.
+        Yields (columns, rows) batches of at most itersize rows, so memory use does not depend on the result size.
+        Rows before offset are skipped on the server with MOVE.
+        """
+        if self.pool is not None:
+            with self.session() as session:
+                yield from session.stream_query(query, itersize, offset)
+            return
 
+        try:
+            with self.conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+                cursor.itersize = itersize
+                cursor.execute(query.strip().rstrip(';'))
+                if offset:
+                    cursor.scroll(offset)
+                while True:
+                    rows = cursor.fetchmany(itersize)
+                    if not rows:
+                        break
+                    yield [desc[0] for desc in cursor.description], rows
+        finally:
+            # The named cursor only lives inside its transaction
+            if not self.conn.closed:
+                self.conn.rollback()
+
+    def fetch_page(self, query, page=0, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Fetch a single page of a query result
+        """
+        start_time = time.time()
+        columns, rows = [], []
+        try:
+            # Ask for one extra row to find out whether there is a next page
+            with span(DB_ROUND_TRIP):
+                stream = self.stream_query(query, itersize=page_size + 1, offset=page * page_size)
+                for columns, rows in stream:
+                    break
+                stream.close()
+        except psycopg2.Error as e:
+            print(f"Error executing query: {e}")
+            return None, None, False, 0, str(e)
+        execution_time = time.time() - start_time
+        return rows[:page_size], columns, len(rows) > page_size, execution_time, None
+
+    def count_rows(self, query):
+        """
+        Count the total number of rows returned by a query
+        """
+        query = f"SELECT COUNT(*) FROM ({query.strip().rstrip(';')}) AS result;"
+        result, execution_time, error, _ = self.execute_query(query)
+        row_count = result[0][0] if result else None
+        return row_count, execution_time, error
 
     def list_all_tables(self):
         """
@@ -70,6 +375,55 @@ class Database:
         """
         return self.execute_query(query)
 
+    def load_catalog(self):
+        """
+        Load every table's columns, estimated row count, size and indexes in a single round trip.
+        Row counts come from pg_class.reltuples, so they are only as fresh as the last ANALYZE (None if never analyzed).
+        A catalog loaded by another worker process is reused until the next ANALYZE or schema change.
+        """
+        start_time = time.time()
+        catalog = self.plan_cache.get_metadata('catalog')
+        if catalog is not None:
+            return catalog, time.time() - start_time, None
+        query = """
+            SELECT n.nspname,
+                   c.relname,
+                   (SELECT array_agg(a.attname::text ORDER BY a.attnum)
+                    FROM pg_attribute a
+                    WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped),
+                   c.reltuples::bigint,
+                   pg_total_relation_size(c.oid),
+                   (SELECT array_agg(i.relname::text ORDER BY i.relname)
+                    FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+                    WHERE x.indrelid = c.oid)
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relkind IN ('r', 'p')
+              AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+              AND n.nspname NOT LIKE 'pg_toast%'
+            ORDER BY n.nspname, c.relname;
+        """
+        result, execution_time, error, _ = self.execute_query(query)
+        catalog = []
+        for schema, table, columns, estimated_rows, size, indexes in result or []:
+            catalog.append({
+                'schema': schema,
+                'table': table,
+                'columns': columns or [],
+                'rows': estimated_rows if estimated_rows is not None and estimated_rows >= 0 else None,
+                'size': size,
+                'indexes': indexes or []
+            })
+        if not error:
+            self.plan_cache.put_metadata('catalog', catalog)
+        return catalog, execution_time, error
+
+    def exact_row_counts(self, tables):
+        """
+        Count the exact number of rows of each (schema, table) pair
+        """
+        return {(schema, table): self.get_rows(schema, table)[0] for schema, table in tables}
+
     def list_columns(self, schema, table):
         """
         List all columns in a table
@@ -86,6 +440,10 @@ class Database:
         """
         Get the number of rows in a table
         """
+        if self.pool is not None:
+            with self.session() as session:
+                return session.get_rows(schema, table)
+
         start_time = time.time()
         query = f"SELECT COUNT(*) FROM {schema}.{table};"
         self.cursor.execute(query)
@@ -100,16 +458,94 @@ class Database:
         query = "ANALYZE;"
         return self.execute_query(query)
 
-    def get_qep(self, query):
+    def track_setting(self, command):
         """
-        Get the query execution plan (QEP) for a query
+        Record a SET / RESET command run on this connection so cached plans are keyed by it and every connection
+        of the pool runs it, see apply_settings
         """
-        query = f"EXPLAIN (FORMAT JSON) {query}"
-        result, execution_time, error, _ = self.execute_query(query)
+        match = _SET_REGEX.match(command)
+        if match:
+            if match.group(2).strip().lower() == "default":
+                self.settings.pop(match.group(1).lower(), None)
+            else:
+                # Kept as typed, units are case sensitive (e.g. '64MB') and lists must stay unquoted
+                self.settings[match.group(1).lower()] = match.group(2).strip()
+            return
+        match = _RESET_REGEX.match(command)
+        if match:
+            if match.group(1).lower() == "all":
+                self.settings.clear()
+            else:
+                self.settings.pop(match.group(1).lower(), None)
+
+    def get_qep(self, query, settings=None, analyze=False, record=True, cache=True):
+        """
+        Get the query execution plan (QEP) for a query as a QueryPlan.
+        settings maps planner settings to values; they are applied with SET LOCAL in the same round trip as
+        the EXPLAIN and rolled back with it, so nothing has to be reset afterwards. The settings tracked from
+        SET commands are already applied to every connection, see apply_settings.
+        With analyze the query is actually run with EXPLAIN (ANALYZE, BUFFERS, TIMING) inside a transaction
+        that is rolled back, so the plan carries actual times and row counts.
+        Plain plans are served from the plan cache when the same query was explained under the same settings.
+        Candidate plans explored by a search or a sweep are made with cache=False and record=False, so they
+        neither evict the plans of the session from the plan cache nor fill the plan history.
+        """
+        start_time = time.time()
+        # Measured plans differ on every run, so they are never cached
+        cache = cache and not analyze
+        if cache:
+            active_settings = dict(self.settings)
+            active_settings.update(settings or {})
+            key = self.plan_cache.make_key(query, {name: str(value).lower()
+                                                   for name, value in active_settings.items()})
+        cached = self.plan_cache.get(key) if cache else None
+        if cached is not None:
+            qep, qep_cost, qep_rows = cached
+            return qep, qep_cost, qep_rows, time.time() - start_time, None
+
+        options = "ANALYZE, BUFFERS, TIMING, FORMAT JSON" if analyze else "FORMAT JSON"
+        explain = f"EXPLAIN ({options}) {query}"
+        if settings or analyze:
+            explain = "".join(f"SET LOCAL {name} = {value}; " for name, value in (settings or {}).items()) + explain
+            with self.session() as session:
+                result, execution_time, error, _ = session.execute_query(explain)
+                # Pooled connections are rolled back when they are returned
+                if session is self and not self.conn.closed:
+                    self.conn.rollback()
+        else:
+            result, execution_time, error, _ = self.execute_query(explain)
+        if error:
+            return None, None, None, execution_time, error
+        # Keep the plan as decoded by psycopg2, its JSON text is only rendered when displayed
+        qep = QueryPlan(result[0][0])
         # Extract the total cost of the top-level plan
-        qep_cost = None
-        qep_rows = None
-        if result is not None:
-            qep_cost = result[0][0][0]["Plan"]["Total Cost"]
-            qep_rows = result[0][0][0]["Plan"]["Plan Rows"]
-        return json.dumps(result[0][0], indent=2), qep_cost, qep_rows, execution_time, error
\ No newline at end of file
+        qep_cost = qep.total_cost
+        qep_rows = qep.plan_rows
+        if cache:
+            self.plan_cache.put(key, (qep, qep_cost, qep_rows))
+        if record:
+            self.record_plan(query, qep, settings)
+        return qep, qep_cost, qep_rows, execution_time, error
+
+    def record_plan(self, query, qep, settings=None):
+        """
+        Add a plan to the plan history, keyed by the what-if settings it was made under.
+        The settings of the connection are kept with it, a plan that changed with them is flagged as a config change.
+        """
+        if self.plan_history is None:
+            return
+        try:
+            self.plan_history.record(self.plan_cache.namespace, query, qep, settings, self.settings)
+        except sqlite3.Error as e:
+            print(f"Error recording plan: {e}")
+
+    def record_event(self, kind, detail=None):
+        """
+        Add an ANALYZE, data reload, config or schema change to the plan history
+        """
+        if self.plan_history is None:
+            return
+        try:
+            self.plan_history.record_event(self.plan_cache.namespace, kind, detail)
+        except sqlite3.Error as e:
+            print(f"Error recording event: {e}")
@@ -0,0 +1,352 @@
+import numpy as np
+import pandas as pd
+import io
+import zlib
+
+# Rows generated per batch, each batch is formatted and handed to COPY on its own
+BATCH_ROWS = 100_000
+# Distinct random strings drawn from for comments, addresses and phone suffixes
+POOL_SIZE = 8192
+
+# TPC-H dates
+START_DATE = np.datetime64('1992-01-01')
+CURRENT_DATE = np.datetime64('1995-06-17')
+END_DATE = np.datetime64('1998-12-31')
+
+# Value lists from the TPC-H specification
+regions = ['AFRICA', 'AMERICA', 'ASIA', 'EUROPE', 'MIDDLE EAST']
+nations = [
+    ('ALGERIA', 0), ('ARGENTINA', 1), ('BRAZIL', 1), ('CANADA', 1), ('EGYPT', 4), ('ETHIOPIA', 0),
+    ('FRANCE', 3), ('GERMANY', 3), ('INDIA', 2), ('INDONESIA', 2), ('IRAN', 4), ('IRAQ', 4), ('JAPAN', 2),
+    ('JORDAN', 4), ('KENYA', 0), ('MOROCCO', 0), ('MOZAMBIQUE', 0), ('PERU', 1), ('CHINA', 2),
+    ('ROMANIA', 3), ('SAUDI ARABIA', 4), ('VIETNAM', 2), ('RUSSIA', 3), ('UNITED KINGDOM', 3),
+    ('UNITED STATES', 1)
+]
+colors = [
+    'almond', 'antique', 'aquamarine', 'azure', 'beige', 'bisque', 'black', 'blanched', 'blue', 'blush', 'brown',
+    'burlywood', 'burnished', 'chartreuse', 'chiffon', 'chocolate', 'coral', 'cornflower', 'cornsilk', 'cream',
+    'cyan', 'dark', 'deep', 'dim', 'dodger', 'drab', 'firebrick', 'floral', 'forest', 'frosted', 'gainsboro',
+    'ghost', 'goldenrod', 'green', 'grey', 'honeydew', 'hot', 'indian', 'ivory', 'khaki', 'lace', 'lavender',
+    'lawn', 'lemon', 'light', 'lime', 'linen', 'magenta', 'maroon', 'medium', 'metallic', 'midnight', 'mint',
+    'misty', 'moccasin', 'navajo', 'navy', 'olive', 'orange', 'orchid', 'pale', 'papaya', 'peach', 'peru', 'pink',
+    'plum', 'powder', 'puff', 'purple', 'red', 'rose', 'rosy', 'royal', 'saddle', 'salmon', 'sandy', 'seashell',
+    'sienna', 'sky', 'slate', 'smoke', 'snow', 'spring', 'steel', 'tan', 'thistle', 'tomato', 'turquoise',
+    'violet', 'wheat', 'white', 'yellow'
+]
+type_syllables = [
+    ['STANDARD', 'SMALL', 'MEDIUM', 'LARGE', 'ECONOMY', 'PROMO'],
+    ['ANODIZED', 'BURNISHED', 'PLATED', 'POLISHED', 'BRUSHED'],
+    ['TIN', 'NICKEL', 'BRASS', 'STEEL', 'COPPER']
+]
+container_syllables = [
+    ['SM', 'LG', 'MED', 'JUMBO', 'WRAP'],
+    ['CASE', 'BOX', 'BAG', 'JAR', 'PKG', 'PACK', 'CAN', 'DRUM']
+]
+segments = ['AUTOMOBILE', 'BUILDING', 'FURNITURE', 'MACHINERY', 'HOUSEHOLD']
+priorities = ['1-URGENT', '2-HIGH', '3-MEDIUM', '4-NOT SPECIFIED', '5-LOW']
+instructions = ['DELIVER IN PERSON', 'COLLECT COD', 'NONE', 'TAKE BACK RETURN']
+modes = ['REG AIR', 'AIR', 'RAIL', 'SHIP', 'TRUCK', 'MAIL', 'FOB']
+words = [
+    'furiously', 'sly', 'careful', 'blithely', 'quickly', 'fluffily', 'slyly', 'ironic', 'regular', 'final',
+    'express', 'special', 'pending', 'bold', 'even', 'silent', 'unusual', 'packages', 'requests', 'accounts',
+    'deposits', 'foxes', 'ideas', 'theodolites', 'pinto', 'beans', 'instructions', 'dependencies', 'excuses',
+    'platelets', 'asymptotes', 'courts', 'dolphins', 'sleep', 'wake', 'are', 'cajole', 'haggle', 'nag', 'use',
+    'boost', 'affix', 'detect', 'integrate', 'maintain', 'nod', 'was', 'lose', 'sublate', 'solve', 'thrash',
+    'about', 'above', 'according', 'to', 'across', 'after', 'against', 'along', 'among', 'around', 'at', 'the'
+]
+
+
+# Row counts of every table at a scale factor
+def table_rows(scale_factor):
+    return {
+        'region': len(regions),
+        'nation': len(nations),
+        'supplier': max(1, int(10_000 * scale_factor)),
+        'part': max(1, int(200_000 * scale_factor)),
+        'partsupp': 4 * max(1, int(200_000 * scale_factor)),
+        'customer': max(1, int(150_000 * scale_factor)),
+        'orders': max(1, int(1_500_000 * scale_factor)),
+        # About four lines per order, generated together with the orders
+        'lineitem': None
+    }
+
+
+# Tables generated in one pass with another one, their batches are numbered like those of that table
+generated_with = {'orders': ['orders', 'lineitem']}
+
+
+# Pool of random text of lengths between low and high characters
+def text_pool(rng, low, high):
+    lengths = rng.integers(low, high + 1, POOL_SIZE)
+    text = " ".join(np.array(words)[rng.integers(0, len(words), POOL_SIZE * high // 4)])
+    starts = rng.integers(0, len(text) - high, POOL_SIZE)
+    return np.array([text[start:start + length].strip() for start, length in zip(starts, lengths)], dtype=object)
+
+
+# Pool of random alphanumeric strings of lengths between low and high characters, as used for addresses
+def alnum_pool(rng, low, high):
+    alphabet = np.array(list("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789,"))
+    characters = alphabet[rng.integers(0, len(alphabet), (POOL_SIZE, high))]
+    lengths = rng.integers(low, high + 1, POOL_SIZE)
+    return np.array(["".join(row[:length]) for row, length in zip(characters, lengths)], dtype=object)
+
+
+def pick(rng, values, n):
+    return np.asarray(values, dtype=object)[rng.integers(0, len(values), n)]
+
+
+def keyed_names(prefix, keys):
+    return pd.Series(keys).map(lambda key: f"{prefix}#{key:09d}").to_numpy()
+
+
+def phones(rng, nationkeys):
+    numbers = rng.integers(100, 1000, (len(nationkeys), 2)), rng.integers(1000, 10000, len(nationkeys))
+    return (pd.Series(nationkeys + 10).astype(str) + "-" + pd.Series(numbers[0][:, 0]).astype(str) + "-"
+            + pd.Series(numbers[0][:, 1]).astype(str) + "-" + pd.Series(numbers[1]).astype(str)).to_numpy()
+
+
+# Dates as ISO text, which is much faster to write out than datetime columns
+def date_text(dates):
+    return np.datetime_as_string(dates, unit='D').astype(object)
+
+
+# Retail price of parts in cents, as defined by the specification
+def retail_cents(partkeys):
+    return 90000 + (partkeys // 10) % 20001 + 100 * (partkeys % 1000)
+
+
+# Supplier of the i-th (0-3) partsupp row of each part, from the TPC-H formula
+# (partkey + i * (S / 4 + (partkey - 1) / S)) % S + 1. The offset (partkey - 1) / S is wrapped so that 3 steps stay
+# below S and the four suppliers of a part stay distinct, which only differs from the formula below scale factor
+# 0.03, where the formula can repeat suppliers
+def part_supplier(partkeys, i, suppliers):
+    step = suppliers // 4 + ((partkeys - 1) // suppliers) % ((suppliers - 1) // 3 - suppliers // 4 + 1)
+    return (partkeys + i * step) % suppliers + 1
+
+
+def generate_region(scale_factor, start, stop, rng):
+    keys = np.arange(start, stop)
+    return pd.DataFrame({
+        'r_regionkey': keys,
+        'r_name': np.array(regions, dtype=object)[keys],
+        'r_comment': text_pool(rng, 31, 115)[:len(keys)]
+    })
+
+
+def generate_nation(scale_factor, start, stop, rng):
+    keys = np.arange(start, stop)
+    return pd.DataFrame({
+        'n_nationkey': keys,
+        'n_name': [nations[key][0] for key in keys],
+        'n_regionkey': [nations[key][1] for key in keys],
+        'n_comment': text_pool(rng, 31, 114)[:len(keys)]
+    })
+
+
+def generate_supplier(scale_factor, start, stop, rng):
+    n = stop - start
+    keys = np.arange(start + 1, stop + 1)
+    nationkeys = rng.integers(0, len(nations), n)
+    return pd.DataFrame({
+        's_suppkey': keys,
+        's_name': keyed_names('Supplier', keys),
+        's_address': pick(rng, alnum_pool(rng, 10, 40), n),
+        's_nationkey': nationkeys,
+        's_phone': phones(rng, nationkeys),
+        's_acctbal': rng.integers(-99999, 1000000, n) / 100,
+        's_comment': pick(rng, text_pool(rng, 25, 100), n)
+    })
+
+
+def generate_part(scale_factor, start, stop, rng):
+    n = stop - start
+    keys = np.arange(start + 1, stop + 1)
+    names = pd.Series(pick(rng, colors, n))
+    for _ in range(4):
+        names = names + " " + pick(rng, colors, n)
+    manufacturers = rng.integers(1, 6, n)
+    types = pd.Series(pick(rng, type_syllables[0], n)) + " " + pick(rng, type_syllables[1], n) + " " \
+        + pick(rng, type_syllables[2], n)
+    containers = pd.Series(pick(rng, container_syllables[0], n)) + " " + pick(rng, container_syllables[1], n)
+    return pd.DataFrame({
+        'p_partkey': keys,
+        'p_name': names.to_numpy(),
+        'p_mfgr': pd.Series(manufacturers).map(lambda m: f"Manufacturer#{m}").to_numpy(),
+        'p_brand': pd.Series(manufacturers * 10 + rng.integers(1, 6, n)).map(lambda b: f"Brand#{b}").to_numpy(),
+        'p_type': types.to_numpy(),
+        'p_size': rng.integers(1, 51, n),
+        'p_container': containers.to_numpy(),
+        'p_retailprice': retail_cents(keys) / 100,
+        'p_comment': pick(rng, text_pool(rng, 5, 22), n)
+    })
+
+
+# partsupp rows are numbered four per part, so batch boundaries are multiples of 4
+def generate_partsupp(scale_factor, start, stop, rng):
+    n = stop - start
+    suppliers = table_rows(scale_factor)['supplier']
+    rows = np.arange(start, stop)
+    partkeys = rows // 4 + 1
+    return pd.DataFrame({
+        'ps_partkey': partkeys,
+        'ps_suppkey': part_supplier(partkeys, rows % 4, suppliers),
+        'ps_availqty': rng.integers(1, 10000, n),
+        'ps_supplycost': rng.integers(100, 100001, n) / 100,
+        'ps_comment': pick(rng, text_pool(rng, 49, 198), n)
+    })
+
+
+def generate_customer(scale_factor, start, stop, rng):
+    n = stop - start
+    keys = np.arange(start + 1, stop + 1)
+    nationkeys = rng.integers(0, len(nations), n)
+    return pd.DataFrame({
+        'c_custkey': keys,
+        'c_name': keyed_names('Customer', keys),
+        'c_address': pick(rng, alnum_pool(rng, 10, 40), n),
+        'c_nationkey': nationkeys,
+        'c_phone': phones(rng, nationkeys),
+        'c_acctbal': rng.integers(-99999, 1000000, n) / 100,
+        'c_mktsegment': pick(rng, segments, n),
+        'c_comment': pick(rng, text_pool(rng, 29, 116), n)
+    })
+
+
+def generate_orders_and_lineitems(scale_factor, start, stop, rng):
+    """
+    Generate orders [start, stop) together with their line items, which their status and total price depend on
+    """
+    counts = table_rows(scale_factor)
+    customers, parts, suppliers = counts['customer'], counts['part'], counts['supplier']
+    n = stop - start
+    rows = np.arange(start, stop)
+    # Order keys are sparse: only the first 8 of every 32 keys are used
+    orderkeys = (rows // 8) * 32 + rows % 8 + 1
+    # A third of the customers never place an order
+    custkeys = rng.integers(1, customers + 1, n)
+    custkeys = np.where(custkeys % 3 == 0, np.where(custkeys + 1 <= customers, custkeys + 1, custkeys - 1), custkeys)
+    custkeys = np.maximum(custkeys, 1)
+    orderdates = START_DATE + rng.integers(0, (END_DATE - START_DATE).astype(int) - 151 + 1, n)
+
+    lines = rng.integers(1, 8, n)
+    order_index = np.repeat(np.arange(n), lines)
+    m = int(lines.sum())
+    linenumbers = np.arange(m) - np.repeat(np.cumsum(lines) - lines, lines) + 1
+    partkeys = rng.integers(1, parts + 1, m)
+    suppkeys = part_supplier(partkeys, rng.integers(0, 4, m), suppliers)
+    quantities = rng.integers(1, 51, m)
+    extendedprices = quantities * retail_cents(partkeys) / 100
+    discounts = rng.integers(0, 11, m) / 100
+    taxes = rng.integers(0, 9, m) / 100
+    line_orderdates = orderdates[order_index]
+    shipdates = line_orderdates + rng.integers(1, 122, m)
+    commitdates = line_orderdates + rng.integers(30, 91, m)
+    receiptdates = shipdates + rng.integers(1, 31, m)
+    returnflags = np.where(receiptdates <= CURRENT_DATE, np.where(rng.random(m) < 0.5, 'R', 'A'), 'N')
+    linestatuses = np.where(shipdates > CURRENT_DATE, 'O', 'F')
+
+    # An order is F(illed) when all of its lines are, O(pen) when none are, and P(artial) otherwise
+    filled = np.bincount(order_index, weights=linestatuses == 'F', minlength=n)
+    orderstatuses = np.where(filled == lines, 'F', np.where(filled == 0, 'O', 'P'))
+    totalprices = np.bincount(order_index, weights=extendedprices * (1 + taxes) * (1 - discounts), minlength=n)
+
+    orders = pd.DataFrame({
+        'o_orderkey': orderkeys,
+        'o_custkey': custkeys,
+        'o_orderstatus': orderstatuses,
+        'o_totalprice': np.round(totalprices, 2),
+        'o_orderdate': date_text(orderdates),
+        'o_orderpriority': pick(rng, priorities, n),
+        'o_clerk': keyed_names('Clerk', rng.integers(1, max(1, int(scale_factor * 1000)) + 1, n)),
+        'o_shippriority': np.zeros(n, dtype=int),
+        'o_comment': pick(rng, text_pool(rng, 19, 78), n)
+    })
+    lineitems = pd.DataFrame({
+        'l_orderkey': orderkeys[order_index],
+        'l_partkey': partkeys,
+        'l_suppkey': suppkeys,
+        'l_linenumber': linenumbers,
+        'l_quantity': quantities,
+        'l_extendedprice': extendedprices,
+        'l_discount': discounts,
+        'l_tax': taxes,
+        'l_returnflag': returnflags,
+        'l_linestatus': linestatuses,
+        'l_shipdate': date_text(shipdates),
+        'l_commitdate': date_text(commitdates),
+        'l_receiptdate': date_text(receiptdates),
+        'l_shipinstruct': pick(rng, instructions, m),
+        'l_shipmode': pick(rng, modes, m),
+        'l_comment': pick(rng, text_pool(rng, 10, 43), m)
+    })
+    return orders, lineitems
+
+
+# Line items are generated with their orders, see generated_with
+generators = {
+    'region': generate_region,
+    'nation': generate_nation,
+    'supplier': generate_supplier,
+    'part': generate_part,
+    'partsupp': generate_partsupp,
+    'customer': generate_customer,
+    'orders': generate_orders_and_lineitems
+}
+
+
+# Function to get the tables a generator fills, in the order of the frames it returns
+def generated_tables(table):
+    return generated_with.get(table, [table])
+
+
+def batch_ranges(table, scale_factor, parts=1):
+    """
+    Split the rows of a table into BATCH_ROWS batches, grouped into at most parts contiguous lists.
+    Line items are generated per batch of orders, so their batches are those of the orders.
+    """
+    total = table_rows(scale_factor)[table]
+    batches = [(start, min(start + BATCH_ROWS, total)) for start in range(0, total, BATCH_ROWS)]
+    parts = max(1, min(parts, len(batches)))
+    return [batches[i::parts] for i in range(parts)]
+
+
+def generate_batch(table, scale_factor, start, stop, seed=0):
+    """
+    Generate one batch of a table as '|'-delimited CSV text, one string per table of generated_tables(table).
+    Each batch has its own random stream, salted with the table name so the batches of different tables do not
+    share one, and the data does not depend on how batches are split between workers.
+    Runs in a worker process, formatting the text holds the GIL.
+    """
+    rng = np.random.default_rng([seed, zlib.crc32(table.encode()), start // BATCH_ROWS])
+    frames = generators[table](scale_factor, start, stop, rng)
+    if isinstance(frames, pd.DataFrame):
+        frames = (frames,)
+    # Money is generated in whole cents, so the shortest float text has at most two decimals
+    return tuple(frame.to_csv(sep='|', header=False, index=False) for frame in frames)
+
+
+class RowStream(io.RawIOBase):
+    """
+    Read-only file object over generated text, so COPY can consume it without temporary files
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b""
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        # Move on to the next generated batch once the current one is used up
+        while self.position >= len(self.buffer):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return b""
+            self.buffer, self.position = chunk.encode(), 0
+        if size < 0:
+            size = len(self.buffer) - self.position
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
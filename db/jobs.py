@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+class BackgroundJobs:
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db-job")
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, name, fn, *args, **kwargs):
+        """
+        Run fn in the background under the given name, replacing any finished job of the same name
+        """
+        def run():
+            start_time = time.time()
+            result = fn(*args, **kwargs)
+            return result, time.time() - start_time
+
+        with self._lock:
+            job = self.jobs.get(name)
+            if job is not None and not job.done():
+                return job
+            self.jobs[name] = self.executor.submit(run)
+            return self.jobs[name]
+
+    def status(self, name):
+        """
+        Get the state of a job as (state, result, time taken).
+        state is one of "idle", "running", "done" or "failed"; result holds the exception for failed jobs.
+        """
+        with self._lock:
+            job = self.jobs.get(name)
+        if job is None:
+            return "idle", None, 0
+        if not job.done():
+            return "running", None, 0
+        if job.exception() is not None:
+            return "failed", job.exception(), 0
+        result, time_taken = job.result()
+        return "done", result, time_taken
+
+    def running(self):
+        """
+        Check whether any job is still running
+        """
+        with self._lock:
+            return any(not job.done() for job in self.jobs.values())
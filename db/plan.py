@@ -0,0 +1,61 @@
+import json
+
+
+class QueryPlan:
+    """
+    EXPLAIN (FORMAT JSON) output as decoded by psycopg2.
+    Indexing works like the decoded list (plan[0]['Plan']); the pretty-printed JSON text is only
+    rendered the first time it is asked for.
+    """
+    __slots__ = ('data', '_text')
+
+    def __init__(self, data):
+        self.data = data
+        self._text = None
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def plan(self):
+        """
+        The root plan node
+        """
+        return self.data[0]['Plan']
+
+    @property
+    def total_cost(self):
+        return self.plan['Total Cost']
+
+    @property
+    def plan_rows(self):
+        return self.plan['Plan Rows']
+
+    @property
+    def analyzed(self):
+        """
+        Whether the plan comes from EXPLAIN ANALYZE and carries actual timings
+        """
+        return 'Execution Time' in self.data[0]
+
+    @property
+    def execution_time(self):
+        """
+        Measured execution time in milliseconds, None for plain EXPLAIN
+        """
+        return self.data[0].get('Execution Time')
+
+    @property
+    def text(self):
+        """
+        The plan as indented JSON text
+        """
+        if self._text is None:
+            self._text = json.dumps(self.data, indent=2)
+        return self._text
+
+    def __str__(self):
+        return self.text
@@ -0,0 +1,151 @@
+from collections import OrderedDict
+import threading
+import time
+import re
+
+# Default number of plans kept and how long (in seconds) a plan stays valid
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_CACHE_TTL = 600
+
+# String literals, quoted identifiers and comments, which must not be normalized
+_LITERAL_REGEX = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/)", re.DOTALL)
+
+
+def normalize_query(query):
+    """
+    Normalize a query so that formatting differences map to the same cache key.
+    Whitespace is collapsed, comments and the trailing semicolon are dropped and
+    everything outside literals and quoted identifiers is lower-cased.
+    """
+    parts = []
+    text = ""
+    for i, part in enumerate(_LITERAL_REGEX.split(query)):
+        if i % 2 == 0 or part.startswith(('--', '/*')):
+            # Comments only separate tokens, like whitespace
+            text += part.lower() if i % 2 == 0 else " "
+        else:
+            # Literals and quoted identifiers are kept as they are
+            parts.append(re.sub(r"\s+", " ", text))
+            parts.append(part)
+            text = ""
+    parts.append(re.sub(r"\s+", " ", text))
+    return "".join(parts).strip().rstrip(';').strip()
+
+
+class PlanCache:
+    """
+    LRU cache of plans with a time to live.
+    With a shared cache (see db.shared_cache) plans are also stored there under the namespace of their database,
+    so every worker process serves the plans any of them made. Invalidation bumps a version kept in the shared
+    cache, which drops the plans of that database in every process.
+    """
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL, shared=None, namespace=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Bumped whenever statistics or the schema change, so plans made before are never served
+        self.version = 0
+        self.shared = shared
+        self.namespace = namespace
+        # Version of the shared cache the local entries were made under
+        self.shared_version = 0
+        self._lock = threading.Lock()
+
+    def _sync(self):
+        """
+        Drop the local entries if another process invalidated the shared plans since
+        """
+        if self.shared is None:
+            return
+        shared_version = self.shared.get(('version', self.namespace), 0)
+        with self._lock:
+            if shared_version != self.shared_version:
+                self.entries.clear()
+                self.version += 1
+                self.shared_version = shared_version
+
+    def make_key(self, query, settings=None):
+        """
+        Build the cache key of a query planned under the given planner settings
+        """
+        self._sync()
+        return normalize_query(query), frozenset((settings or {}).items()), self.version
+
+    def _shared_key(self, kind, key):
+        return kind, self.namespace, self.shared_version, key
+
+    def get(self, key):
+        """
+        Get a cached plan, or None if it is missing or has expired
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            stale = key[-1] != self.version
+        value = None
+        if self.shared is not None and not stale:
+            value = self.shared.get(self._shared_key('plan', key[:-1]))
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if key[-1] == self.version:
+                self.entries[key] = (time.time(), value)
+            return value
+
+    def put(self, key, value):
+        """
+        Cache a plan, evicting the least recently used ones above the size limit
+        """
+        with self._lock:
+            # Drop plans computed against statistics that have since been invalidated
+            if key[-1] != self.version:
+                return
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            shared_key = self._shared_key('plan', key[:-1])
+        if self.shared is not None:
+            self.shared.set(shared_key, value, expire=self.ttl)
+
+    def get_metadata(self, name):
+        """
+        Get metadata of the database shared by the worker processes, e.g. the catalog.
+        It is only valid as long as the plans are, so it goes with the next invalidation.
+        """
+        if self.shared is None:
+            return None
+        self._sync()
+        return self.shared.get(self._shared_key('metadata', name))
+
+    def put_metadata(self, name, value):
+        if self.shared is not None:
+            self.shared.set(self._shared_key('metadata', name), value, expire=self.ttl)
+
+    def invalidate(self):
+        """
+        Drop every cached plan, e.g. after ANALYZE or a schema change
+        """
+        if self.shared is not None:
+            self.shared.incr(('version', self.namespace))
+            self._sync()
+            return
+        with self._lock:
+            self.entries.clear()
+            self.version += 1
+
+    def stats(self):
+        """
+        Get the hit and miss counters of the cache
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'version': self.version}
@@ -0,0 +1,355 @@
+from db.plan import QueryPlan
+from db.plan_cache import normalize_query
+from db.shared_cache import cache_directory
+from preprocessing import PlanTree
+from dataclasses import dataclass, field
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+# Where plans are kept unless configured otherwise (overridden by $QEP_PLAN_HISTORY), in the private cache directory
+HISTORY_PATH_ENV = "QEP_PLAN_HISTORY"
+HISTORY_FILE = "plan_history.sqlite3"
+# Seconds during which a plan equal to the last one this process recorded for its key is only counted in memory,
+# so planning the same query again does not take the write lock of the history every time
+SEEN_INTERVAL = 60
+# Relative change of the estimated cost above which a plan of the same shape is flagged
+DEFAULT_COST_THRESHOLD = 0.1
+# Events recorded between two plans of a query that may explain why its plan changed
+ANALYZE = 'analyze'
+RELOAD = 'reload'
+CONFIG = 'config'
+SCHEMA = 'schema'
+# Longest statement text kept with an event
+EVENT_DETAIL_LENGTH = 200
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY,
+    database TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    config TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    cost REAL,
+    rows REAL,
+    execution_time REAL,
+    recorded_at REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    seen INTEGER NOT NULL DEFAULT 1,
+    query TEXT NOT NULL,
+    plan BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS plans_key ON plans (database, fingerprint, settings, recorded_at);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    database TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    detail TEXT,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (database, recorded_at);
+"""
+# Every plan next to the one recorded before it for the same query and settings
+_CONSECUTIVE_PLANS = """
+SELECT * FROM (
+    SELECT id, database, fingerprint, settings, config, shape, cost, recorded_at, query,
+        LAG(id) OVER key_order AS before_id,
+        LAG(shape) OVER key_order AS before_shape,
+        LAG(cost) OVER key_order AS before_cost,
+        LAG(config) OVER key_order AS before_config,
+        LAG(last_seen) OVER key_order AS before_last_seen
+    FROM plans
+    WHERE {filters}
+    WINDOW key_order AS (PARTITION BY database, fingerprint, settings ORDER BY recorded_at, id)
+)
+WHERE before_id IS NOT NULL AND recorded_at >= ?
+ORDER BY recorded_at
+"""
+_ALTER_SYSTEM_REGEX = re.compile(r"^\s*alter\s+system\b", re.IGNORECASE)
+_ANALYZE_REGEX = re.compile(r"^\s*(analyze|vacuum)\b", re.IGNORECASE)
+
+_plan_history = None
+_configured = False
+
+
+def query_fingerprint(query):
+    """
+    Hash of a query that ignores formatting, see normalize_query
+    """
+    return hashlib.blake2b(normalize_query(query).encode(), digest_size=16).hexdigest()
+
+
+def settings_key(settings):
+    return json.dumps({name: str(value).lower() for name, value in (settings or {}).items()}, sort_keys=True)
+
+
+def event_kind(statement):
+    """
+    Get the kind of event a statement that invalidates plans is: an ANALYZE, a config or a schema change
+    """
+    if _ANALYZE_REGEX.match(statement):
+        return ANALYZE
+    if _ALTER_SYSTEM_REGEX.match(statement):
+        return CONFIG
+    return SCHEMA
+
+
+@dataclass
+class PlanChange:
+    """
+    A plan of a query that differs in shape or cost from the one recorded before it under the same settings
+    """
+    database: str
+    fingerprint: str
+    query: str
+    settings: dict
+    before_id: int
+    after_id: int
+    recorded_at: float
+    shape_changed: bool
+    before_cost: float
+    after_cost: float
+    # (kind, detail, time) of the events between the two plans, a changed config counts as one
+    causes: list = field(default_factory=list)
+
+    @property
+    def cost_change(self):
+        """
+        Relative change of the estimated cost, None if the cost before was 0
+        """
+        if not self.before_cost:
+            return None
+        return (self.after_cost - self.before_cost) / self.before_cost
+
+    def describe(self):
+        changes = []
+        if self.shape_changed:
+            changes.append("plan shape changed")
+        if self.cost_change:
+            changes.append(f"cost {self.cost_change:+.1%} ({self.before_cost:,.2f} -> {self.after_cost:,.2f})")
+        causes = ", ".join(dict.fromkeys(kind for kind, _, _ in self.causes)) or "no recorded cause"
+        return f"{', '.join(changes)} after {causes}"
+
+
+@dataclass
+class _LatestPlan:
+    """
+    The last plan a process recorded for a key, with the times it was seen again that are not written yet
+    """
+    entry_id: int
+    shape: str
+    cost: float
+    config: str
+    written_at: float
+    unwritten: int = 0
+    last_seen: float = None
+
+
+class PlanHistory:
+    """
+    Every distinct plan of every query, kept in a SQLite database with its plan JSON compressed.
+    Plans are keyed by database, query fingerprint, planner settings and time, with the hash of their shape.
+    A plan equal in shape, cost and config to the latest one of its key only updates when that one was last
+    seen, so the history of a query is the sequence of plans it actually went through.
+    Statements that change statistics, the config or the schema are recorded as events, which explain why
+    a plan changed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        # Last plan recorded by this process for each key
+        self._latest = {}
+        self._latest_lock = threading.Lock()
+
+    def connection(self):
+        """
+        Get this thread's connection, opened after any fork so processes never share one
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+            # The plans hold the queries of every user, SQLite gives the WAL files the mode of the database
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            # Readers do not block the writers of other threads and processes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def record(self, database, query, plan, settings=None, config=None):
+        """
+        Record a plan of a query made under what-if settings and the session's config, return its entry ID.
+        A plan equal to the last one this process recorded for its key is written at most once per SEEN_INTERVAL.
+        """
+        now = time.time()
+        key = (database, query_fingerprint(query), settings_key(settings))
+        config = settings_key(config)
+        shape = PlanTree.from_plan(plan.plan).fingerprint()
+        with self._latest_lock:
+            pending = self._latest.get(key)
+            if (pending is not None and not plan.analyzed and now - pending.written_at < SEEN_INTERVAL
+                    and (pending.shape, pending.cost, pending.config) == (shape, plan.total_cost, config)):
+                pending.unwritten += 1
+                pending.last_seen = now
+                return pending.entry_id
+            # The times the last plan was seen in memory are written with this one
+            self._latest.pop(key, None)
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if pending is not None and pending.unwritten:
+                conn.execute("UPDATE plans SET last_seen = MAX(last_seen, ?), seen = seen + ? WHERE id = ?",
+                             (pending.last_seen, pending.unwritten, pending.entry_id))
+            latest = conn.execute(
+                "SELECT id, shape, cost, config, execution_time FROM plans "
+                "WHERE database = ? AND fingerprint = ? AND settings = ? ORDER BY recorded_at DESC, id DESC LIMIT 1",
+                key).fetchone()
+            # Measured plans are always kept, their timings differ on every run
+            if (latest is not None and not plan.analyzed and latest['execution_time'] is None
+                    and (latest['shape'], latest['cost'], latest['config']) == (shape, plan.total_cost, config)):
+                conn.execute("UPDATE plans SET last_seen = ?, seen = seen + 1 WHERE id = ?", (now, latest['id']))
+                entry_id = latest['id']
+            else:
+                entry_id = conn.execute(
+                    "INSERT INTO plans (database, fingerprint, settings, config, shape, cost, rows, execution_time, "
+                    "recorded_at, last_seen, query, plan) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    key + (config, shape, plan.total_cost, plan.plan_rows, plan.execution_time, now, now, query,
+                           zlib.compress(json.dumps(plan.data).encode()))).lastrowid
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        with self._latest_lock:
+            # Measured plans are compared with the next ones in the database, never in memory
+            if plan.analyzed:
+                self._latest.pop(key, None)
+            else:
+                self._latest[key] = _LatestPlan(entry_id, shape, plan.total_cost, config, now)
+        return entry_id
+
+    def record_event(self, database, kind, detail=None):
+        self.connection().execute("INSERT INTO events (database, kind, detail, recorded_at) VALUES (?, ?, ?, ?)",
+                                  (database, kind, detail[:EVENT_DETAIL_LENGTH] if detail else None, time.time()))
+
+    def load_plan(self, entry_id):
+        """
+        Get the plan of an entry as a QueryPlan, None if there is no such entry
+        """
+        row = self.connection().execute("SELECT plan FROM plans WHERE id = ?", (entry_id,)).fetchone()
+        return QueryPlan(json.loads(zlib.decompress(row['plan']))) if row is not None else None
+
+    def entries(self, database=None, query=None, settings=None, limit=100):
+        """
+        Get the latest entries, without their plans, newest first
+        """
+        filters, params = self._filters(database, query, settings)
+        rows = self.connection().execute(
+            f"SELECT id, database, fingerprint, settings, config, shape, cost, rows, execution_time, recorded_at, "
+            f"last_seen, seen, query FROM plans WHERE {filters} ORDER BY recorded_at DESC, id DESC LIMIT ?",
+            params + [limit]).fetchall()
+        return [dict(row, settings=json.loads(row['settings']), config=json.loads(row['config'])) for row in rows]
+
+    def detect_regressions(self, database=None, query=None, settings=None, cost_threshold=DEFAULT_COST_THRESHOLD,
+                           since=0):
+        """
+        Find the plans whose shape changed, or whose cost changed by more than cost_threshold, from the plan
+        recorded before them for the same query and settings, oldest first.
+        Each change lists the ANALYZEs, reloads, config and schema changes recorded in between as its causes.
+        :param since: only look at plans recorded from this timestamp on
+        """
+        filters, params = self._filters(database, query, settings)
+        conn = self.connection()
+        changes = []
+        for row in conn.execute(_CONSECUTIVE_PLANS.format(filters=filters), params + [since]).fetchall():
+            shape_changed = row['shape'] != row['before_shape']
+            before_cost, after_cost = row['before_cost'] or 0., row['cost'] or 0.
+            cost_changed = abs(after_cost - before_cost) > cost_threshold * before_cost
+            if not shape_changed and not cost_changed:
+                continue
+            causes = [(event['kind'], event['detail'], event['recorded_at']) for event in conn.execute(
+                "SELECT kind, detail, recorded_at FROM events WHERE database = ? AND recorded_at BETWEEN ? AND ? "
+                "ORDER BY recorded_at", (row['database'], row['before_last_seen'], row['recorded_at']))]
+            if row['config'] != row['before_config']:
+                causes.append((CONFIG, f"{row['before_config']} -> {row['config']}", row['recorded_at']))
+            changes.append(PlanChange(row['database'], row['fingerprint'], row['query'], json.loads(row['settings']),
+                                      row['before_id'], row['id'], row['recorded_at'], shape_changed, before_cost,
+                                      after_cost, causes))
+        return changes
+
+    def latest_change(self, database, query, settings=None, cost_threshold=DEFAULT_COST_THRESHOLD):
+        """
+        Get the change that led to the latest plan of a query, None if its latest plan did not change
+        """
+        entries = self.entries(database, query, settings or {}, limit=1)
+        if not entries:
+            return None
+        changes = self.detect_regressions(database, query, settings or {}, cost_threshold,
+                                          since=entries[0]['recorded_at'])
+        return next((change for change in changes if change.after_id == entries[0]['id']), None)
+
+    @staticmethod
+    def _filters(database=None, query=None, settings=None):
+        filters, params = ["1 = 1"], []
+        if database is not None:
+            filters.append("database = ?")
+            params.append(database)
+        if query is not None:
+            filters.append("fingerprint = ?")
+            params.append(query_fingerprint(query))
+        if settings is not None:
+            filters.append("settings = ?")
+            params.append(settings_key(settings))
+        return " AND ".join(filters), params
+
+
+def configure_plan_history(path):
+    """
+    Keep the plan history in a SQLite file, None to keep no history
+    """
+    global _plan_history, _configured
+    _plan_history = PlanHistory(path) if path else None
+    _configured = True
+    return _plan_history
+
+
+def get_plan_history():
+    """
+    Get the plan history, opened at $QEP_PLAN_HISTORY (or in the private cache directory) unless configured
+    """
+    if not _configured:
+        configure_plan_history(os.environ.get(HISTORY_PATH_ENV) or os.path.join(cache_directory(), HISTORY_FILE))
+    return _plan_history
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="List the plans that changed shape or cost")
+    parser.add_argument('--path', help="plan history file (default: $QEP_PLAN_HISTORY or the temporary directory)")
+    parser.add_argument('--database', help="only this database, as host:port/dbname")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_COST_THRESHOLD,
+                        help="relative cost change that is flagged (default: %(default)s)")
+    parser.add_argument('--hours', type=float, help="only plans recorded in the last hours")
+    args = parser.parse_args()
+
+    history = configure_plan_history(args.path) if args.path else get_plan_history()
+    since = time.time() - args.hours * 3600 if args.hours else 0
+    changes = history.detect_regressions(args.database, cost_threshold=args.threshold, since=since)
+    for change in changes:
+        recorded_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(change.recorded_at))
+        settings = f" with {change.settings}" if change.settings else ""
+        print(f"{recorded_at} {change.database} {change.fingerprint[:12]}{settings}: {change.describe()}")
+        print(f"    {' '.join(change.query.split())[:120]}")
+        for kind, detail, event_time in change.causes:
+            print(f"    {time.strftime('%H:%M:%S', time.localtime(event_time))} {kind}: {detail or ''}")
+    print(f"{len(changes)} plan changes")
@@ -1,10 +1,83 @@
 import psycopg2
 from psycopg2 import sql
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
 import os
+import re
+import threading
+import time
 from dotenv import load_dotenv
-import create_script
+import argparse
+from db import create_script, generate
+from db.plan_history import get_plan_history, RELOAD
 load_dotenv()
 
+# Files larger than this are split into several concurrently loaded chunks
+CHUNK_SIZE = 64 * 1024 ** 2
+# Buffer size used by COPY when reading a chunk
+COPY_BUFFER_SIZE = 1024 ** 2
+# Generated batches a load keeps ready ahead of its COPY
+PREFETCH_BATCHES = 2
+
+# Data files of the TPC-H tables
+tbl_files = {table: os.path.abspath(f'db/tbl/{table}.tbl') for table in create_script.script_dict.keys()}
+
+
+# Table definition without its PRIMARY KEY / FOREIGN KEY constraints
+def bare_table_script(script):
+    return re.sub(r",\s*CONSTRAINT\b.*?(?=\)\s*WITH\b)", "\n", script, flags=re.DOTALL | re.IGNORECASE)
+
+
+# ALTER TABLE statements adding the constraints of a table definition, as (primary keys, foreign keys)
+def constraint_scripts(table, script):
+    constraints = re.findall(r"CONSTRAINT\s+(\w+)\s+(PRIMARY KEY\s*\([^)]*\)|FOREIGN KEY\s*\([^)]*\)\s*"
+                             r"REFERENCES\s+[\w.]+\s*\([^)]*\))", script, re.IGNORECASE)
+    primary_keys = [f"ALTER TABLE public.{table} ADD CONSTRAINT {name} {definition}"
+                    for name, definition in constraints if definition.upper().startswith("PRIMARY")]
+    # All foreign keys of a table are added by one statement so it scans the table once
+    foreign_key_clauses = [f"ADD CONSTRAINT {name} {' '.join(definition.split())}"
+                           for name, definition in constraints if definition.upper().startswith("FOREIGN")]
+    foreign_keys = [f"ALTER TABLE public.{table} " + ", ".join(foreign_key_clauses)] if foreign_key_clauses else []
+    return primary_keys, foreign_keys
+
+
+# Split a file into byte ranges that start and end on line boundaries
+def split_file(path, chunk_size=CHUNK_SIZE):
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as file:
+        start = 0
+        while start < size:
+            file.seek(min(start + chunk_size, size))
+            # Move the end of the chunk to the end of the line it falls in
+            file.readline()
+            end = min(file.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+# Read-only file object exposing a byte range of a file, as consumed by COPY
+class FileRange:
+    def __init__(self, file, start, end):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.readline(size)
+        self.remaining -= len(data)
+        return data
+
 
 class Database:
     def __init__(self):
@@ -80,13 +153,169 @@ class Database:
             conn.commit()
             conn.close()
 
+    # Run statements concurrently, each on its own connection
+    def run_parallel(self, statements, workers):
+        def run(statement):
+            conn = self.connect()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(statement)
+                conn.commit()
+            finally:
+                conn.close()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(run, statements))
+
+    # Load one byte range of a data file, returning the number of rows copied
+    def copy_range(self, table, path, start, end):
+        conn = self.connect()
+        try:
+            with conn.cursor() as cursor, open(path, 'rb') as file:
+                # The load is redone from scratch on failure, so it does not need to wait for the WAL flush
+                cursor.execute("SET synchronous_commit = off")
+                query = f"COPY {table} FROM STDIN DELIMITER '|' CSV"
+                cursor.copy_expert(sql=query, file=FileRange(file, start, end), size=COPY_BUFFER_SIZE)
+                rows = cursor.rowcount
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    # Generate batches of a table in worker processes and COPY each one as it arrives, one connection per table
+    # filled (orders and line items are generated together), returning the number of rows copied per table
+    def copy_generated(self, processes, table, scale_factor, batches):
+        tables = generate.generated_tables(table)
+        connections = [self.connect() for _ in tables]
+        rows = dict.fromkeys(tables, 0)
+        try:
+            cursors = [conn.cursor() for conn in connections]
+            for cursor in cursors:
+                cursor.execute("SET synchronous_commit = off")
+
+            def copy_batch(texts):
+                for generated_table, cursor, text in zip(tables, cursors, texts):
+                    query = f"COPY {generated_table} FROM STDIN DELIMITER '|' CSV"
+                    cursor.copy_expert(sql=query, file=generate.RowStream(iter([text])), size=COPY_BUFFER_SIZE)
+                    rows[generated_table] += cursor.rowcount
+
+            pending = deque()
+            for start, stop in batches:
+                pending.append(processes.submit(generate.generate_batch, table, scale_factor, start, stop))
+                if len(pending) > PREFETCH_BATCHES:
+                    copy_batch(pending.popleft().result())
+            while pending:
+                copy_batch(pending.popleft().result())
+            for conn in connections:
+                conn.commit()
+            return rows
+        finally:
+            for conn in connections:
+                conn.close()
+
+    # Drop the tables and create them again without constraints
+    def create_bare_tables(self):
+        self.drop_table()
+        conn = self.connect()
+        with conn.cursor() as cursor:
+            for table, script in create_script.script_dict.items():
+                cursor.execute(bare_table_script(script))
+        conn.commit()
+        conn.close()
+        print("Tables created without constraints")
+
+    # Run load functions in parallel, each returning the rows it copied per table, and report the rows/s of every table
+    def run_loads(self, jobs, workers):
+        table_stats = {}
+        stats_lock = threading.Lock()
+
+        def load(load_function):
+            job_start = time.time()
+            table_rows = load_function()
+            with stats_lock:
+                for table, rows in table_rows.items():
+                    stats = table_stats.setdefault(table, {'rows': 0, 'start': job_start, 'end': 0})
+                    stats['rows'] += rows
+                    stats['start'] = min(stats['start'], job_start)
+                    stats['end'] = max(stats['end'], time.time())
+
+        load_start = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(load, jobs))
+        load_time = max(time.time() - load_start, 1e-9)
+
+        for table, stats in table_stats.items():
+            elapsed = max(stats['end'] - stats['start'], 1e-9)
+            print(f"Data inserted into {table}: {stats['rows']:,} rows in {elapsed:.2f}s "
+                  f"({stats['rows'] / elapsed:,.0f} rows/s)")
+        total_rows = sum(stats['rows'] for stats in table_stats.values())
+        print(f"Loaded {total_rows:,} rows in {load_time:.2f}s ({total_rows / load_time:,.0f} rows/s)")
+
+    # Create constraint-free tables, COPY the data files in parallel chunks, then add the constraints in parallel
+    def bulk_load(self, workers=None):
+        workers = workers or os.cpu_count() or 4
+        self.create_bare_tables()
+
+        # Largest chunks first so the slowest work starts early
+        chunks = [(table, path, start, end) for table, path in tbl_files.items() for start, end in split_file(path)]
+        chunks.sort(key=lambda chunk: chunk[2] - chunk[3])
+        self.run_loads([lambda table=table, path=path, start=start, end=end:
+                        {table: self.copy_range(table, path, start, end)} for table, path, start, end in chunks], workers)
+        self.add_constraints(workers)
+
+    # Generate TPC-H data at any scale factor in worker processes and stream it into COPY without intermediate files
+    def generate_load(self, scale_factor, workers=None):
+        workers = workers or os.cpu_count() or 4
+        self.create_bare_tables()
+
+        # Orders and their line items take the longest to generate, so they start first
+        tables = sorted(generate.generators, key=lambda table: table != 'orders')
+        with ProcessPoolExecutor(max_workers=workers) as processes:
+            self.run_loads([lambda table=table, batches=batches:
+                            self.copy_generated(processes, table, scale_factor, batches)
+                            for table in tables for batches in generate.batch_ranges(table, scale_factor, workers)],
+                           workers)
+        self.add_constraints(workers)
+
+    # Add the primary keys and then the foreign keys of every table in parallel, then ANALYZE
+    def add_constraints(self, workers):
+        scripts = create_script.script_dict
+        # Foreign keys need the primary keys they reference, so primary keys go first
+        primary_keys, foreign_keys = [], []
+        for table, script in scripts.items():
+            table_primary_keys, table_foreign_keys = constraint_scripts(table, script)
+            primary_keys.extend(table_primary_keys)
+            foreign_keys.extend(table_foreign_keys)
+        start_time = time.time()
+        self.run_parallel(primary_keys, workers)
+        print(f"Primary keys added in {time.time() - start_time:.2f}s")
+        start_time = time.time()
+        self.run_parallel(foreign_keys, workers)
+        print(f"Foreign keys added in {time.time() - start_time:.2f}s")
+
+        conn = self.connect()
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        conn.close()
+        # Plans made before the reload are compared against the ones made after it
+        history = get_plan_history()
+        if history is not None:
+            history.record_event(f"{self.db_host}:{self.db_port}/{self.db_name}", RELOAD, "data reloaded")
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Populate the TPC-H database")
+    parser.add_argument('--generate', type=float, metavar='SCALE_FACTOR',
+                        help="generate the data at this scale factor instead of loading db/tbl/*.tbl")
+    parser.add_argument('--workers', type=int, help="number of concurrent connections (default: CPU count)")
+    args = parser.parse_args()
+
     print('Connecting to the database...')
     db = Database()
     db.connect()
     print('Connected')
-    db.drop_table()
-    db.create_table()
-    print('Tables created')
-    db.insert_data()
+    if args.generate:
+        db.generate_load(args.generate, args.workers)
+    else:
+        db.bulk_load(args.workers)
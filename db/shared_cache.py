@@ -0,0 +1,49 @@
+import diskcache
+import os
+import stat
+
+# Most bytes kept on disk, the least recently stored entries are culled above it
+SHARED_CACHE_SIZE_LIMIT = 2 ** 30
+# Directory for sessions, caches, background jobs and the plan history, required when serving with gunicorn
+CACHE_DIR_ENV = "QEP_CACHE_DIR"
+# Used without $QEP_CACHE_DIR, private to the user running the app
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "qep")
+
+_shared_cache = None
+
+
+def configure_shared_cache(directory, size_limit=SHARED_CACHE_SIZE_LIMIT):
+    """
+    Share plans, layouts and catalogs between worker processes through a SQLite-backed cache in a directory.
+    Configured once before the workers fork, every worker then opens its own connection to it.
+    """
+    global _shared_cache
+    _shared_cache = diskcache.Cache(directory, size_limit=size_limit) if directory else None
+    return _shared_cache
+
+
+def private_directory(directory):
+    """
+    Create a directory only this user can use, or check that an existing one belongs to this user and nobody
+    else can use it
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    status = os.stat(directory)
+    if status.st_uid != os.getuid() or stat.S_IMODE(status.st_mode) & 0o077:
+        raise RuntimeError(f"{directory} must be owned by this user with no group or other permissions "
+                           f"(chmod 700), it holds the sessions and plans of every user")
+    return directory
+
+
+def cache_directory():
+    """
+    Get the private directory of the app's on-disk state, $QEP_CACHE_DIR or a directory in the user's cache
+    """
+    return private_directory(os.environ.get(CACHE_DIR_ENV) or DEFAULT_CACHE_DIR)
+
+
+def get_shared_cache():
+    """
+    Get the shared cache, None if the caches of this process are not shared
+    """
+    return _shared_cache
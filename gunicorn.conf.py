@@ -0,0 +1,19 @@
+import multiprocessing
+import os
+
+# gunicorn -c gunicorn.conf.py, every setting can be overridden on the command line
+wsgi_app = "wsgi:create_app()"
+bind = os.environ.get("QEP_BIND", "0.0.0.0:8050")
+# Build the app once in the master, the workers fork from it and share its memory until they write to it
+preload_app = True
+workers = int(os.environ.get("QEP_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+# Callbacks mostly wait on PostgreSQL, so every worker serves several sessions at once
+worker_class = "gthread"
+threads = int(os.environ.get("QEP_THREADS", 4))
+# Every worker borrows at most $QEP_MAX_CONNECTIONS (see db/db.py) connections at once for all of its sessions
+# Long queries and EXPLAIN ANALYZE run as background callbacks, requests themselves stay short
+timeout = 120
+# Recycle workers now and then so fragmented memory is given back
+max_requests = 1000
+max_requests_jitter = 100
+accesslog = "-"
@@ -1,38 +1,113 @@
-from dash import Dash, html, dcc, Output, Input, State, callback_context, MATCH, ALL
+from dash import Dash, DiskcacheManager, html, dcc, dash_table, Output, Input, State, callback_context, no_update, \
+    Patch, MATCH, ALL
 import dash_bootstrap_components as dbc
 from interface_components.navbar import navbar
 from interface_components.accordion import accordion
 from interface_components.graph_plot import GraphPlot
-from db.db import Database
+from interface_components.diff_plot import DiffPlot, STATUS_COLORS, format_delta
+from interface_components.knob_plot import KnobPlot
+from db.db import DEFAULT_PAGE_SIZE, is_row_query, is_setting_command
 from db.query_list import query_template_list
-from preprocessing import Graph
-import pandas as pd
+from db.plan import QueryPlan
+from plan_diff import PlanDiff
+from sessions import SessionStore, new_session_id
+from db.shared_cache import cache_directory
+from metrics import instrument_callback, register_metrics, timed, FORMAT_SQL
+from contextlib import contextmanager
+import diskcache
 import psycopg2
 import plotly.graph_objs as go
 import feffery_markdown_components as fmc
-import json
-from sql_formatter.core import format_sql
-from whatif import whatif_query, modify_join_order, get_modifiable_list
+import threading
+import time
+import uuid
+import os
+from sql_formatter.core import format_sql as _format_sql
+from whatif import whatif_query, sweep_whatif, modify_join_order, get_modifiable_list, sweep_knobs, knob_grids, \
+    parse_knob_values
+from join_rewrite import parse_join_order, format_join_order
+from advisor import advise_indexes
+from join_order import enumerate_join_orders
+
+# Long-running callbacks run in child processes that exchange progress and results through this cache
+BACKGROUND_CACHE_DIR = os.path.join(cache_directory(), "background")
+background_cache = diskcache.Cache(BACKGROUND_CACHE_DIR)
+background_callback_manager = DiskcacheManager(background_cache)
+# Seconds between progress updates of a running background callback
+PROGRESS_INTERVAL = 1
+# Plans handed from a background callback to the app are dropped if never picked up
+PLAN_HANDOFF_EXPIRY = 600
+# Components toggled while a statement of the query tab (the query, a page of it or its row count) runs in the
+# background, only one of them can run at a time and the Cancel button cancels it
+QUERY_RUNNING = [
+    (Output("execute-button", "disabled"), True, False),
+    (Output("count-rows-button", "disabled"), True, False),
+    (Output("cancel-query-button", "disabled"), False, True),
+    (Output("query-progress", "style"), {"display": "block"}, {"display": "none"}),
+]
+
+# SQL shown in the interface is formatted in a span of its own
+format_sql = timed(FORMAT_SQL)(_format_sql)
+
+# Options of the what-if dropdowns
+join_type_options = [
+    {'label': 'No modification', 'value': 'none'},
+    {'label': 'Hash Join', 'value': 'hash'},
+    {'label': 'Merge Join', 'value': 'merge'},
+    {'label': 'Nested Loop Join', 'value': 'nested'}
+]
+scan_type_options = [
+    {'label': 'No modification', 'value': 'none'},
+    {'label': 'Sequential Scan', 'value': 'seq'},
+    {'label': 'Index Scan', 'value': 'index'},
+    {'label': 'Bitmap Scan', 'value': 'bitmap'}
+]
+aggregate_type_options = [
+    {'label': 'No modification', 'value': 'hash'},
+    {'label': 'Disable Hash Aggregate', 'value': 'no_hash'}
+]
+# Options of the knob sweep dropdowns
+knob_options = [{'label': name, 'value': name} for name in knob_grids]
 
 
 class Interface:
-    def __init__(self):
+    def __init__(self, session_directory=None, session_secret=None):
+        """
+        :param session_directory: directory of the session store shared by worker processes,
+            None to keep sessions in this process only
+        :param session_secret: Fernet key encrypting the DB passwords of the shared sessions
+        """
         self.app = Dash(
             __name__,
             external_stylesheets=[dbc.themes.ZEPHYR, dbc.icons.BOOTSTRAP],
+            background_callback_manager=background_callback_manager,
         )
+        # Connections, catalogs and plans of every browser session, found through the session ID in the page
+        self.sessions = SessionStore(directory=session_directory, secret=session_secret)
+        # Per-stage latency and allocation histograms on /metrics (Prometheus) and /metrics.json
+        register_metrics(self.app.server)
         self.set_layout()
         self.set_callbacks()
-        self.db = None
-        self.qep = None
-        self.qep_cost = None
-        self.qep_rows = None
-        self.modified_query = None
-        self.modified_qep = None
-        self.modified_qep_cost = None
+
+    def callback(self, *args, **kwargs):
+        """
+        Register a Dash callback whose body is timed as a span, see metrics.py
+        """
+        def decorator(fn):
+            return self.app.callback(*args, **kwargs)(instrument_callback(fn))
+        return decorator
+
+    def serve_layout(self):
+        """
+        Serve the page with a new session ID, which the browser tab keeps across reloads
+        """
+        return html.Div([
+            dcc.Store(id="session-id", data=new_session_id(), storage_type="session"),
+            self.layout,
+        ])
 
     def set_layout(self):
-        self.app.layout = html.Div([
+        self.layout = html.Div([
             navbar(),
             dbc.Container([
                 dbc.Row([
@@ -79,6 +154,15 @@ class Interface:
                                 width=9,
                             )
                         ], className="mb-3"),
+                        dbc.Checklist(
+                            id="connect-jobs",
+                            options=[
+                                {"label": "Run ANALYZE in the background", "value": "analyze"},
+                                {"label": "Count exact rows in the background", "value": "count"},
+                            ],
+                            value=["analyze"],
+                            switch=True,
+                        ),
                         dbc.Button(["Connect", html.I(className="bi bi-database-fill-lock ms-2")], id="connect-button",
                                    color="primary", className="my-3"),
                         dbc.Alert(id="connection-status", color="info", is_open=False)
@@ -93,6 +177,8 @@ class Interface:
                             type="default",
                             children=[
                                 html.P(id="table-time-taken", className="my-3"),
+                                html.P(id="table-jobs-status", className="my-3 text-muted"),
+                                dcc.Interval(id="table-jobs-interval", interval=1000, disabled=True),
                                 html.Div(
                                     style={"maxHeight": "400px", "overflowY": "auto"},
                                     children=[
@@ -148,8 +234,30 @@ class Interface:
                             ),
                         ], className="mb-3"),
 
-                        dbc.Button(["Execute", html.I(className="bi bi-play-fill ms-2")], id="execute-button",
-                                   color="primary", className="my-3", disabled=True),
+                        dbc.Row([
+                            dbc.Label("Timeout (s)", html_for="statement-timeout", width=3),
+                            dbc.Col(
+                                dbc.Input(id="statement-timeout", placeholder="No limit", type="number", min=0),
+                                width=9,
+                            )
+                        ], className="mb-3"),
+
+                        dbc.Row([
+                            dbc.Col(
+                                dbc.Button(["Execute", html.I(className="bi bi-play-fill ms-2")],
+                                           id="execute-button", color="primary", className="my-3", disabled=True),
+                                width="auto"
+                            ),
+                            dbc.Col(
+                                dbc.Button(["Cancel", html.I(className="bi bi-stop-fill ms-2")],
+                                           id="cancel-query-button", color="danger", className="my-3",
+                                           disabled=True),
+                                width="auto"
+                            ),
+                        ], className="g-2"),
+                        html.P(id="query-progress", className="text-muted", style={"display": "none"}),
+                        html.P(id="query-cancel-status", className="text-muted"),
+                        dcc.Store(id="query-backend-pid"),
                         dbc.Alert(
                             id="query-status",
                             color="info",
@@ -169,16 +277,50 @@ class Interface:
                                     children=[
                                         html.P(id="query-time-taken", className="my-3"),
                                         html.P(id="query-rows-count", className="my-3"),
-                                        html.Div(id="query-output", style={
-                                            "maxWidth": "100%",
-                                            "overflowX": "auto",
-                                            "maxHeight": "350px",
-                                            "overflowY": "auto"
-                                        })
+                                        html.Div(id="query-output"),
                                     ]
                                 ),
                             ),
                         ]),
+                        # Result grid, paged on the server so only one page is ever held in memory
+                        dcc.Store(id="query-executed"),
+                        # Page of the grid currently loaded, so resetting the page of a new result fetches nothing
+                        dcc.Store(id="query-page"),
+                        # SET / RESET run in the background, tracked by the session's pool once it succeeded
+                        dcc.Store(id="query-setting"),
+                        html.Div(id="query-table-container", style={"display": "none"}, children=[
+                            dash_table.DataTable(
+                                id="query-table",
+                                page_action="custom",
+                                page_current=0,
+                                page_size=DEFAULT_PAGE_SIZE,
+                                virtualization=True,
+                                fixed_rows={"headers": True},
+                                style_table={"maxHeight": "350px", "overflowY": "auto", "overflowX": "auto"},
+                                style_cell={
+                                    "fontSize": "14px",
+                                    "padding": "2px",
+                                    "whiteSpace": "nowrap",
+                                    "overflow": "hidden",
+                                    "textOverflow": "ellipsis",
+                                    "minWidth": "100px",
+                                    "maxWidth": "300px",
+                                    "textAlign": "left",
+                                },
+                            ),
+                            dbc.Row([
+                                dbc.Col(
+                                    dbc.Button(["Count Total Rows", html.I(className="bi bi-calculator ms-2")],
+                                               id="count-rows-button", color="secondary", size="sm",
+                                               className="my-3"),
+                                    width="auto"
+                                ),
+                                dbc.Col(
+                                    dcc.Loading(html.P(id="query-total-rows", className="my-3"), type="dot"),
+                                    width="auto"
+                                ),
+                            ], className="g-2 align-items-center"),
+                        ]),
 
                     ], width=6),
                 ]),
@@ -188,8 +330,31 @@ class Interface:
                         html.H5([
                             html.B("QEP")
                         ], className="bg-light text-dark p-3 py-3 rounded-3 mb-3"),
-                        dbc.Button(["Get QEP", html.I(className="bi bi-filetype-json ms-2")], id="qep-button",
-                                   color="primary", className="my-3", disabled=True),
+                        dbc.Row([
+                            dbc.Col(
+                                dbc.Button(["Get QEP", html.I(className="bi bi-filetype-json ms-2")],
+                                           id="qep-button", color="primary", className="my-3", disabled=True),
+                                width="auto"
+                            ),
+                            dbc.Col(
+                                dbc.Button(["Cancel", html.I(className="bi bi-stop-fill ms-2")],
+                                           id="cancel-qep-button", color="danger", className="my-3",
+                                           disabled=True),
+                                width="auto"
+                            ),
+                        ], className="g-2"),
+                        html.P(id="qep-progress", className="text-muted", style={"display": "none"}),
+                        html.P(id="qep-cancel-status", className="text-muted"),
+                        dcc.Store(id="qep-backend-pid"),
+                        # Key of the plan handed over from the background callback through background_cache
+                        dcc.Store(id="qep-handoff"),
+                        # Set by the QEP button to hand EXPLAIN ANALYZE over to its background callback
+                        dcc.Store(id="qep-analyze-request"),
+                        dbc.Switch(
+                            id="qep-analyze",
+                            label="EXPLAIN ANALYZE (runs the query in a rolled-back transaction)",
+                            value=False,
+                        ),
                         dbc.Alert(id="qep-status", color="info", is_open=False),
                         dbc.Row([
                             dbc.Col(
@@ -216,6 +381,16 @@ class Interface:
                         ], className="bg-light text-dark p-3 py-3 rounded-3 mb-3"),
                         dbc.Button(["Show QEP Graph", html.I(className="bi bi-diagram-3-fill ms-2")],
                                    id="show-qep-graph", color="primary", className="my-3", disabled=True),
+                        dbc.RadioItems(
+                            id="qep-color-by",
+                            options=[
+                                {"label": "Estimated cost", "value": "cost"},
+                                {"label": "Actual time", "value": "time"},
+                                {"label": "Row misestimate", "value": "misestimate"},
+                            ],
+                            value="cost",
+                            inline=True,
+                        ),
                         dbc.Alert(id="qep-graph-status", color="info", is_open=False),
                         dbc.Row([
                             dbc.Col(
@@ -229,6 +404,7 @@ class Interface:
                                             dcc.Graph(id="qep-interactive-graph", figure=go.Figure(),
                                                       style={"display": "none"}),
                                         ]),
+                                        html.Div(id="qep-node-details", className="mt-3"),
                                     ]
                                 ),
                             ),
@@ -242,7 +418,28 @@ class Interface:
                         html.H5([
                             html.B("Modify Join Order")
                         ], className="bg-light text-dark p-3 py-3 rounded-3 mb-3"),
-                        dbc.Button(["View Join Orders", html.I(className="bi bi-search ms-2")], id="explore-join-order-btn", color="primary", className="my-3", disabled=True),
+                        dbc.Row([
+                            dbc.Col(
+                                dbc.Button(["View Join Orders", html.I(className="bi bi-search ms-2")],
+                                           id="explore-join-order-btn", color="primary", className="my-3",
+                                           disabled=True),
+                                width="auto"
+                            ),
+                            dbc.Col(
+                                dbc.Button(["Find Cheapest Join Orders", html.I(className="bi bi-sort-down ms-2")],
+                                           id="enumerate-join-orders-btn", color="secondary", className="my-3",
+                                           disabled=True),
+                                width="auto"
+                            ),
+                        ], className="g-2"),
+                        dcc.Loading(
+                            id="loading-join-order-search",
+                            type="default",
+                            children=[
+                                html.P(id="join-order-search-time-taken", className="my-3"),
+                                html.Div(id="join-order-search-output"),
+                            ]
+                        ),
                         dcc.Loading(
                             id="loading-join-orders",
                             type="default",
@@ -293,12 +490,7 @@ class Interface:
                                     dbc.Col(
                                         dbc.Select(
                                             id='join-type-dropdown',
-                                            options=[
-                                                {'label': 'No modification', 'value': 'none'},
-                                                {'label': 'Hash Join', 'value': 'hash'},
-                                                {'label': 'Merge Join', 'value': 'merge'},
-                                                {'label': 'Nested Loop Join', 'value': 'nested'}
-                                            ],
+                                            options=join_type_options,
                                             value='none',
                                         ),
                                         width=6
@@ -311,12 +503,7 @@ class Interface:
                                     dbc.Col(
                                         dbc.Select(
                                             id='scan-type-dropdown',
-                                            options=[
-                                                {'label': 'No modification', 'value': 'none'},
-                                                {'label': 'Sequential Scan', 'value': 'seq'},
-                                                {'label': 'Index Scan', 'value': 'index'},
-                                                {'label': 'Bitmap Scan', 'value': 'bitmap'}
-                                            ],
+                                            options=scan_type_options,
                                             value='none',
                                         ),
                                         width=6
@@ -329,10 +516,7 @@ class Interface:
                                     dbc.Col(
                                         dbc.Select(
                                             id='aggregate-type-dropdown',
-                                            options=[
-                                                {'label': 'No modification', 'value': 'hash'},
-                                                {'label': 'Disable Hash Aggregate', 'value': 'no_hash'}
-                                            ],
+                                            options=aggregate_type_options,
                                             value='hash',
                                         ),
                                         width=6
@@ -340,10 +524,99 @@ class Interface:
                                 ]),
                             ], className="mb-3", width=6),
                         ]),
-                        dbc.Button(["Execute Modified Query", html.I(className="bi bi-play-fill ms-2")],
-                                   id="execute-whatif-query-btn", color="primary", className="my-3", disabled=True),
+                        dbc.Row([
+                            dbc.Col(
+                                dbc.Button(["Execute Modified Query", html.I(className="bi bi-play-fill ms-2")],
+                                           id="execute-whatif-query-btn", color="primary", className="my-3",
+                                           disabled=True),
+                                width="auto"
+                            ),
+                            dbc.Col(
+                                dbc.Button(["Sweep All Combinations", html.I(className="bi bi-grid-3x3-gap-fill ms-2")],
+                                           id="sweep-whatif-btn", color="secondary", className="my-3",
+                                           disabled=True),
+                                width="auto"
+                            ),
+                            dbc.Col(
+                                dbc.Button(["Suggest Indexes", html.I(className="bi bi-lightning-charge-fill ms-2")],
+                                           id="advise-indexes-btn", color="secondary", className="my-3",
+                                           disabled=True),
+                                width="auto"
+                            ),
+                        ], className="g-2"),
 
                         dbc.Alert(id="whatif-query-status", color="info", is_open=False),
+                        dcc.Loading(
+                            id="loading-whatif-sweep",
+                            type="default",
+                            children=[
+                                html.P(id="whatif-sweep-time-taken", className="my-3"),
+                                html.Div(id="whatif-sweep-output", style={"maxHeight": "400px", "overflowY": "auto"}),
+                            ]
+                        ),
+                        dcc.Loading(
+                            id="loading-index-advice",
+                            type="default",
+                            children=[
+                                html.P(id="index-advice-time-taken", className="my-3"),
+                                html.Div(id="index-advice-output", style={"maxHeight": "400px", "overflowY": "auto"}),
+                            ]
+                        ),
+                    ], width=12),
+                ], className="mb-3"),
+                # Knob Sweep Section
+                html.Hr(),
+                dbc.Row([
+                    dbc.Col([
+                        html.H5([
+                            html.B("Sweep Resource Knobs")
+                        ], className="bg-light text-dark p-3 py-3 rounded-3 mb-3"),
+                        dbc.Row([
+                            dbc.Col([
+                                dbc.Row([
+                                    dbc.Label("Knob", html_for="knob-1-dropdown", width=4),
+                                    dbc.Col(
+                                        dbc.Select(id="knob-1-dropdown", options=knob_options, value="work_mem"),
+                                        width=8
+                                    ),
+                                ], className="mb-2"),
+                                dbc.Row([
+                                    dbc.Label("Values", html_for="knob-1-values", width=4),
+                                    dbc.Col(dbc.Input(id="knob-1-values", type="text"), width=8),
+                                ]),
+                            ], className="mb-3", width=6),
+                            dbc.Col([
+                                dbc.Row([
+                                    dbc.Label("Second Knob", html_for="knob-2-dropdown", width=4),
+                                    dbc.Col(
+                                        dbc.Select(id="knob-2-dropdown",
+                                                   options=[{'label': 'None', 'value': 'none'}] + knob_options,
+                                                   value="none"),
+                                        width=8
+                                    ),
+                                ], className="mb-2"),
+                                dbc.Row([
+                                    dbc.Label("Values", html_for="knob-2-values", width=4),
+                                    dbc.Col(dbc.Input(id="knob-2-values", type="text"), width=8),
+                                ]),
+                            ], className="mb-3", width=6),
+                        ]),
+                        dbc.Switch(
+                            id="knob-analyze",
+                            label="EXPLAIN ANALYZE every point (runs the query once per point, one at a time)",
+                            value=False,
+                        ),
+                        dbc.Button(["Sweep Knobs", html.I(className="bi bi-sliders ms-2")],
+                                   id="sweep-knobs-btn", color="secondary", className="my-3", disabled=True),
+                        dcc.Loading(
+                            id="loading-knob-sweep",
+                            type="default",
+                            children=[
+                                html.P(id="knob-sweep-time-taken", className="my-3"),
+                                html.Div(id="knob-sweep-graph"),
+                                html.Div(id="knob-sweep-output", style={"maxHeight": "400px", "overflowY": "auto"}),
+                            ]
+                        ),
                     ], width=12),
                 ], className="mb-3"),
                 dcc.Loading(
@@ -399,6 +672,7 @@ class Interface:
                                         html.Div(id="whatif-qep-graph", children=[
                                             dcc.Graph(id="updated-qep-graph", figure=go.Figure())
                                         ]),
+                                        html.Div(id="whatif-node-details", className="mt-3"),
                                         html.Div(id="accordion-container")
                                     ]
                                 ),
@@ -407,12 +681,26 @@ class Interface:
                     ], width=6),
                 ], className="mb-5"),
 
+                dbc.Row([
+                    dbc.Col([
+                        html.H5([
+                            html.B("QEP vs AQP")
+                        ], className="bg-light text-dark p-3 py-3 rounded-3 mb-3"),
+                        dcc.Loading(
+                            id="loading-plan-diff",
+                            type="default",
+                            children=[html.Div(id="plan-diff")]
+                        ),
+                    ], width=12),
+                ], className="mb-5"),
+
                 dbc.Row(className="py-5"),
             ]),
         ])
+        self.app.layout = self.serve_layout
 
     def set_callbacks(self):
-        @self.app.callback(
+        @self.callback(
             Output("connection-status", "children"),
             Output("connection-status", "color"),
             Output("connection-status", "is_open"),
@@ -420,164 +708,320 @@ class Interface:
             Output("table-time-taken", "children"),
             Output("qep-button", "disabled"),
             Output("execute-button", "disabled"),
+            Output("table-jobs-interval", "disabled"),
             Input("connect-button", "n_clicks"),
             State("host", "value"),
             State("port", "value"),
             State("dbname", "value"),
             State("user", "value"),
-            State("password", "value")
+            State("password", "value"),
+            State("connect-jobs", "value"),
+            State("session-id", "data")
         )
-        def connect_to_db(n_clicks, host, port, dbname, user, password):
+        def connect_to_db(n_clicks, host, port, dbname, user, password, connect_jobs, session_id):
             if n_clicks is None:
-                return "", "info", False, None, "", True, True
+                return "", "info", False, None, "", True, True, True
 
+            session = self.sessions.get(session_id)
             try:
-                # Attempt to connect to the PostgreSQL database
-                self.db = Database(host, port, dbname, user, password)
-                self.db.connect()
-
-                # Analyze the database
-                result, analyze_time, error, _ = self.db.analyze()
+                # Attempt to connect to the PostgreSQL database with a pool shared by the session's callbacks,
+                # replacing the pool of any previous connection
+                session.connect(host, port, dbname, user, password)
 
-                # Query to list all tables in the connected database
-                tables, time_taken, error, _ = self.db.list_all_tables()
-                table_rows = []
-                time_taken = time_taken + analyze_time
-
-                for schema, table in tables:
-                    columns = []
-                    # Get the columns for each table
-                    columns_result, time_taken_col, error, _ = self.db.list_columns(schema, table)
-
-                    for row in columns_result:
-                        columns.append(row[0])
-                    time_taken += time_taken_col
-
-                    # Get the exact number of rows
-                    row_count, time_taken_row = self.db.get_rows(schema, table)
-                    time_taken += time_taken_row
-
-                    # Create a table row
-                    table_rows.append(html.Tr([
-                        html.Td(table),
-                        html.Td(', '.join(columns)),
-                        html.Td(row_count)
-                    ]))
-
-                # Define table header
-                table_header = [
-                    html.Thead(html.Tr([
-                        html.Th("Table"),
-                        html.Th("Attributes"),
-                        html.Th("Rows")
-                    ]))
-                ]
-
-                # Combine header and body
-                table_body = [html.Tbody(table_rows)]
+                # Load every table's columns, estimated rows, size and indexes in one query
+                session.catalog, time_taken, error = session.db.load_catalog()
+                if error:
+                    raise psycopg2.OperationalError(error)
+                self.sessions.save(session)
 
-                table_children = table_header + table_body
+                # ANALYZE and exact row counts scale with the data, so they run in the background
+                connect_jobs = connect_jobs or []
+                if "analyze" in connect_jobs:
+                    session.jobs.submit("analyze", self.analyze_and_reload, session, session.db)
+                if "count" in connect_jobs:
+                    tables = [(entry['schema'], entry['table']) for entry in session.catalog]
+                    session.jobs.submit("count", session.db.exact_row_counts, tables)
 
                 return ([html.I(className="bi bi-check-circle-fill me-2"), "Connected successfully! "],
-                        "success", True, table_children, f"Time taken: {round(time_taken * 1000):,} ms", False,
-                        False)
+                        "success", True, self.build_table_schemas(session.catalog),
+                        f"Time taken: {round(time_taken * 1000):,} ms", False, False, not connect_jobs)
             except psycopg2.OperationalError as e:
                 print(f"Connection failed: {e}")
                 return ([html.I(className="bi bi-x-octagon-fill me-2"), "Connection failed:",
                          fmc.FefferyMarkdown(markdownStr=f"```sh\n{e}\n```", codeTheme="atom-dark", className="mt-3")],
-                        "danger", True, [], "", True, True)
+                        "danger", True, [], "", True, True, True)
+
+        @self.callback(
+            Output("table-schemas", "children", allow_duplicate=True),
+            Output("table-jobs-status", "children"),
+            Output("table-jobs-interval", "disabled", allow_duplicate=True),
+            Input("table-jobs-interval", "n_intervals"),
+            State("session-id", "data"),
+            prevent_initial_call=True
+        )
+        def poll_table_jobs(n_intervals, session_id):
+            session = self.sessions.get(session_id)
+            status = []
+            for name, label in [("analyze", "ANALYZE"), ("count", "Exact row count")]:
+                state, result, time_taken = session.jobs.status(name)
+                if state == "running":
+                    status.append(f"{label}: running...")
+                elif state == "done":
+                    status.append(f"{label}: done in {round(time_taken * 1000):,} ms")
+                elif state == "failed":
+                    status.append(f"{label}: failed ({result})")
 
-        @self.app.callback(
+            # Prefer exact counts once they are available, otherwise the refreshed estimates
+            state, exact_counts, _ = session.jobs.status("count")
+            table = self.build_table_schemas(session.catalog, exact_counts if state == "done" else None)
+            return table, " | ".join(status), not session.jobs.running()
+
+        @self.callback(
             Output("query-input", "value"),
             Input("query-template", "value")
         )
         def update_query_input(selected_template):
             return selected_template
 
-        @self.app.callback(
+        @self.callback(
             Output("query-status", "children"),
             Output("query-status", "color"),
             Output("query-status", "is_open"),
             Output("query-output", "children"),
             Output("query-time-taken", "children"),
             Output("query-rows-count", "children"),
+            Output("query-table", "data"),
+            Output("query-table", "columns"),
+            Output("query-table", "page_current"),
+            Output("query-table", "page_count"),
+            Output("query-table-container", "style"),
+            Output("query-executed", "data"),
+            Output("query-total-rows", "children"),
+            Output("query-page", "data"),
+            Output("query-setting", "data"),
             Input("execute-button", "n_clicks"),
             State("query-input", "value"),
+            State("statement-timeout", "value"),
+            State("session-id", "data"),
+            background=True,
+            running=QUERY_RUNNING,
+            progress=[Output("query-progress", "children"), Output("query-backend-pid", "data")],
+            prevent_initial_call=True
         )
-        def execute_query(n_clicks, query):
+        def execute_query(set_progress, n_clicks, query, timeout, session_id):
             if n_clicks is None:
-                return "", "info", False, None, "", ""
+                return "", "info", False, None, "", "", [], [], 0, None, {"display": "none"}, None, "", 0, None
 
             try:
-                # Execute the query
-                result, time_taken, error, rows = self.db.execute_query(query)
+                with self.background_session(session_id, set_progress, "Running query", timeout) as db:
+                    if is_row_query(query):
+                        rows, columns, has_more, time_taken, error = db.fetch_page(query, 0)
+                    else:
+                        # EXPLAIN, SHOW and INSERT ... RETURNING still return rows, with their own columns
+                        rows, columns, time_taken, error, _ = db.execute_statement(query)
+                        has_more = False
 
                 if error:
                     raise psycopg2.Error(error)
 
+                page_count = None if has_more else 1
                 # If the query returns results
-                if result:
-                    df = pd.DataFrame(result, columns=[desc[0] for desc in self.db.cursor.description])
-                    table = dbc.Table.from_dataframe(
-                        df,
-                        striped=True,
-                        bordered=True,
-                        hover=True,
-                        style={
-                            "fontSize": "14px",
-                            "padding": "2px",
-                            "margin": "0",
-                            "whiteSpace": "nowrap",
-                            "overflow": "hidden",
-                            "textOverflow": "ellipsis",
-                        }
-                    )
+                if rows:
                     return [html.I(className="bi bi-check-circle-fill me-2"),
-                            "Query executed successfully!"], "success", True, table, f"Time taken: {round(time_taken * 1000):,} ms", f"Rows returned: {rows}"
+                            "Query executed successfully!"], "success", True, None, \
+                        f"Time taken: {round(time_taken * 1000):,} ms", \
+                        f"Rows shown: 1 - {len(rows):,}", \
+                        self.to_table_data(rows), [{"name": column, "id": str(i)} for i, column in enumerate(columns)], \
+                        0, page_count, {"display": "block"}, query if is_row_query(query) else None, "", 0, None
                 else:
                     return [html.I(className="bi bi-check-circle-fill me-2"),
                             "Query executed successfully!"], "success", True, html.P(
-                        "Query executed successfully!"), f"Time taken: {round(time_taken * 1000):,} ms", "No rows returned"
+                        "Query executed successfully!"), f"Time taken: {round(time_taken * 1000):,} ms", \
+                        "No rows returned", [], [], 0, None, {"display": "none"}, None, "", 0, \
+                        query if is_setting_command(query) else None
             except psycopg2.Error as e:
                 # Split error message by lines and format with HTML line breaks
                 return [
                     html.I(className="bi bi-x-octagon-fill me-2"),
                     "Error executing query:",
                     fmc.FefferyMarkdown(markdownStr=f"```sh\n{str(e)}\n```", codeTheme="atom-dark", className="mt-3")
-                ], "danger", True, None, "", ""
+                ], "danger", True, None, "", "", [], [], 0, None, {"display": "none"}, None, "", 0, None
+
+        @self.callback(
+            Output("query-setting", "data", allow_duplicate=True),
+            Input("query-setting", "data"),
+            State("session-id", "data"),
+            prevent_initial_call=True
+        )
+        def track_query_setting(command, session_id):
+            # The SET ran on a connection of the background process, the pool applies it to later plans itself
+            session = self.sessions.get(session_id)
+            if command and session.db is not None:
+                session.db.track_setting(command)
+            return None
+
+        @self.callback(
+            Output("query-time-taken", "children", allow_duplicate=True),
+            Output("query-rows-count", "children", allow_duplicate=True),
+            Output("query-table", "data", allow_duplicate=True),
+            Output("query-table", "page_count", allow_duplicate=True),
+            Output("query-page", "data", allow_duplicate=True),
+            Input("query-table", "page_current"),
+            State("query-page", "data"),
+            State("query-executed", "data"),
+            State("statement-timeout", "value"),
+            State("session-id", "data"),
+            background=True,
+            running=QUERY_RUNNING,
+            progress=[Output("query-progress", "children"), Output("query-backend-pid", "data")],
+            prevent_initial_call=True
+        )
+        def fetch_query_page(set_progress, page_current, loaded_page, executed_query, timeout, session_id):
+            page_current = page_current or 0
+            if not executed_query or page_current == loaded_page:
+                return (no_update,) * 5
+
+            # Every page runs the query again up to its OFFSET, so it can be cancelled like the query itself
+            try:
+                with self.background_session(session_id, set_progress, "Fetching page", timeout) as db:
+                    rows, _, has_more, time_taken, error = db.fetch_page(executed_query, page_current)
+            except psycopg2.Error as e:
+                error = str(e)
+            if error:
+                return html.Span(f"Error fetching page: {error}", className="text-danger"), \
+                    no_update, no_update, no_update, no_update
+            first_row = page_current * DEFAULT_PAGE_SIZE
+            return (f"Time taken: {round(time_taken * 1000):,} ms",
+                    f"Rows shown: {first_row + 1:,} - {first_row + len(rows):,}",
+                    self.to_table_data(rows), None if has_more else page_current + 1, page_current)
+
+        @self.callback(
+            Output("query-total-rows", "children", allow_duplicate=True),
+            Output("query-table", "page_count", allow_duplicate=True),
+            Input("count-rows-button", "n_clicks"),
+            State("query-executed", "data"),
+            State("statement-timeout", "value"),
+            State("session-id", "data"),
+            background=True,
+            running=QUERY_RUNNING,
+            progress=[Output("query-progress", "children"), Output("query-backend-pid", "data")],
+            prevent_initial_call=True
+        )
+        def count_query_rows(set_progress, n_clicks, executed_query, timeout, session_id):
+            if not executed_query:
+                return "", no_update
+
+            try:
+                with self.background_session(session_id, set_progress, "Counting rows", timeout) as db:
+                    row_count, time_taken, error = db.count_rows(executed_query)
+            except psycopg2.Error as e:
+                error = str(e)
+            if error:
+                return html.Span(f"Error counting rows: {error}", className="text-danger"), no_update
+            page_count = max(1, -(-row_count // DEFAULT_PAGE_SIZE))
+            return f"Total rows: {row_count:,} (counted in {round(time_taken * 1000):,} ms)", page_count
 
-        @self.app.callback(
+        @self.callback(
             Output("qep-status", "children"),
             Output("qep-status", "color"),
             Output("qep-status", "is_open"),
             Output("qep-output", "markdownStr"),
             Output("qep-time-taken", "children"),
-            Output("show-qep-graph", "disabled"),
-            Output("execute-whatif-query-btn", "disabled"),
-            Output("explore-join-order-btn", "disabled"),
+            Output("qep-handoff", "data"),
+            Output("qep-analyze-request", "data"),
             Input("qep-button", "n_clicks"),
             State("query-input", "value"),
+            State("qep-analyze", "value"),
+            State("session-id", "data"),
+            prevent_initial_call=True
         )
-        def get_qep(n_clicks, query):
+        def get_qep(n_clicks, query, analyze, session_id):
             if n_clicks is None:
-                return "", "info", False, None, "", True, True, True
+                return "", "info", False, None, "", None, no_update
+            # EXPLAIN ANALYZE runs the query, so it goes to a background process that can be cancelled
+            if analyze:
+                return (no_update,) * 6 + (n_clicks,)
+
+            # A plain EXPLAIN is served from the plan cache or planned on the session's pool, in this thread
+            session = self.sessions.get(session_id)
+            try:
+                if session.db is None:
+                    raise psycopg2.Error("Not connected to a database")
+                qep, qep_cost, qep_rows, time_taken, error = session.db.get_qep(query)
+                if error:
+                    raise psycopg2.Error(error)
+                session.qep, session.qep_cost, session.qep_rows = qep, qep_cost, qep_rows
+                session.qep_tree = None
+                self.sessions.save(session)
+                return self.qep_response(session.db, query, qep, time_taken, f"local-{uuid.uuid4().hex}") + \
+                    (no_update,)
+            except psycopg2.Error as e:
+                return self.qep_error(e) + (no_update,)
 
+        @self.callback(
+            Output("qep-status", "children", allow_duplicate=True),
+            Output("qep-status", "color", allow_duplicate=True),
+            Output("qep-status", "is_open", allow_duplicate=True),
+            Output("qep-output", "markdownStr", allow_duplicate=True),
+            Output("qep-time-taken", "children", allow_duplicate=True),
+            Output("qep-handoff", "data", allow_duplicate=True),
+            Input("qep-analyze-request", "data"),
+            State("query-input", "value"),
+            State("statement-timeout", "value"),
+            State("session-id", "data"),
+            background=True,
+            running=[
+                (Output("qep-button", "disabled"), True, False),
+                (Output("cancel-qep-button", "disabled"), False, True),
+                (Output("qep-progress", "style"), {"display": "block"}, {"display": "none"}),
+            ],
+            progress=[Output("qep-progress", "children"), Output("qep-backend-pid", "data")],
+            prevent_initial_call=True
+        )
+        def get_analyzed_qep(set_progress, request, query, timeout, session_id):
             try:
-                # Get the query execution plan
-                self.qep, self.qep_cost, self.qep_rows, time_taken, error = self.db.get_qep(query)
+                with self.background_session(session_id, set_progress, "Running EXPLAIN ANALYZE", timeout) as db:
+                    qep, qep_cost, qep_rows, time_taken, error = db.get_qep(query, analyze=True)
 
                 if error:
                     raise psycopg2.Error(error)
 
-                return ([html.I(className="bi bi-check-circle-fill me-2"),
-                        "Query execution plan generated successfully!"], "success",
-                        True, f"```json\n{self.qep}\n```", f"Time taken: {round(time_taken * 1000):,} ms", False, False, False)
+                # This runs in a child process, so the plan goes back to the app through the shared cache
+                handoff = f"qep-{uuid.uuid4().hex}"
+                background_cache.set(handoff, (query, qep.data, qep_cost, qep_rows), expire=PLAN_HANDOFF_EXPIRY)
+                return self.qep_response(db, query, qep, time_taken, handoff)
             except psycopg2.Error as e:
-                return [html.I(className="bi bi-x-octagon-fill me-2"), "Error generating query execution plan:",
-                        fmc.FefferyMarkdown(markdownStr=f"```sh\n{str(e)}\n```", codeTheme="atom-dark",
-                                            className="mt-3")], "danger", True, "", "", True, True
+                return self.qep_error(e)
 
-        @self.app.callback(
+        @self.callback(
+            Output("show-qep-graph", "disabled"),
+            Output("execute-whatif-query-btn", "disabled"),
+            Output("explore-join-order-btn", "disabled"),
+            Output("sweep-whatif-btn", "disabled"),
+            Output("advise-indexes-btn", "disabled"),
+            Output("enumerate-join-orders-btn", "disabled"),
+            Output("sweep-knobs-btn", "disabled"),
+            Input("qep-handoff", "data"),
+            State("session-id", "data"),
+        )
+        def receive_qep(handoff, session_id):
+            session = self.sessions.get(session_id)
+            # Plans made in the request thread are already in the session
+            if handoff and handoff.startswith("local-") and session.qep is not None:
+                return False, False, False, False, False, False, False
+            handed_over = background_cache.pop(handoff) if handoff else None
+            session.qep_tree = None
+            if handed_over is None:
+                session.qep, session.qep_cost, session.qep_rows = None, None, None
+                self.sessions.save(session)
+                return True, True, True, True, True, True, True
+
+            _, plan, session.qep_cost, session.qep_rows = handed_over
+            session.qep = QueryPlan(plan)
+            self.sessions.save(session)
+            return False, False, False, False, False, False, False
+
+        @self.callback(
             Output("qep-graph", "children"),
             Output("qep-graph-status", "children"),
             Output("qep-graph-status", "color"),
@@ -585,19 +1029,20 @@ class Interface:
             Output("qep-cost", "children"),
             Output("qep-rows-estimate", "children"),
             Input("show-qep-graph", "n_clicks"),
+            Input("qep-color-by", "value"),
+            State("session-id", "data"),
         )
-        def show_qep_graph(n_clicks):
+        def show_qep_graph(n_clicks, color_by, session_id):
             if n_clicks is None:
                 return None, "", "info", False, "", ""
 
-            if self.qep:
-                qep_dict = json.loads(self.qep)
-                graph = Graph()
-                graph.parse_qep(qep_dict)
-                # graph.print_graph()
-                graph_plot = GraphPlot(graph.build_graph())
+            session = self.sessions.get(session_id)
+            if session.qep:
+                qep_tree = session.tree("qep_tree")
+                graph_plot = GraphPlot(qep_tree)
                 return (
-                    dcc.Graph(id="qep-interactive-graph", figure=graph_plot.plot_graph(), style={"height": "555px"}),
+                    dcc.Graph(id="qep-interactive-graph", figure=graph_plot.plot_graph(color_by=color_by),
+                              style={"height": "555px"}),
                     [
                         html.I(className="bi bi-check-circle-fill me-2"),
                         "QEP Graph generated successfully!"
@@ -606,28 +1051,31 @@ class Interface:
                     True,
                     html.Span([
                         "QEP Query Cost: ",
-                        html.Strong(f'{round(self.qep_cost):,}')
+                        html.Strong(f'{round(session.qep_cost):,}')
                     ]),
-                    f'Query Planner Output Rows Estimate: {self.qep_rows:,}'
+                    f'Query Planner Output Rows Estimate: {session.qep_rows:,}' + (
+                        f' | Actual: {qep_tree.actual_rows[0]:,.0f}' if qep_tree.analyzed else '')
                 )
             else:
                 return None, [html.I(className="bi bi-x-octagon-fill me-2"),
                               "No QEP available to generate graph"], "danger", True, "", ""
 
         # To show the join order options   
-        @self.app.callback(
+        @self.callback(
         Output('sortable-join-order-row', 'children'),
         Output('submit-join-order-btn', 'style'),
         Output("keep-original-query-btn", 'style'),
         Input('explore-join-order-btn', 'n_clicks'),
         State('query-input', 'value'),
+        State('session-id', 'data'),
         )
-        def display_join_orders(n_clicks, query):
+        def display_join_orders(n_clicks, query, session_id):
             if n_clicks is None or n_clicks == 0:
                 return None, {"display": "none"}, {"display": "none"}
 
+            session = self.sessions.get(session_id)
             # Get join order from backend
-            join_orders = get_modifiable_list(query)
+            join_orders = get_modifiable_list(query, session.catalog)
 
             order_elements = []
             count = 0
@@ -654,11 +1102,12 @@ class Interface:
                                         dbc.Input(
                                             type="text",
                                             id={'type': 'join-order-textinput', 'index': idx},
-                                            placeholder="Relation A, Relation B, Relation C",
+                                            placeholder="Relation A, (Relation B, Relation C)",
                                             className="form-control",
                                             value=join_order
                                         ),
-                                        html.Label("Modify the join order separated by commas")
+                                        html.Label("Modify the join order separated by commas, "
+                                                   "parenthesized relations are joined first")
                                     ], className="form-floating mb-3"),
                                 ]),
                             ], className="card border-primary mb-3"
@@ -673,43 +1122,50 @@ class Interface:
                     color="danger",  # Set the alert theme to "danger" for an error message
                     className="my-3"
                 )
-                self.modified_query = None
+                session.modified_query = None
+                self.sessions.save(session)
                 return error_message, {"display": "none"}, {"display": "none"}
                 
             return order_elements, {"display": "block"}, {"display": "block"}
 
-        @self.app.callback(
+        @self.callback(
             Output('new-join-query-markdown', 'markdownStr'),
             Output('new-join-query-title', 'children'),
             [Input('submit-join-order-btn', 'n_clicks'),
             Input('keep-original-query-btn', 'n_clicks')],
             State({'type': 'join-order-textinput', 'index': ALL}, 'value'),
             State("query-input", "value"),
+            State("session-id", "data"),
             prevent_initial_call=True
         )
-        def generate_new_sql_query(n_clicks_m, n_clicks_o, updated_orders, query):
+        def generate_new_sql_query(n_clicks_m, n_clicks_o, updated_orders, query, session_id):
             ctx = callback_context
             if not ctx:
                 return None, None
             
             triggered_id = ctx.triggered[0]["prop_id"].split(".")[0]
+            session = self.sessions.get(session_id)
 
             if triggered_id == 'keep-original-query-btn' and (n_clicks_o is not None or n_clicks_o != 0):
-                self.modified_query = query
+                session.modified_query = query
 
             elif triggered_id == 'submit-join-order-btn' and n_clicks_m is not None or n_clicks_m != 0:
-                updated_orders = [order.split(',') for order in updated_orders]
-                # Remove any empty strings
-                updated_orders = [[item.strip() for item in order if item.strip()] for order in updated_orders]
-                self.modified_query = modify_join_order(query, updated_orders)
+                try:
+                    updated_orders = [parse_join_order(order) for order in updated_orders]
+                    session.modified_query = modify_join_order(query, updated_orders, session.catalog)
+                except ValueError as e:
+                    session.modified_query = None
+                    self.sessions.save(session)
+                    return f"Invalid join order: {e}", "Modified SQL Query:"
             else:
                 return None, None
+            self.sessions.save(session)
 
-            # print(format_sql(self.modified_query))
+            # print(format_sql(session.modified_query))
 
-            return f"```sql\n{format_sql(self.modified_query)}\n```", "Modified SQL Query:"
+            return f"```sql\n{format_sql(session.modified_query)}\n```", "Modified SQL Query:"
 
-        @self.app.callback(
+        @self.callback(
             Output('final-query-markdown', 'markdownStr'),
             Output("whatif-query-status", "children"),
             Output("whatif-query-status", "color"),
@@ -720,51 +1176,55 @@ class Interface:
             Output("cost_difference", "children"),
             Output("final-query-title", "children"),
             Output("accordion-container", "children"),
+            Output("plan-diff", "children"),
             Input("execute-whatif-query-btn", "n_clicks"),
             State("join-type-dropdown", "value"),
             State("scan-type-dropdown", "value"),
             State("aggregate-type-dropdown", "value"),
-            State("query-input", "value")
+            State("query-input", "value"),
+            State("session-id", "data")
         )
-        def execute_whatif_query(n_clicks, join_type, scan_type, aggregate_type, query):
+        def execute_whatif_query(n_clicks, join_type, scan_type, aggregate_type, query, session_id):
             if n_clicks is None:
-                return None, "", "info", False, "", "", "", "", None, None
+                return None, "", "info", False, "", "", "", "", None, None, None
+            session = self.sessions.get(session_id)
             change_order = False
-            if self.modified_query is not None:
-                query = self.modified_query
+            if session.modified_query is not None:
+                query = session.modified_query
                 change_order = True
             try:
                 # Send the What-If parameters and query to the backend to get the new QEP
-                self.modified_qep, self.modified_qep_cost, modified_qep_rows, modified_execution_time, error, new_query = whatif_query(
-                    self.db, query, join_type, scan_type, aggregate_type, change_order)
+                modified_qep, modified_qep_cost, modified_qep_rows, modified_execution_time, error, new_query = whatif_query(
+                    session.db, query, join_type, scan_type, aggregate_type, change_order)
 
                 if error:
                     raise Exception(error)
+                session.modified_qep, session.modified_qep_cost, session.modified_qep_tree = \
+                    modified_qep, modified_qep_cost, None
+                self.sessions.save(session)
 
                 # Displaying Updated QEP in JSON format
-                qep_markdown = f"```json\n{self.modified_qep}\n```"
+                qep_markdown = f"```json\n{session.modified_qep.text}\n```"
 
                 # Creating QEP Graph from the retrieved graph data
-                if self.modified_qep:
-                    modified_qep_dict = json.loads(self.modified_qep)
-                    modified_graph = Graph()
-                    modified_graph.parse_qep(modified_qep_dict)
-                    modified_graph_plot = GraphPlot(modified_graph.build_graph())
+                if session.modified_qep:
+                    modified_graph_plot = GraphPlot(session.tree("modified_qep_tree"))
                     modified_qep_graph = dcc.Graph(id="updated-qep-graph", figure=modified_graph_plot.plot_graph(), style={"height": "555px"})
 
-                diff = self.qep_cost - self.modified_qep_cost
+                diff = session.qep_cost - session.modified_qep_cost
                 if diff == 0:
                     color = "info"
                     performance = 0
                 else:
-                    performance = 100 * diff / self.qep_cost
+                    performance = 100 * diff / session.qep_cost
                     color = "success" if performance >= 0 else "danger"
 
                 return f"```sql\n{format_sql(new_query)}\n```", [
                     html.I(className="bi bi-check-circle-fill me-2"), "What-If Query executed successfully!"
                 ], "success", True, qep_markdown, modified_qep_graph, html.Span([
-                    "AQP Query Cost: ", html.Strong(f'{round(self.modified_qep_cost):,}')
-                ]), html.Span(f'Performance: {performance:+.4f}%', className=f'text-{color}'), "Final Modified SQL Query:", accordion()
+                    "AQP Query Cost: ", html.Strong(f'{round(session.modified_qep_cost):,}')
+                ]), html.Span(f'Performance: {performance:+.4f}%', className=f'text-{color}'), "Final Modified SQL Query:", \
+                    accordion(), self.build_plan_diff(session)
 
             except Exception as e:
                 # Handle any errors that occurred
@@ -772,7 +1232,494 @@ class Interface:
                     html.I(className="bi bi-x-octagon-fill me-2"),
                     "Error executing What-If query:",
                     fmc.FefferyMarkdown(markdownStr=f"```sh\n{str(e)}\n```", codeTheme="atom-dark",
-                                        className="mt-3")], "danger", True, "", "", "", "", None, None
+                                        className="mt-3")], "danger", True, "", "", "", "", None, None, None
+
+        # Large plans are drawn with WebGL: labels follow the zoom level and node details are loaded on click
+        for graph_id, details_id, tree_attribute in [
+            ("qep-interactive-graph", "qep-node-details", "qep_tree"),
+            ("updated-qep-graph", "whatif-node-details", "modified_qep_tree"),
+        ]:
+            self.set_graph_callbacks(graph_id, details_id, tree_attribute)
+
+        # Cancelling a background callback cancels its statement on the server, which then ends the callback
+        for button_id, pid_id, status_id in [
+            ("cancel-query-button", "query-backend-pid", "query-cancel-status"),
+            ("cancel-qep-button", "qep-backend-pid", "qep-cancel-status"),
+        ]:
+            self.set_cancel_callback(button_id, pid_id, status_id)
+
+        @self.callback(
+            Output("whatif-sweep-output", "children"),
+            Output("whatif-sweep-time-taken", "children"),
+            Input("sweep-whatif-btn", "n_clicks"),
+            State({'type': 'join-order-textinput', 'index': ALL}, 'value'),
+            State("query-input", "value"),
+            State("session-id", "data"),
+            prevent_initial_call=True
+        )
+        def sweep_whatif_query(n_clicks, join_orders, query, session_id):
+            session = self.sessions.get(session_id)
+            # Include the join order typed by the user as an extra variant
+            try:
+                join_orders = [parse_join_order(order) for order in join_orders or []]
+            except ValueError:
+                # An unbalanced order is reported by the join order card, the sweep runs without it
+                join_orders = []
+            sweep_orders = [join_orders] if join_orders else None
+
+            start_time = time.time()
+            results = sweep_whatif(session.db, query, sweep_orders, catalog=session.catalog)
+            time_taken = time.time() - start_time
+
+            join_labels = {option['value']: option['label'] for option in join_type_options}
+            scan_labels = {option['value']: option['label'] for option in scan_type_options}
+            aggregate_labels = {option['value']: option['label'] for option in aggregate_type_options}
+            table_rows = []
+            for rank, result in enumerate(results, start=1):
+                if result['cost'] is None:
+                    cost, performance, color = "Error", "", ""
+                else:
+                    cost = f"{round(result['cost']):,}"
+                    performance = 0 if not session.qep_cost else 100 * (session.qep_cost - result['cost']) / session.qep_cost
+                    color = "text-success" if performance > 0 else "text-danger" if performance < 0 else ""
+                    performance = f"{performance:+.2f}%"
+                table_rows.append(html.Tr([
+                    html.Td(rank),
+                    # A join order that could not be rewritten has no planner options
+                    html.Td(join_labels.get(result['join'], "-")),
+                    html.Td(scan_labels.get(result['scan'], "-")),
+                    html.Td(aggregate_labels.get(result['aggregate'], "-")),
+                    html.Td(" | ".join(format_join_order(order) for order in result['join_order'])
+                            if result['join_order'] else "Default"),
+                    html.Td(cost, title=result['error'] or ""),
+                    html.Td(performance, className=color),
+                ]))
+
+            table = dbc.Table([
+                html.Thead(html.Tr([
+                    html.Th("Rank"),
+                    html.Th("Join Type"),
+                    html.Th("Scan Type"),
+                    html.Th("Aggregate Type"),
+                    html.Th("Join Order"),
+                    html.Th("AQP Cost"),
+                    html.Th("Performance"),
+                ])),
+                html.Tbody(table_rows)
+            ], bordered=True, hover=True, striped=True, size="sm", style={"fontSize": "14px"})
+            return table, f"Planned {len(results):,} combinations in {round(time_taken * 1000):,} ms"
+
+        @self.callback(
+            Output("knob-1-values", "placeholder"),
+            Output("knob-2-values", "placeholder"),
+            Output("knob-2-values", "disabled"),
+            Input("knob-1-dropdown", "value"),
+            Input("knob-2-dropdown", "value"),
+        )
+        def update_knob_placeholders(knob, second_knob):
+            # An empty value list sweeps the default grid of the knob
+            placeholders = [", ".join(str(value) for value in knob_grids[name]) if name in knob_grids else ""
+                            for name in (knob, second_knob)]
+            return placeholders[0], placeholders[1], second_knob not in knob_grids
+
+        @self.callback(
+            Output("knob-sweep-graph", "children"),
+            Output("knob-sweep-output", "children"),
+            Output("knob-sweep-time-taken", "children"),
+            Input("sweep-knobs-btn", "n_clicks"),
+            State("knob-1-dropdown", "value"),
+            State("knob-1-values", "value"),
+            State("knob-2-dropdown", "value"),
+            State("knob-2-values", "value"),
+            State("knob-analyze", "value"),
+            State("statement-timeout", "value"),
+            State("query-input", "value"),
+            State("session-id", "data"),
+            prevent_initial_call=True
+        )
+        def sweep_knob_grid(n_clicks, knob, values, second_knob, second_values, analyze, timeout, query, session_id):
+            if knob not in knob_grids:
+                return no_update, no_update, no_update
+            session = self.sessions.get(session_id)
+            if session is None or session.db is None:
+                return None, html.Span("Connect to a database to sweep resource knobs", className="text-danger"), ""
+            knobs = {knob: parse_knob_values(values or "") or knob_grids[knob]}
+            if second_knob in knob_grids and second_knob != knob:
+                knobs[second_knob] = parse_knob_values(second_values or "") or knob_grids[second_knob]
+
+            start_time = time.time()
+            results = sweep_knobs(session.db, query, knobs, analyze=analyze, timeout=timeout)
+            time_taken = time.time() - start_time
+
+            figure = KnobPlot(results, knobs).plot_sweep(show_time=analyze)
+            table_rows = []
+            for result in results:
+                table_rows.append(html.Tr([
+                    *[html.Td(str(result['settings'][name])) for name in knobs],
+                    html.Td(f"Plan {result['plan']}" if result['plan'] else "Error", title=result['nodes'] or "",
+                            className="text-danger fw-bold" if result['shape_changed'] else ""),
+                    html.Td(f"{result['cost']:,.2f}" if result['cost'] is not None else "-",
+                            title=result['error'] or ""),
+                    html.Td(f"{result['actual_time']:,.3f}" if result['actual_time'] is not None else "-"),
+                ]))
+            table = dbc.Table([
+                html.Thead(html.Tr([
+                    *[html.Th(name) for name in knobs],
+                    html.Th("Plan"),
+                    html.Th("Cost"),
+                    html.Th("Actual Time (ms)"),
+                ])),
+                html.Tbody(table_rows)
+            ], bordered=True, hover=True, striped=True, size="sm", style={"fontSize": "14px"})
+
+            changes = sum(result['shape_changed'] for result in results)
+            verb = "Ran" if analyze else "Planned"
+            return (dcc.Graph(figure=figure), table,
+                    f"{verb} {len(results):,} points in {round(time_taken * 1000):,} ms, "
+                    f"{len({result['plan'] for result in results if result['plan']})} plan shapes, "
+                    f"shape changes: {changes}")
+
+        @self.callback(
+            Output("join-order-search-output", "children"),
+            Output("join-order-search-time-taken", "children"),
+            Input("enumerate-join-orders-btn", "n_clicks"),
+            State("query-input", "value"),
+            State("session-id", "data"),
+            prevent_initial_call=True
+        )
+        def search_join_orders(n_clicks, query, session_id):
+            session = self.sessions.get(session_id)
+            if session.db is None:
+                return html.Span("Not connected to a database", className="text-danger"), ""
+            start_time = time.time()
+            results = enumerate_join_orders(session.db, query, session.catalog)
+            time_taken = time.time() - start_time
+            if not results:
+                return dbc.Alert("Join order search not available for this query", color="danger",
+                                 className="my-3"), ""
+
+            cards = []
+            for result in results:
+                table_rows = []
+                for rank, order in enumerate(result['orders'], start=1):
+                    performance = 0 if not session.qep_cost else 100 * (session.qep_cost - order['cost']) / session.qep_cost
+                    color = "text-success" if performance > 0 else "text-danger" if performance < 0 else ""
+                    table_rows.append(html.Tr([
+                        html.Td(rank),
+                        html.Td(" → ".join(item if len(item) <= 40 else "(subquery)" for item in order['order']),
+                                title=order['query']),
+                        html.Td(f"{round(order['cost']):,}"),
+                        html.Td(f"{performance:+.2f}%", className=color),
+                    ]))
+                errors = [html.P(f"Failed: {error}", className="text-danger") for error in result['errors']]
+                cards.append(dbc.Card([
+                    dbc.CardHeader([
+                        f"{len(result['items'])} relations, {result['strategy']} search: ",
+                        f"{result['explained']:,} orders explained, {result['pruned']:,} pruned ",
+                        f"in {round(result['time'] * 1000):,} ms",
+                    ]),
+                    dbc.CardBody([
+                        dbc.Table([
+                            html.Thead(html.Tr([
+                                html.Th("Rank"),
+                                html.Th("Join Order"),
+                                html.Th("AQP Cost"),
+                                html.Th("Performance"),
+                            ])),
+                            html.Tbody(table_rows)
+                        ], bordered=True, hover=True, striped=True, size="sm", style={"fontSize": "14px"}),
+                        *errors
+                    ]),
+                ], className="border-primary mb-3"))
+            return cards, f"Searched {len(results):,} FROM lists in {round(time_taken * 1000):,} ms"
+
+        @self.callback(
+            Output("index-advice-output", "children"),
+            Output("index-advice-time-taken", "children"),
+            Input("advise-indexes-btn", "n_clicks"),
+            State("query-input", "value"),
+            State("session-id", "data"),
+            prevent_initial_call=True
+        )
+        def advise_query_indexes(n_clicks, query, session_id):
+            session = self.sessions.get(session_id)
+            start_time = time.time()
+            catalog = session.catalog or session.db.load_catalog()[0]
+            results, error = advise_indexes(session.db, query, catalog)
+            time_taken = time.time() - start_time
+            if error:
+                return html.Span(f"Error planning the query: {error}", className="text-danger"), ""
+            if not results:
+                return html.Span("No candidate indexes: every filtered or joined column is already indexed."), ""
+
+            table_rows = []
+            for rank, result in enumerate(results, start=1):
+                if result['cost'] is None:
+                    cost, reduction, size, color = "Error", "", "", ""
+                else:
+                    cost = f"{round(result['cost']):,}"
+                    performance = 0 if not session.qep_cost else 100 * result['cost_reduction'] / session.qep_cost
+                    color = "text-success" if performance > 0 else "text-danger" if performance < 0 else ""
+                    reduction = f"{round(result['cost_reduction']):,} ({performance:+.2f}%)"
+                    size = f"{result['size'] / 2 ** 20:,.1f} MB"
+                table_rows.append(html.Tr([
+                    html.Td(rank),
+                    html.Td(html.Code(result['definition'])),
+                    html.Td(cost, title=result['error'] or ""),
+                    html.Td(reduction, className=color),
+                    html.Td(size),
+                    html.Td("Yes" if result['used'] else "No"),
+                ]))
+
+            table = dbc.Table([
+                html.Thead(html.Tr([
+                    html.Th("Rank"),
+                    html.Th("Index"),
+                    html.Th("AQP Cost"),
+                    html.Th("Cost Reduction"),
+                    html.Th("Size"),
+                    html.Th("Used"),
+                ])),
+                html.Tbody(table_rows)
+            ], bordered=True, hover=True, striped=True, size="sm", style={"fontSize": "14px"})
+            return table, f"Evaluated {len(results):,} candidate indexes in {round(time_taken * 1000):,} ms"
+
+    def set_cancel_callback(self, button_id, pid_id, status_id):
+        """
+        Register the callback of a Cancel button that cancels the statement of a background callback
+        on the server backend it reported
+        """
+        @self.callback(
+            Output(status_id, "children"),
+            Input(button_id, "n_clicks"),
+            State(pid_id, "data"),
+            State("session-id", "data"),
+            prevent_initial_call=True
+        )
+        def cancel_statement(n_clicks, pid, session_id):
+            db = self.sessions.get(session_id).db
+            if not pid or db is None:
+                return ""
+            cancelled, error = db.cancel_backend(pid)
+            if error:
+                return html.Span(f"Error cancelling: {error}", className="text-danger")
+            return f"Cancel sent to backend {pid}" if cancelled else f"Backend {pid} was no longer running"
+
+    def set_graph_callbacks(self, graph_id, details_id, tree_attribute):
+        """
+        Register the zoom and click callbacks of a plan graph whose tree is kept in the given session attribute
+        """
+        @self.callback(
+            Output(graph_id, "figure", allow_duplicate=True),
+            Input(graph_id, "relayoutData"),
+            State("session-id", "data"),
+            prevent_initial_call=True
+        )
+        def relabel_graph(relayout_data, session_id):
+            tree = self.sessions.get(session_id).tree(tree_attribute)
+            if tree is None or not relayout_data:
+                return no_update
+            graph_plot = GraphPlot(tree)
+            if not graph_plot.use_webgl():
+                return no_update
+
+            x_range = [relayout_data.get("xaxis.range[0]"), relayout_data.get("xaxis.range[1]")]
+            y_range = [relayout_data.get("yaxis.range[0]"), relayout_data.get("yaxis.range[1]")]
+            if None in x_range and None in y_range and not relayout_data.get("xaxis.autorange"):
+                return no_update
+            figure = Patch()
+            figure["data"][1]["text"] = graph_plot.node_labels(
+                graph_plot.hierarchy_pos(tree),
+                None if None in x_range else x_range,
+                None if None in y_range else y_range)
+            return figure
+
+        @self.callback(
+            Output(details_id, "children"),
+            Input(graph_id, "clickData"),
+            State("session-id", "data"),
+            prevent_initial_call=True
+        )
+        def show_node_details(click_data, session_id):
+            tree = self.sessions.get(session_id).tree(tree_attribute)
+            if tree is None or not click_data:
+                return None
+            point = click_data["points"][0]
+            # Only the node trace carries node details
+            if point.get("curveNumber") != 1 or point.get("pointIndex", point.get("pointNumber")) >= len(tree):
+                return None
+            node = point.get("pointIndex", point.get("pointNumber"))
+            return dbc.Card([
+                dbc.CardHeader([html.B(tree.node_type[node]), f" (ID: {node})"]),
+                dbc.CardBody(dbc.Table(
+                    html.Tbody([html.Tr([html.Td(key), html.Td(str(value))])
+                                for key, value in tree.attrs[node].items()]),
+                    bordered=True, size="sm", style={"fontSize": "13px"}, className="mb-0"
+                ), style={"maxHeight": "300px", "overflowY": "auto"}),
+            ], className="border-primary")
+
+    @contextmanager
+    def background_session(self, session_id, set_progress, label, timeout=None):
+        """
+        Open a connection of its own for a background callback of a session and report its backend PID and
+        elapsed time through set_progress until the block ends.
+        :param timeout: statement timeout in seconds, None or 0 for no limit
+        """
+        session = self.sessions.get(session_id)
+        if session.db is None:
+            raise psycopg2.Error("Not connected to a database")
+        set_progress(("Connecting...", None))
+        db = session.db.detached(statement_timeout=timeout * 1000 if timeout else None)
+        pid = db.backend_pid()
+        start_time = time.time()
+        finished = threading.Event()
+
+        def report():
+            while True:
+                set_progress((f"{label} on backend {pid}: {round(time.time() - start_time):,} s", pid))
+                if finished.wait(PROGRESS_INTERVAL):
+                    break
+
+        reporter = threading.Thread(target=report, daemon=True)
+        reporter.start()
+        try:
+            yield db
+        finally:
+            finished.set()
+            reporter.join()
+            db.close()
+
+    @staticmethod
+    def qep_response(db, query, qep, time_taken, handoff):
+        """
+        Build the status, plan text and timings shown for a new QEP, warning if the plan flipped since the query
+        was last planned
+        """
+        cache_stats = db.plan_cache.stats()
+        time_text = (f"Time taken: {round(time_taken * 1000, 3):,} ms "
+                     f"(plan cache: {cache_stats['hits']:,} hits, {cache_stats['misses']:,} misses)")
+        if qep.analyzed:
+            time_text += f" | Execution time: {qep.execution_time:,.3f} ms"
+
+        change = (db.plan_history.latest_change(db.plan_cache.namespace, query)
+                  if db.plan_history is not None else None)
+        if change is not None:
+            return ([html.I(className="bi bi-exclamation-triangle-fill me-2"),
+                    f"Query execution plan generated, {change.describe()} since it was last planned."],
+                    "warning", True, f"```json\n{qep.text}\n```", time_text, handoff)
+        return ([html.I(className="bi bi-check-circle-fill me-2"),
+                "Query execution plan generated successfully!"], "success",
+                True, f"```json\n{qep.text}\n```", time_text, handoff)
+
+    @staticmethod
+    def qep_error(e):
+        return [html.I(className="bi bi-x-octagon-fill me-2"), "Error generating query execution plan:",
+                fmc.FefferyMarkdown(markdownStr=f"```sh\n{str(e)}\n```", codeTheme="atom-dark",
+                                    className="mt-3")], "danger", True, "", "", None
+
+    def analyze_and_reload(self, session, db):
+        """
+        Run ANALYZE and reload the session's catalog so the row estimates are fresh
+        """
+        _, _, error, _ = db.analyze()
+        if error:
+            raise psycopg2.Error(error)
+        catalog, _, error = db.load_catalog()
+        # The session may have connected elsewhere in the meantime
+        if not error and db is session.db:
+            session.catalog = catalog
+            self.sessions.save(session)
+
+    def build_plan_diff(self, session, max_changes=20):
+        """
+        Build the merged QEP / AQP diff view of a session with the changes of largest self cost first
+        """
+        if session.qep is None or session.modified_qep is None:
+            return None
+        diff = PlanDiff(session.tree("qep_tree"), session.tree("modified_qep_tree"))
+        summary = diff.summary()
+        changes = diff.changes()
+
+        table_rows = []
+        for change in changes[:max_changes]:
+            if change['before_type'] and change['after_type'] and change['before_type'] != change['after_type']:
+                operator = f"{change['before_type']} → {change['after_type']}"
+            else:
+                operator = change['after_type'] or change['before_type']
+            delta = change['self_cost_delta']
+            table_rows.append(html.Tr([
+                html.Td(html.Span(change['status'], style={"color": STATUS_COLORS[change['status']]})),
+                html.Td(operator),
+                html.Td(change['relation']),
+                html.Td(format_delta(change['cost_before'] if change['before_node'] >= 0 else None,
+                                     change['cost_after'] if change['after_node'] >= 0 else None)),
+                html.Td(f"{delta:+,.2f}", className="text-success" if delta < 0 else "text-danger" if delta > 0 else ""),
+                html.Td(format_delta(change['rows_before'] if change['before_node'] >= 0 else None,
+                                     change['rows_after'] if change['after_node'] >= 0 else None, ',.0f')),
+            ]))
+
+        return html.Div([
+            html.P([
+                f"Edit distance: {diff.edit_distance():,} | ",
+                " | ".join(f"{status.capitalize()}: {count:,}" for status, count in summary.items())
+            ], className="my-3"),
+            dcc.Graph(id="plan-diff-graph", figure=DiffPlot(diff).plot_diff(), style={"height": "600px"}),
+            dbc.Table([
+                html.Thead(html.Tr([
+                    html.Th("Status"),
+                    html.Th("Operator"),
+                    html.Th("Relation"),
+                    html.Th("Cost"),
+                    html.Th("Self Cost Change"),
+                    html.Th("Rows"),
+                ])),
+                html.Tbody(table_rows)
+            ], bordered=True, hover=True, striped=True, size="sm", style={"fontSize": "14px"})
+            if table_rows else html.P("Both plans have the same shape and costs.")
+        ])
+
+    @staticmethod
+    def build_table_schemas(catalog, exact_counts=None):
+        """
+        Build the database tables summary from the catalog
+        """
+        table_rows = []
+        for entry in catalog:
+            if exact_counts and (entry['schema'], entry['table']) in exact_counts:
+                rows = f"{exact_counts[(entry['schema'], entry['table'])]:,}"
+            elif entry['rows'] is not None:
+                rows = f"~{entry['rows']:,}"
+            else:
+                rows = "unknown"
+            table_rows.append(html.Tr([
+                html.Td(entry['table']),
+                html.Td(', '.join(entry['columns'])),
+                html.Td(rows),
+                html.Td(f"{entry['size'] / 1024 ** 2:,.1f} MB"),
+                html.Td(', '.join(entry['indexes']))
+            ]))
+
+        table_header = [
+            html.Thead(html.Tr([
+                html.Th("Table"),
+                html.Th("Attributes"),
+                html.Th("Rows"),
+                html.Th("Size"),
+                html.Th("Indexes")
+            ]))
+        ]
+        return table_header + [html.Tbody(table_rows)]
+
+    @staticmethod
+    def to_table_data(rows):
+        """
+        Convert result rows to DataTable records keyed by column position
+        """
+        return [{str(i): value for i, value in enumerate(row)} for row in rows]
 
-    def run(self):
-        self.app.run(debug=True)
+    def run(self, debug=False):
+        """
+        Serve the app with the Flask development server, see wsgi.py for serving it in production
+        :param debug: turn on the reloader and the debugging tools
+        """
+        self.app.run(debug=debug)
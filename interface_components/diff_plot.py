@@ -0,0 +1,64 @@
+import plotly.graph_objects as go
+from interface_components.graph_plot import GraphPlot
+from plan_diff import STATUSES
+
+# Marker colour of each diff status
+STATUS_COLORS = {
+    'added': '#2e7d32',
+    'removed': '#c62828',
+    'changed': '#ef6c00',
+    'moved': '#6a1b9a',
+    'cost changed': '#f9a825',
+    'kept': '#bdbdbd',
+}
+
+
+def format_delta(before, after, spec=',.2f'):
+    """
+    Format a before -> after change with its absolute and relative difference
+    """
+    if before is None:
+        return f"{after:{spec}} (new)"
+    if after is None:
+        return f"{before:{spec}} (gone)"
+    delta = after - before
+    relative = f", {100 * delta / before:+.1f}%" if before else ""
+    return f"{before:{spec}} → {after:{spec}} ({delta:+{spec}}{relative})"
+
+
+class DiffPlot:
+    def __init__(self, diff):
+        self.diff = diff
+        self.tree = diff.merged_tree()
+
+    def plot_diff(self, render_mode='auto'):
+        """
+        Plot the merged plan of a PlanDiff, coloured by diff status with cost and row deltas on hover.
+        The layout and renderer are those of GraphPlot.plot_graph.
+        """
+        graph_plot = GraphPlot(self.tree)
+        figure = graph_plot.plot_graph(render_mode)
+        statuses = [attrs['Diff Status'] for attrs in self.tree.attrs]
+        hover = []
+        for node, attrs in enumerate(self.tree.attrs):
+            relation = f" on {attrs['Relation']}" if attrs['Relation'] else ""
+            hover.append(f"{self.tree.node_type[node]}{relation}<br>Status: {attrs['Diff Status']}"
+                         f"<br>Cost: {format_delta(attrs['Cost Before'], attrs['Cost After'])}"
+                         f"<br>Self Cost Change: {attrs['Self Cost Delta']:+,.2f}"
+                         f"<br>Rows: {format_delta(attrs['Rows Before'], attrs['Rows After'], ',.0f')}")
+
+        # Node details stay on hover even for WebGL, they are what the diff view is for
+        figure.update_traces(
+            selector=1,
+            marker=dict(color=[STATUS_COLORS[status] for status in statuses], colorscale=None, showscale=False,
+                        colorbar=None),
+            hoverinfo='text',
+            hovertext=hover
+        )
+        # One empty trace per status that occurs, only to label the colours in the legend
+        for status in STATUSES:
+            if status in statuses:
+                figure.add_trace(go.Scatter(x=[None], y=[None], mode='markers', name=status,
+                                            marker=dict(size=12, color=STATUS_COLORS[status])))
+        figure.update_layout(showlegend=True, legend=dict(orientation='h', y=-0.05))
+        return figure
@@ -1,59 +1,138 @@
-import networkx as nx
 import plotly.graph_objects as go
+from db.shared_cache import get_shared_cache
+from metrics import timed, HIERARCHY_POS, PLOT_GRAPH
+from collections import OrderedDict
+import threading
+import math
+
+# Plans with more nodes than this are drawn with WebGL and without inline hover details
+WEBGL_THRESHOLD = 300
+# Most node labels drawn at once by the WebGL renderer
+MAX_LABELS = 60
+
+# Layouts of recently drawn plans, keyed by plan fingerprint and layout parameters
+LAYOUT_CACHE_SIZE = 128
+# Layouts of smaller plans are quicker to compute again than to load from the cache shared between processes
+SHARED_LAYOUT_MIN_NODES = 1000
+SHARED_LAYOUT_TTL = 3600
+_layout_cache = OrderedDict()
+_layout_lock = threading.Lock()
 
 
 class GraphPlot:
-    def __init__(self, graph):
-        self.G = graph
+    def __init__(self, tree):
+        self.tree = tree
 
-    def hierarchy_pos(self, G, root=None, width=1., vert_gap=0.2, vert_loc=0, xcenter=0.5):
+    @timed(HIERARCHY_POS)
+    def hierarchy_pos(self, tree, root=0, width=1., vert_gap=0.2, vert_loc=0, xcenter=0.5):
         """
-        Position nodes in a hierarchical layout.
-        :param G: The graph to be laid out
-        :param root:  The root node of current branch
-        :param width:  Horizontal space allocated for this branch - avoids overlap with other branches
+        Position nodes in a hierarchical (tidy tree) layout in linear time.
+        Leaves are spread evenly in left-to-right order and every parent is centred above its
+        first and last child, so each subtree gets horizontal space in proportion to its leaf count.
+        :param tree: The plan tree to be laid out
+        :param root:  The root node of the subtree to lay out
+        :param width:  Horizontal space allocated for the tree
         :param vert_gap:  Gap between levels of hierarchy
         :param vert_loc:  Vertical location of root
-        :param xcenter:  Horizontal location of root
-        :return:
+        :param xcenter:  Horizontal location of the centre of the tree
+        :return: dict mapping each node to its (x, y) position
         """
-        if not nx.is_tree(G):
-            raise TypeError('Cannot use hierarchy_pos on a graph that is not a tree')
-
-        if root is None:
-            root = next(iter(nx.topological_sort(G)))  # Find a root node
-
-        def _hierarchy_pos(G, node, left, right, vert_loc, xcenter, pos):
-            children = list(G.successors(node))
-            if not children:
-                pos[node] = (xcenter, vert_loc)
-            else:
-                dx = (right - left) / len(children)
-                nextx = left + dx / 2
-                for child in children:
-                    pos = _hierarchy_pos(G, child, nextx - dx / 2, nextx + dx / 2, vert_loc - vert_gap, nextx, pos)
-                    nextx += dx
-                pos[node] = (xcenter, vert_loc)
+        key = (tree.fingerprint(), root, width, vert_gap, vert_loc, xcenter)
+        with _layout_lock:
+            if key in _layout_cache:
+                _layout_cache.move_to_end(key)
+                return _layout_cache[key]
+        shared = get_shared_cache() if len(tree) >= SHARED_LAYOUT_MIN_NODES else None
+        pos = shared.get(('layout',) + key) if shared is not None else None
+        if pos is not None:
+            self.cache_layout(key, pos)
             return pos
 
-        return _hierarchy_pos(G, root, 0, width, vert_loc, xcenter, {})
+        # Pre-order numbering puts every subtree in a contiguous range after its root
+        end = tree.subtree_end(root)
+        x = [0.] * (end - root)
+        leaves = 0
+        for node in range(root, end):
+            if tree.is_leaf(node):
+                x[node - root] = leaves
+                leaves += 1
+        # Children come after their parent in pre-order, so walking backwards places them first
+        for node in range(end - 1, root - 1, -1):
+            if not tree.is_leaf(node):
+                children = tree.children_of(node)
+                x[node - root] = (x[children[0] - root] + x[children[-1] - root]) / 2
+
+        left = xcenter - width / 2
+        pos = {}
+        for node in range(root, end):
+            pos[node] = (left + (x[node - root] + 0.5) / leaves * width,
+                         vert_loc - (tree.depth[node] - tree.depth[root]) * vert_gap)
+
+        self.cache_layout(key, pos)
+        if shared is not None:
+            shared.set(('layout',) + key, pos, expire=SHARED_LAYOUT_TTL)
+        return pos
+
+    @staticmethod
+    def cache_layout(key, pos):
+        with _layout_lock:
+            _layout_cache[key] = pos
+            while len(_layout_cache) > LAYOUT_CACHE_SIZE:
+                _layout_cache.popitem(last=False)
+
+    def use_webgl(self, render_mode='auto'):
+        """
+        Check whether the plan should be drawn with WebGL
+        """
+        return render_mode == 'webgl' or (render_mode == 'auto' and len(self.tree) > WEBGL_THRESHOLD)
+
+    def node_labels(self, pos, x_range=None, y_range=None, max_labels=MAX_LABELS):
+        """
+        Get the node labels for the visible area, keeping at most max_labels of them.
+        When too many nodes are visible, the ones closest to the root are labelled.
+        """
+        visible = [node for node, (x, y) in pos.items()
+                   if (x_range is None or min(x_range) <= x <= max(x_range))
+                   and (y_range is None or min(y_range) <= y <= max(y_range))]
+        if len(visible) > max_labels:
+            visible = sorted(visible, key=lambda node: (self.tree.depth[node], node))[:max_labels]
+        labelled = set(visible)
+        return [self.tree.node_type[node] if node in labelled else "" for node in range(len(self.tree))]
+
+    def node_colors(self, color_by='cost'):
+        """
+        Get the colour value of each node and the colour bar title.
+        :param color_by: 'cost' (estimated total cost), 'time' (actual exclusive time) or
+                         'misestimate' (log10 of the factor by which the row estimate is off)
+        """
+        if color_by == 'time' and self.tree.analyzed:
+            return list(self.tree.exclusive_time()), 'Exclusive<br>Time (ms)'
+        if color_by == 'misestimate' and self.tree.analyzed:
+            return [math.log10(factor) for factor in self.tree.misestimate()], 'Row<br>Misestimate<br>(log10)'
+        return list(self.tree.cost), 'Cost'
 
-    def plot_graph(self):
+    @timed(PLOT_GRAPH)
+    def plot_graph(self, render_mode='auto', color_by='cost'):
         """
-        Plot the graph using Plotly
+        Plot the graph using Plotly.
+        :param render_mode: 'svg', 'webgl' or 'auto' (WebGL above WEBGL_THRESHOLD nodes). The WebGL figure only
+                            labels some of the nodes and leaves node details to be fetched when a node is clicked.
+        :param color_by: what the node colour shows, see node_colors
         """
-        pos = self.hierarchy_pos(self.G)  # Ensure self.G is passed correctly
+        webgl = self.use_webgl(render_mode)
+        scatter = go.Scattergl if webgl else go.Scatter
+        pos = self.hierarchy_pos(self.tree)
         edge_x = []
         edge_y = []
 
         # Create edges
-        for edge in self.G.edges():
+        for edge in self.tree.edges():
             x0, y0 = pos[edge[0]]
             x1, y1 = pos[edge[1]]
             edge_x.extend([x0, x1, None])
             edge_y.extend([y0, y1, None])
 
-        edge_trace = go.Scatter(
+        edge_trace = scatter(
             x=edge_x, y=edge_y,
             line=dict(width=1, color='#888'),
             hoverinfo='none',
@@ -64,18 +143,29 @@ class GraphPlot:
         node_x = []
         node_y = []
         node_text = []
-        node_color = []
+        node_color, color_title = self.node_colors(color_by)
+        if self.tree.analyzed and not webgl:
+            exclusive_time = self.tree.exclusive_time()
+            row_ratio = self.tree.row_ratio()
 
-        for node in self.G.nodes():
+        for node in range(len(self.tree)):
             x, y = pos[node]
             node_x.append(x)
             node_y.append(y)
-            data = self.G.nodes[node]
-            text = f"{data['label']}<br>ID: {node}<br>Cost: {data['cost']}<br>Rows: {data['rows']}"
-            node_text.append(text)
-            node_color.append(data['cost'])  # Use cost for color
+            if not webgl:
+                text = (f"{self.tree.node_type[node]}<br>ID: {node}<br>Cost: {self.tree.cost[node]}"
+                        f"<br>Rows: {self.tree.rows[node]:g}")
+                if self.tree.analyzed:
+                    if self.tree.actual_loops[node]:
+                        text += (f"<br>Actual Rows: {self.tree.actual_rows[node]:g}"
+                                 f"<br>Actual Time: {self.tree.actual_time[node]:,.3f} ms"
+                                 f"<br>Exclusive Time: {exclusive_time[node]:,.3f} ms"
+                                 f"<br>Estimated / Actual Rows: {row_ratio[node]:.3g}")
+                    else:
+                        text += "<br>Never executed"
+                node_text.append(text)
 
-        node_trace = go.Scatter(
+        node_trace = scatter(
             x=node_x, y=node_y,
             mode='markers+text',
             textposition="bottom center",
@@ -88,17 +178,17 @@ class GraphPlot:
                 color=node_color,
                 colorscale='Reds',
                 colorbar=dict(
-                    title='Cost',
+                    title=color_title,
                     len=1,
                     thickness=15,
                     bordercolor='white',
                 ),
                 line=dict(width=2, color='black')
             ),
-            text=[self.G.nodes[node]['label'] for node in self.G.nodes()],
-            hoverinfo='text',
-            hovertext=node_text,
-            ids=[node for node in self.G.nodes()]
+            text=self.node_labels(pos) if webgl else self.tree.node_type,
+            hoverinfo='none' if webgl else 'text',
+            hovertext=None if webgl else node_text,
+            ids=None if webgl else list(range(len(self.tree)))
         )
 
         return go.Figure(
@@ -122,6 +212,8 @@ class GraphPlot:
                 ),
                 # paper_bgcolor='rgba(0,0,0,0)',
                 plot_bgcolor='rgba(0,0,0,0)',
+                # Keep the zoom level when labels are updated for a new viewport
+                uirevision=self.tree.fingerprint(),
                 showlegend=False,
                 hovermode='closest',
                 margin=dict(b=20, l=5, r=5, t=40),
@@ -0,0 +1,76 @@
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+from plotly.colors import qualitative
+
+# Marker of each plan shape, cycled when a sweep finds more shapes than there are symbols
+PLAN_SYMBOLS = ['circle', 'square', 'diamond', 'triangle-up', 'cross', 'x', 'pentagon', 'star-triangle-up']
+
+
+class KnobPlot:
+    def __init__(self, results, knobs):
+        self.results = results
+        self.knobs = list(knobs)
+
+    def plot_sweep(self, show_time=False):
+        """
+        Plot the estimated cost of a knob sweep against the first knob, one line per value of the second knob.
+        Every point is labelled with its plan shape and the points where the shape changes are ringed in red.
+        :param show_time: also plot the actual execution time of measured sweeps on a second axis
+        """
+        figure = make_subplots(specs=[[{"secondary_y": show_time}]])
+        x_knob = self.knobs[0]
+        series_knob = self.knobs[1] if len(self.knobs) > 1 else None
+        series = {}
+        for result in self.results:
+            key = result['settings'][series_knob] if series_knob else None
+            series.setdefault(key, []).append(result)
+
+        for index, (value, results) in enumerate(series.items()):
+            color = qualitative.Plotly[index % len(qualitative.Plotly)]
+            name = f"{series_knob} = {value}" if series_knob else "Cost"
+            x = [str(result['settings'][x_knob]) for result in results]
+            hover = [f"{x_knob} = {result['settings'][x_knob]}" + (f"<br>{name}" if series_knob else "") +
+                     (f"<br>Plan {result['plan']}: {result['nodes']}<br>Cost: {result['cost']:,.2f}"
+                      if result['error'] is None else f"<br>Error: {result['error']}")
+                     for result in results]
+            figure.add_trace(go.Scatter(
+                x=x,
+                y=[result['cost'] for result in results],
+                mode='lines+markers+text',
+                name=name,
+                text=[f"P{result['plan']}" if result['plan'] else "" for result in results],
+                textposition='top center',
+                marker=dict(size=10, color=color,
+                            symbol=[PLAN_SYMBOLS[(result['plan'] or 1) - 1] if result['plan'] else 'circle-open'
+                                    for result in results],
+                            line=dict(width=[3 if result['shape_changed'] else 0 for result in results],
+                                      color='#c62828')),
+                line=dict(color=color),
+                hoverinfo='text',
+                hovertext=hover,
+            ))
+            if show_time:
+                figure.add_trace(go.Scatter(
+                    x=x,
+                    y=[result['actual_time'] for result in results],
+                    mode='lines+markers',
+                    name=f"Time ({value})" if series_knob else "Actual time",
+                    marker=dict(size=6, color=color),
+                    line=dict(color=color, dash='dash'),
+                ), secondary_y=True)
+
+        # Empty trace, only to explain the red rings in the legend
+        if any(result['shape_changed'] for result in self.results):
+            figure.add_trace(go.Scatter(x=[None], y=[None], mode='markers', name="Plan shape changed",
+                                        marker=dict(size=10, color='white', line=dict(width=3, color='#c62828'))))
+
+        figure.update_xaxes(title_text=x_knob, type='category')
+        figure.update_yaxes(title_text="Estimated cost", secondary_y=False)
+        if show_time:
+            figure.update_yaxes(title_text="Actual time (ms)", secondary_y=True)
+        figure.update_layout(
+            hovermode='closest',
+            legend=dict(orientation='h', y=-0.2),
+            margin=dict(b=20, l=5, r=5, t=20),
+        )
+        return figure
@@ -0,0 +1,254 @@
+from db.db import Database
+from join_rewrite import JoinRewriter, get_rewriter
+from preprocessing import PlanTree
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+import math
+import random
+import time
+
+# FROM lists up to this many relations are searched exhaustively, larger ones with a genetic search
+EXHAUSTIVE_LIMIT = 10
+POPULATION_SIZE = 24
+GENERATIONS = 12
+MUTATION_RATE = 0.3
+# Planner setting that makes the planner keep the order of explicit JOINs
+FORCED_ORDER_SETTINGS = {'join_collapse_limit': 1}
+
+
+class JoinOrderEnumerator:
+    """
+    Search the join orders of one FROM list by EXPLAINing the query with the list rewritten to explicit
+    left-deep joins (see join_rewrite.JoinRewriter) under join_collapse_limit = 1, which makes the planner join
+    in exactly that order. Relations are joined along the predicates that reference them.
+    Every EXPLAIN of a complete order also gives the cost of each of its prefixes (the cost of the join node
+    over those relations), which bounds the cost of every order starting with that prefix.
+    """
+    def __init__(self, db: Database, rewriter: JoinRewriter, block_index: int, executor: ThreadPoolExecutor,
+                 top_k: int = 5, seed: int = 0):
+        self.db = db
+        self.rewriter = rewriter
+        self.block_index = block_index
+        self.items = rewriter.blocks[block_index].sources
+        self.executor = executor
+        self.top_k = top_k
+        self.rng = random.Random(seed)
+        size = len(self.items)
+        indexes = {source.alias: index for index, source in enumerate(self.items)}
+        self.neighbours = [set() for _ in range(size)]
+        for predicate in rewriter.blocks[block_index].predicates:
+            for first, second in combinations(sorted(indexes[alias] for alias in predicate.aliases or ()), 2):
+                self.neighbours[first].add(second)
+                self.neighbours[second].add(first)
+        if not self.connected():
+            # Without a connected join graph every pair may be joined, cross products included
+            self.neighbours = [set(range(size)) - {item} for item in range(size)]
+        self.alias_items = {}
+        for index, source in enumerate(self.items):
+            for alias in {source.alias} | source.inner_aliases:
+                self.alias_items[alias] = index
+        # Costs of complete orders and of the prefixes seen inside their plans
+        self.costs = {}
+        self.prefix_costs = {}
+        self.errors = {}
+        self.pruned = 0
+
+    def connected(self):
+        seen = {0}
+        stack = [0]
+        while stack:
+            for neighbour in self.neighbours[stack.pop()] - seen:
+                seen.add(neighbour)
+                stack.append(neighbour)
+        return len(seen) == len(self.items)
+
+    def rewrite(self, order):
+        """
+        Get the query with the FROM list joined in the given order, the other FROM lists as written
+        """
+        orders = [None] * len(self.rewriter.blocks)
+        orders[self.block_index] = [self.items[item].alias for item in order]
+        return self.rewriter.rewrite(orders)
+
+    def complete(self, prefix):
+        """
+        Extend a prefix to a complete order, adding joined relations before unjoined ones in FROM list order
+        """
+        order = list(prefix)
+        remaining = [item for item in range(len(self.items)) if item not in prefix]
+        while remaining:
+            joined = set(order)
+            item = next((item for item in remaining if self.neighbours[item] & joined), remaining[0])
+            order.append(item)
+            remaining.remove(item)
+        return tuple(order)
+
+    def random_order(self):
+        """
+        Get a random order that only adds relations joined to the ones before them (when possible)
+        """
+        remaining = list(range(len(self.items)))
+        order = [remaining.pop(self.rng.randrange(len(remaining)))]
+        while remaining:
+            joined = [item for item in remaining if self.neighbours[item] & set(order)] or remaining
+            item = self.rng.choice(joined)
+            order.append(item)
+            remaining.remove(item)
+        return tuple(order)
+
+    def explain(self, orders):
+        """
+        EXPLAIN every order that has not been explained yet, concurrently, bypassing the plan cache and history
+        """
+        orders = list(dict.fromkeys(order for order in orders if order not in self.costs))
+        futures = [(order, self.executor.submit(self.db.get_qep, self.rewrite(order), FORCED_ORDER_SETTINGS,
+                                                record=False, cache=False))
+                   for order in orders]
+        for order, future in futures:
+            qep, cost, _, _, error = future.result()
+            if error:
+                self.costs[order] = math.inf
+                self.errors[order] = error
+                continue
+            self.costs[order] = cost
+            self.record_prefixes(order, PlanTree.from_plan(qep.plan))
+
+    def record_prefixes(self, order, tree):
+        """
+        Record the cost of every prefix of an order from the plan nodes that join exactly its relations
+        """
+        item_sets = [frozenset()] * len(tree)
+        for node in range(len(tree) - 1, -1, -1):
+            alias = str(tree.attrs[node].get('Alias', '')).lower()
+            if alias in self.alias_items:
+                item_sets[node] = frozenset([self.alias_items[alias]])
+            else:
+                item_sets[node] = frozenset().union(*(item_sets[child] for child in tree.children_of(node)))
+        # The lowest node over a set of relations is its join, nodes above it (Hash, Sort) only add cost
+        set_costs = {}
+        for node in range(len(tree)):
+            if item_sets[node]:
+                set_costs[item_sets[node]] = min(set_costs.get(item_sets[node], math.inf), tree.cost[node])
+        for length in range(1, len(order)):
+            prefix = order[:length]
+            if frozenset(prefix) in set_costs:
+                self.prefix_costs[prefix] = set_costs[frozenset(prefix)]
+        self.prefix_costs[order] = self.costs[order]
+
+    def bound(self):
+        """
+        Cost of the k-th cheapest complete order so far: no order with a more expensive prefix can beat it
+        """
+        costs = sorted(self.costs.values())
+        return costs[self.top_k - 1] if len(costs) >= self.top_k else math.inf
+
+    def search_exhaustive(self):
+        """
+        Dynamic programming over connected subsets of the FROM list, building left-deep orders one relation at
+        a time. Every subset keeps its top_k cheapest orders, and prefixes costing more than the bound are pruned.
+        """
+        size = len(self.items)
+        # The order as written gives a first bound
+        self.explain([tuple(range(size))])
+        level = {frozenset([item]): [(item,)] for item in range(size)}
+        for _ in range(size - 1):
+            candidates = {}
+            for prefixes in level.values():
+                for prefix in prefixes:
+                    for item in sorted(self.neighbours_of(prefix)):
+                        candidates.setdefault(frozenset(prefix + (item,)), []).append(prefix + (item,))
+            # A completion of each new prefix prices the prefix and refines the bound
+            self.explain(self.complete(prefix) for prefixes in candidates.values() for prefix in prefixes
+                         if prefix not in self.prefix_costs)
+            bound = self.bound()
+            level = {}
+            for item_set, prefixes in candidates.items():
+                kept = [prefix for prefix in prefixes if self.prefix_costs.get(prefix, 0) < bound]
+                self.pruned += len(prefixes) - len(kept)
+                kept.sort(key=lambda prefix: self.prefix_costs.get(prefix, 0))
+                if kept:
+                    level[item_set] = kept[:self.top_k]
+
+    def neighbours_of(self, prefix):
+        joined = set(prefix)
+        return set().union(*(self.neighbours[item] for item in prefix)) - joined
+
+    def search_genetic(self, population_size=POPULATION_SIZE, generations=GENERATIONS):
+        """
+        Genetic search for FROM lists too large to enumerate: the cheapest half of every generation survives
+        and breeds with order crossover and swap mutations
+        """
+        size = len(self.items)
+        population = [tuple(range(size))] + [self.complete((item,)) for item in range(size)]
+        population += [self.random_order() for _ in range(population_size - len(population))]
+        population = population[:population_size]
+        for _ in range(generations):
+            self.explain(population)
+            ranked = sorted(dict.fromkeys(population), key=lambda order: self.costs[order])
+            parents = ranked[:max(population_size // 2, 2)]
+            children = []
+            while len(parents) + len(children) < population_size:
+                first, second = self.rng.sample(parents, 2)
+                child = self.crossover(first, second)
+                if self.rng.random() < MUTATION_RATE:
+                    i, j = self.rng.sample(range(size), 2)
+                    child = list(child)
+                    child[i], child[j] = child[j], child[i]
+                children.append(tuple(child))
+            self.pruned += len(ranked) - len(parents)
+            population = parents + children
+        self.explain(population)
+
+    def crossover(self, first, second):
+        """
+        Order crossover: a slice of the first parent, the other relations in the order of the second
+        """
+        start, end = sorted(self.rng.sample(range(len(first) + 1), 2))
+        middle = first[start:end]
+        rest = [item for item in second if item not in middle]
+        return tuple(rest[:start]) + middle + tuple(rest[start:])
+
+    def search(self):
+        """
+        Search the join orders and return the top_k cheapest with the search statistics
+        """
+        start_time = time.time()
+        if len(self.items) <= EXHAUSTIVE_LIMIT:
+            strategy = 'exhaustive'
+            self.search_exhaustive()
+        else:
+            strategy = 'genetic'
+            self.search_genetic()
+        ranked = sorted((order for order in self.costs if self.costs[order] < math.inf),
+                        key=lambda order: self.costs[order])
+        return {
+            'items': [source.label for source in self.items],
+            'strategy': strategy,
+            'orders': [{
+                'order': [self.items[item].label for item in order],
+                'cost': self.costs[order],
+                'query': self.rewrite(order)
+            } for order in ranked[:self.top_k]],
+            'explained': len(self.costs),
+            'pruned': self.pruned,
+            'errors': list(self.errors.values())[:3],
+            'time': time.time() - start_time
+        }
+
+
+# Function to enumerate the join orders of every FROM list of a query and return the top_k of each
+def enumerate_join_orders(db: Database, query: str, catalog: list[dict] = None, top_k: int = 5,
+                          max_workers: int = None, seed: int = 0):
+    # every EXPLAIN borrows its own pooled connection, so a shared connection can only run one at a time
+    if db.pool is None:
+        max_workers = 1
+    max_workers = max_workers or db.pool_max
+
+    # The parse tree and the rewrite template are shared with the what-if views, see join_rewrite.get_rewriter
+    rewriter = get_rewriter(query, catalog)
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for block_index in range(len(rewriter.blocks)):
+            enumerator = JoinOrderEnumerator(db, rewriter, block_index, executor, top_k, seed)
+            results.append(enumerator.search())
+    return results
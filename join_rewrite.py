@@ -0,0 +1,354 @@
+from dataclasses import dataclass, field
+from functools import lru_cache
+import re
+import sqlglot
+from sqlglot import exp
+
+DIALECT = 'postgres'
+# Number of parsed queries (and rewriters built from them) kept per process
+PARSE_CACHE_SIZE = 256
+
+# Explicit joins that may be reordered, outer / natural / USING joins keep their place
+_REORDERABLE_JOIN_KINDS = {'', 'INNER', 'CROSS'}
+_AS_REGEX = re.compile(r"\s+as\s+", re.IGNORECASE)
+
+
+@dataclass
+class JoinSource:
+    alias: str
+    # How the source is shown and typed in a join order, e.g. "nation n1"
+    label: str
+    # The source as it goes into a join, e.g. "nation AS n1"
+    sql: str
+    # Base table name, None for subqueries and functions
+    table: str = None
+    # Output columns of a subquery, used to resolve unqualified columns
+    columns: frozenset = frozenset()
+    # Aliases of the relations inside a subquery, which show up in its plan nodes when it is pulled up
+    inner_aliases: frozenset = frozenset()
+
+
+@dataclass
+class JoinPredicate:
+    sql: str
+    # Aliases of the block the predicate references, None if it has to stay in the WHERE clause
+    aliases: frozenset = None
+
+
+@dataclass
+class JoinBlock:
+    """
+    A query block whose FROM list and inner joins can be reordered. In the rewriter's template its FROM
+    list and WHERE clause are replaced by the markers, which every rewrite fills in.
+    """
+    sources: list
+    predicates: list
+    from_marker: str
+    where_marker: str
+    # FROM list and WHERE condition as written, for blocks that keep their order
+    original_from: str = ''
+    original_where: str = None
+    labels: dict = field(default_factory=dict)
+
+    def resolve(self, name: str):
+        """
+        Get the alias of a source from its alias or label (case and AS insensitive)
+        """
+        key = " ".join(_AS_REGEX.sub(" ", f" {name} ").split()).lower()
+        if key not in self.labels:
+            raise ValueError(f"Unknown relation '{name.strip()}', expected one of: "
+                             f"{', '.join(source.label for source in self.sources)}")
+        return self.labels[key]
+
+
+# Function to parse a query once per process, the parse tree is shared so callers must copy it before changing it
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_query(query: str):
+    return sqlglot.parse_one(query, read=DIALECT)
+
+
+# Function to split a condition into its AND-ed conjuncts
+def conjuncts(condition: exp.Expression):
+    if isinstance(condition, exp.Paren) and isinstance(condition.this, exp.And):
+        return conjuncts(condition.this)
+    if isinstance(condition, exp.And):
+        return conjuncts(condition.this) + conjuncts(condition.expression)
+    return [condition]
+
+
+# Function to get a lower-case identifier the way Postgres folds unquoted names
+def identifier_name(identifier):
+    if identifier is None:
+        return ''
+    if isinstance(identifier, exp.Identifier) and identifier.quoted:
+        return identifier.name
+    return identifier.name.lower()
+
+
+# Function to collect the sources and join conditions of a FROM item, flattening parenthesized inner joins
+def flatten_source(source: exp.Expression, sources: list, conditions: list):
+    # (a JOIN b ON ...) without an alias is a join group, its members can be reordered as well
+    if isinstance(source, exp.Subquery) and not isinstance(source.this, exp.Query) and not source.alias:
+        inner = source.this.copy()
+        joins = inner.args.get('joins') or []
+        inner.set('joins', None)
+        return flatten_source(inner, sources, conditions) and flatten_joins(joins, sources, conditions)
+    if isinstance(source, exp.Lateral) or isinstance(source, exp.Subquery) and not isinstance(source.this, exp.Query):
+        return False
+    # Functions in FROM are implicitly lateral, they can only move if they do not reference other relations
+    if isinstance(source, exp.Table) and not isinstance(source.this, exp.Identifier) and source.find(exp.Column):
+        return False
+    if not isinstance(source, (exp.Table, exp.Subquery)):
+        return False
+    sources.append(source)
+    return True
+
+
+# Function to collect the sources and ON conditions of explicit joins, all of which must be inner joins
+def flatten_joins(joins: list, sources: list, conditions: list):
+    for join in joins:
+        if (join.side or join.method or join.args.get('using') or
+                join.kind not in _REORDERABLE_JOIN_KINDS):
+            return False
+        if not flatten_source(join.this, sources, conditions):
+            return False
+        if join.args.get('on'):
+            conditions.extend(conjuncts(join.args['on']))
+    return True
+
+
+# Function to render the FROM list of a block as written
+def from_sql(select: exp.Select):
+    text = select.args['from_'].this.sql(dialect=DIALECT)
+    for join in select.args.get('joins') or []:
+        join_text = join.sql(dialect=DIALECT)
+        text += join_text if join_text.startswith(',') else f" {join_text}"
+    return text
+
+
+class JoinRewriter:
+    """
+    Rewrite the join order of a query on its parse tree.
+    Every query block with at least two relations joined by commas or inner joins can be given an order:
+    a list of relations joined left-deep, where a nested list is joined first and goes in parentheses,
+    e.g. ['a', ['b', 'c'], 'd'] is ((a JOIN (b JOIN c)) JOIN d). Each predicate between relations is
+    moved into the ON clause of the lowest join that has all of its relations, the rest stays in WHERE.
+    The query is parsed and split into a template once, so every rewrite only joins strings.
+    """
+    def __init__(self, query: str, catalog_columns: dict = None):
+        self.query = query
+        # Columns of every catalog table, for unqualified columns
+        self.catalog_columns = catalog_columns or {}
+        self.blocks = []
+        self.template = None
+        try:
+            tree = parse_query(query).copy()
+        except sqlglot.errors.ParseError:
+            return
+
+        # Outer blocks come before their inner blocks
+        selects = [select for select in tree.find_all(exp.Select) if select.args.get('from_')]
+        # Relations inside every subquery, taken before the inner blocks are cut out
+        inner_aliases = {id(subquery): frozenset(identifier_name(table.args['alias'].this) if table.args.get('alias')
+                                                 else identifier_name(table.this)
+                                                 for table in subquery.find_all(exp.Table))
+                         for subquery in tree.find_all(exp.Subquery)}
+        # Inner blocks are cut out first so the sources and predicates of the outer blocks hold their markers
+        self.blocks = [None] * len(selects)
+        for index in range(len(selects) - 1, -1, -1):
+            select = selects[index]
+            sources, conditions = [], []
+            if not (flatten_source(select.args['from_'].this, sources, conditions) and
+                    flatten_joins(select.args.get('joins') or [], sources, conditions)) or len(sources) < 2:
+                continue
+            block = self.build_block(index, select, sources, conditions, inner_aliases)
+            if block is None:
+                continue
+            self.blocks[index] = block
+            select.set('joins', None)
+            select.from_(block.from_marker, dialect=DIALECT, copy=False)
+            select.set('where', exp.Where(this=exp.column(block.where_marker)))
+        # Blocks that cannot be reordered keep their text and leave no gap in the numbering
+        self.blocks = [block for block in self.blocks if block is not None]
+        self.template = tree.sql(dialect=DIALECT)
+
+    def build_block(self, index: int, select: exp.Select, sources: list, conditions: list, inner_aliases: dict):
+        block = JoinBlock([], [], f"__join_from_{index}__", f"__join_where_{index}__",
+                          original_from=from_sql(select))
+        where = select.args.get('where')
+        if where is not None:
+            block.original_where = where.this.sql(dialect=DIALECT)
+            conditions = conditions + conjuncts(where.this)
+
+        for source in sources:
+            alias = identifier_name(source.args['alias'].this) if source.args.get('alias') else None
+            unaliased = source.copy()
+            unaliased.set('alias', None)
+            if isinstance(source, exp.Table) and isinstance(source.this, exp.Identifier):
+                table = identifier_name(source.this)
+                alias = alias or table
+                name = unaliased.sql(dialect=DIALECT)
+                label = name if alias == table else f"{name} {alias}"
+                block.sources.append(JoinSource(alias, label, source.sql(dialect=DIALECT), table))
+            else:
+                # A subquery has an alias in Postgres, a function may be known by its own text
+                alias = alias or unaliased.sql(dialect=DIALECT).lower()
+                columns = frozenset(name.lower() for name in source.this.named_selects) \
+                    if isinstance(source.this, exp.Query) else frozenset()
+                block.sources.append(JoinSource(alias, alias, source.sql(dialect=DIALECT), columns=columns,
+                                                inner_aliases=inner_aliases.get(id(source), frozenset())))
+
+        aliases = [source.alias for source in block.sources]
+        if len(set(aliases)) != len(aliases):
+            return None
+        for source in block.sources:
+            block.labels[source.alias] = source.alias
+            block.labels[" ".join(source.label.lower().split())] = source.alias
+        block.predicates = [JoinPredicate(condition.sql(dialect=DIALECT), self.predicate_aliases(block, condition))
+                            for condition in conditions]
+        return block
+
+    def predicate_aliases(self, block: JoinBlock, condition: exp.Expression):
+        """
+        Get the aliases a predicate references, None if any column cannot be placed with certainty
+        """
+        # Subqueries may reference relations of any block, they stay where they are evaluated last
+        if condition.find(exp.Query):
+            return None
+        aliases = set()
+        names = {source.alias for source in block.sources}
+        for column in condition.find_all(exp.Column):
+            if column.args.get('table'):
+                qualifier = identifier_name(column.args['table'])
+                # A reference to an outer block is a correlation, it must not move into a join
+                if qualifier not in names:
+                    return None
+                aliases.add(qualifier)
+                continue
+            name = identifier_name(column.this)
+            owners = [source.alias for source in block.sources
+                      if name in (self.catalog_columns.get(source.table, ()) if source.table else source.columns)]
+            if len(owners) != 1:
+                return None
+            aliases.add(owners[0])
+        return frozenset(aliases)
+
+    def labels(self):
+        """
+        Get the relations of every reorderable block in their written order
+        """
+        return [[source.label for source in block.sources] for block in self.blocks]
+
+    def join_tree(self, block: JoinBlock, node, placed: set):
+        """
+        Build the join text of an order, returning it with the aliases it covers
+        """
+        if isinstance(node, str):
+            alias = block.resolve(node)
+            return next(source.sql for source in block.sources if source.alias == alias), {alias}
+        items = [item for item in node if not isinstance(item, str) or item.strip()]
+        if not items:
+            raise ValueError("Empty group in the join order")
+        if len(items) == 1:
+            return self.join_tree(block, items[0], placed)
+
+        text, aliases = self.join_tree(block, items[0], placed)
+        for item in items[1:]:
+            right_text, right_aliases = self.join_tree(block, item, placed)
+            if aliases & right_aliases:
+                raise ValueError("A relation appears more than once in the join order")
+            if not isinstance(item, str) and len(item) > 1:
+                right_text = f"({right_text})"
+            covered = aliases | right_aliases
+            on = []
+            for index, predicate in enumerate(block.predicates):
+                if (index not in placed and predicate.aliases and predicate.aliases <= covered and
+                        predicate.aliases & aliases and predicate.aliases & right_aliases):
+                    on.append(predicate.sql)
+                    placed.add(index)
+            text = f"{text} JOIN {right_text} ON {' AND '.join(on)}" if on else f"{text} CROSS JOIN {right_text}"
+            aliases = covered
+        return text, aliases
+
+    def block_sql(self, block: JoinBlock, order):
+        """
+        Get the FROM list and WHERE condition of a block joined in the given order
+        """
+        if not order:
+            return block.original_from, block.original_where
+        placed = set()
+        text, aliases = self.join_tree(block, order, placed)
+        missing = [source.label for source in block.sources if source.alias not in aliases]
+        if missing:
+            raise ValueError(f"The join order is missing: {', '.join(missing)}")
+        remaining = [predicate.sql for index, predicate in enumerate(block.predicates) if index not in placed]
+        return text, " AND ".join(remaining) or None
+
+    def rewrite(self, orders: list):
+        """
+        Get the query with every block joined in its order, an empty order keeps a block as it is
+        """
+        orders = list(orders or [])
+        if any(orders[len(self.blocks):]):
+            raise ValueError(f"The query has {len(self.blocks)} reorderable FROM lists, got {len(orders)} join orders")
+        if self.template is None:
+            return self.query
+        query = self.template
+        # Outer blocks come first, filling them in brings the markers of their inner blocks
+        for index, block in enumerate(self.blocks):
+            text, where = self.block_sql(block, orders[index] if index < len(orders) else None)
+            query = query.replace(f"FROM {block.from_marker}", f"FROM {text}", 1)
+            query = query.replace(f" WHERE {block.where_marker}", f" WHERE {where}" if where else "", 1)
+        return query
+
+    def rewrite_many(self, batch: list):
+        """
+        Rewrite the query for every list of orders of a batch
+        """
+        return [self.rewrite(orders) for orders in batch]
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _cached_rewriter(query: str, catalog_columns: tuple):
+    return JoinRewriter(query, {table: columns for table, columns in catalog_columns})
+
+
+# Function to get the rewriter of a query, built once per query and catalog
+def get_rewriter(query: str, catalog: list[dict] = None):
+    catalog_columns = tuple(sorted((entry['table'].lower(), frozenset(column.lower() for column in entry['columns']))
+                                   for entry in catalog or []))
+    return _cached_rewriter(query, catalog_columns)
+
+
+# Function to parse a typed join order such as "a, (b, c), d" into nested lists
+def parse_join_order(text: str):
+    stack = [[]]
+    for token in re.findall(r"[(),]|[^(),]+", text or ''):
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) == 1:
+                raise ValueError("Unbalanced parentheses in the join order")
+            group = stack.pop()
+            stack[-1].append(group)
+        elif token != ',' and token.strip():
+            stack[-1].append(token.strip())
+    if len(stack) != 1:
+        raise ValueError("Unbalanced parentheses in the join order")
+    return stack[0]
+
+
+# Function to format a join order the way parse_join_order reads it
+def format_join_order(order):
+    return ", ".join(item if isinstance(item, str) else f"({format_join_order(item)})" for item in order or [])
+
+
+if __name__ == '__main__':
+    catalog = [{'table': 'supplier', 'columns': ['s_suppkey', 's_nationkey']},
+               {'table': 'lineitem', 'columns': ['l_suppkey', 'l_orderkey']},
+               {'table': 'nation', 'columns': ['n_nationkey', 'n_name']}]
+    query = ("SELECT * FROM supplier, lineitem, nation n1, nation n2 WHERE s_suppkey = l_suppkey "
+             "AND s_nationkey = n1.n_nationkey AND n1.n_nationkey = n2.n_nationkey AND n2.n_name = 'EGYPT'")
+    rewriter = get_rewriter(query, catalog)
+    print(rewriter.labels())
+    print(rewriter.rewrite([parse_join_order("nation n1, (supplier, lineitem), n2")]))
@@ -0,0 +1,294 @@
+from db.shared_cache import get_shared_cache
+from bisect import bisect_left
+from functools import wraps
+from contextlib import contextmanager
+from flask import request
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+# Stages of a request, from the database to the response
+DB_ROUND_TRIP = 'db_round_trip'
+JSON_DECODE = 'json_decode'
+PARSE_QEP = 'parse_qep'
+BUILD_GRAPH = 'build_graph'
+HIERARCHY_POS = 'hierarchy_pos'
+PLOT_GRAPH = 'plot_graph'
+FORMAT_SQL = 'format_sql'
+CALLBACK = 'callback'
+RESPONSE_SERIALIZATION = 'response_serialization'
+STAGES = [DB_ROUND_TRIP, JSON_DECODE, PARSE_QEP, BUILD_GRAPH, HIERARCHY_POS, PLOT_GRAPH, FORMAT_SQL, CALLBACK,
+          RESPONSE_SERIALIZATION]
+
+# Upper bounds of the histogram buckets, in seconds and in bytes
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+ALLOCATION_BUCKETS = [4 ** power for power in range(5, 16)]
+# Seconds between two writes of this process's metrics to the shared cache
+FLUSH_INTERVAL = 1
+METRICS_KEY = ('metrics',)
+METRICS_TTL = 7 * 24 * 3600
+# Key of the histograms of the processes that have exited, summed into one entry so the shared blob does not
+# grow with every worker ever started
+RETIRED_KEY = 'retired'
+# Set to trace allocations from the start (e.g. QEP_TRACEMALLOC=1), tracing slows every allocation down
+TRACEMALLOC_ENV = 'QEP_TRACEMALLOC'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, snapshot):
+        for index, count in enumerate(snapshot['counts']):
+            self.counts[index] += count
+        self.sum += snapshot['sum']
+        self.count += snapshot['count']
+
+    def snapshot(self):
+        return {'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by linear interpolation inside its bucket, like Prometheus' histogram_quantile
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+    Latency and allocation histograms of every stage, for this process.
+    With a shared cache (see db.shared_cache) every process writes its histograms there at most once per
+    FLUSH_INTERVAL, and a report covers all of them.
+    """
+    def __init__(self):
+        self.latency = {}
+        self.allocation = {}
+        self.last_flush = 0.
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, allocated=None):
+        with self._lock:
+            if stage not in self.latency:
+                self.latency[stage] = Histogram(LATENCY_BUCKETS)
+                self.allocation[stage] = Histogram(ALLOCATION_BUCKETS)
+            self.latency[stage].observe(seconds)
+            if allocated is not None:
+                self.allocation[stage].observe(max(allocated, 0))
+            flush = time.time() - self.last_flush > FLUSH_INTERVAL
+        if flush:
+            self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: {'latency': self.latency[stage].snapshot(), 'allocation': self.allocation[stage].snapshot()}
+                    for stage in self.latency}
+
+    def flush(self):
+        """
+        Write this process's histograms to the shared cache, keyed by process ID
+        """
+        shared = get_shared_cache()
+        self.last_flush = time.time()
+        if shared is None:
+            return
+        snapshot = self.snapshot()
+        with shared.transact():
+            processes = shared.get(METRICS_KEY, {})
+            processes[os.getpid()] = snapshot
+            retire_exited(processes)
+            shared.set(METRICS_KEY, processes, expire=METRICS_TTL)
+
+    def collect(self):
+        """
+        Get the histograms of every stage, summed over all processes sharing the cache
+        """
+        shared = get_shared_cache()
+        if shared is None:
+            processes = {os.getpid(): self.snapshot()}
+        else:
+            self.flush()
+            processes = shared.get(METRICS_KEY, {})
+        latency, allocation = {}, {}
+        for snapshot in processes.values():
+            for stage, histograms in snapshot.items():
+                latency.setdefault(stage, Histogram(LATENCY_BUCKETS)).merge(histograms['latency'])
+                allocation.setdefault(stage, Histogram(ALLOCATION_BUCKETS)).merge(histograms['allocation'])
+        # Known stages first, in pipeline order
+        order = STAGES + sorted(set(latency) - set(STAGES))
+        return [(stage, latency[stage], allocation[stage]) for stage in order if stage in latency], \
+            sum(key != RETIRED_KEY for key in processes)
+
+
+# Function to check whether a process is still running
+def process_alive(pid):
+    # Signal 0 only checks that the process exists, but os.kill terminates the process on Windows
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Function to sum the histograms of the processes that have exited into the retired entry, in place
+def retire_exited(processes):
+    retired = processes.get(RETIRED_KEY, {})
+    for pid in [key for key in processes if key != RETIRED_KEY and not process_alive(key)]:
+        for stage, histograms in processes.pop(pid).items():
+            totals = retired.setdefault(stage, {})
+            for kind, buckets in (('latency', LATENCY_BUCKETS), ('allocation', ALLOCATION_BUCKETS)):
+                histogram = Histogram(buckets)
+                if kind in totals:
+                    histogram.merge(totals[kind])
+                histogram.merge(histograms[kind])
+                totals[kind] = histogram.snapshot()
+    if retired:
+        processes[RETIRED_KEY] = retired
+
+
+metrics = Metrics()
+# End of the callback handled by the current request thread, where response serialization starts
+_request_state = threading.local()
+
+
+# Function to get the bytes currently traced by tracemalloc, None if it is not tracing
+def traced_memory():
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+
+
+# Function to start tracing allocations if the environment asks for it
+def start_tracemalloc(force: bool = False):
+    if (force or os.environ.get(TRACEMALLOC_ENV)) and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+@contextmanager
+def span(stage: str):
+    """
+    Time a block as a stage and, while tracemalloc is tracing, record the bytes it allocated and kept.
+    Spans nest, an outer stage includes the time of the stages inside it. tracemalloc counts the allocations
+    of every thread, so the bytes of concurrent spans overlap.
+    """
+    memory = traced_memory()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        end_memory = traced_memory()
+        metrics.record(stage, elapsed, end_memory - memory if memory is not None and end_memory is not None else None)
+
+
+# Decorator to run a function in a span
+def timed(stage: str):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Decorator for a Dash callback body, which marks where Dash starts serializing its response
+def instrument_callback(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            with span(CALLBACK):
+                return fn(*args, **kwargs)
+        finally:
+            _request_state.callback_end = (time.perf_counter(), traced_memory())
+    return wrapper
+
+
+# Function to format the histograms in the Prometheus text exposition format
+def prometheus_text():
+    stages, _ = metrics.collect()
+    lines = []
+    for name, index, help_text in [
+        ('qep_stage_duration_seconds', 0, "Time spent in each stage of a request"),
+        ('qep_stage_allocated_bytes', 1, "Bytes allocated and kept by each stage (with tracemalloc on)"),
+    ]:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for stage, *histograms in stages:
+            histogram = histograms[index]
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+    return "\n".join(lines) + "\n"
+
+
+# Function to summarize the histograms as JSON, with quantile estimates in milliseconds
+def metrics_json():
+    stages, processes = metrics.collect()
+    summary = {}
+    for stage, latency, allocation in stages:
+        summary[stage] = {
+            'count': latency.count,
+            'total_ms': latency.sum * 1000,
+            'mean_ms': latency.sum * 1000 / latency.count if latency.count else None,
+            'p50_ms': latency.quantile(0.5) * 1000 if latency.count else None,
+            'p95_ms': latency.quantile(0.95) * 1000 if latency.count else None,
+            'p99_ms': latency.quantile(0.99) * 1000 if latency.count else None,
+            'latency_buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], latency.counts)),
+            'allocated_samples': allocation.count,
+            'mean_allocated_bytes': allocation.sum / allocation.count if allocation.count else None,
+            'allocation_buckets': dict(zip([str(bound) for bound in ALLOCATION_BUCKETS] + ['+Inf'],
+                                           allocation.counts)),
+        }
+    return {'processes': processes, 'tracemalloc': tracemalloc.is_tracing(), 'stages': summary}
+
+
+# Function to add the metrics endpoints and the response serialization span to a Flask server
+def register_metrics(server, update_path='/_dash-update-component'):
+    @server.before_request
+    def reset_callback_end():
+        _request_state.callback_end = None
+
+    @server.after_request
+    def record_serialization(response):
+        callback_end = getattr(_request_state, 'callback_end', None)
+        if callback_end is not None and response.status_code == 200:
+            if request.path.endswith(update_path):
+                memory = traced_memory()
+                metrics.record(RESPONSE_SERIALIZATION, time.perf_counter() - callback_end[0],
+                               memory - callback_end[1] if memory is not None and callback_end[1] is not None
+                               else None)
+        _request_state.callback_end = None
+        return response
+
+    @server.route('/metrics')
+    def prometheus_metrics():
+        return server.response_class(prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+    @server.route('/metrics.json')
+    def json_metrics():
+        return server.response_class(json.dumps(metrics_json(), indent=2), mimetype='application/json')
@@ -0,0 +1,247 @@
+from array import array
+from preprocessing import PlanTree
+
+# Statuses of a node in the diff, from the strongest change to none
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+MOVED = 'moved'
+COST_CHANGED = 'cost changed'
+KEPT = 'kept'
+STATUSES = [ADDED, REMOVED, CHANGED, MOVED, COST_CHANGED, KEPT]
+
+# Relative cost difference below which a node counts as having kept its cost
+COST_TOLERANCE = 0.01
+
+
+def leaf_key(tree, node):
+    """
+    Get what a leaf reads, used to pair leaves of two plans: the aliased relation, CTE or function
+    """
+    attrs = tree.attrs[node]
+    for name in ('Relation Name', 'CTE Name', 'Function Name', 'Subplan Name'):
+        if name in attrs:
+            return attrs[name], attrs.get('Alias', attrs[name])
+    return tree.node_type[node], None
+
+
+def relation_sets(tree):
+    """
+    Get the set of leaf keys below every node, which identifies the part of the query a node computes
+    """
+    sets = [frozenset()] * len(tree)
+    # Children come after their parent in pre-order, so walking backwards builds every set from its children
+    for node in range(len(tree) - 1, -1, -1):
+        if tree.is_leaf(node):
+            sets[node] = frozenset([leaf_key(tree, node)])
+        else:
+            sets[node] = frozenset().union(*(sets[child] for child in tree.children_of(node)))
+    return sets
+
+
+class PlanDiff:
+    """
+    Structural diff of two plans of the same query.
+    Nodes are aligned by the relations they compute and their operator: nodes computing the same set of
+    relations are paired, same operators first, then in plan order. Every node of either plan gets a status:
+    added / removed (no counterpart), changed (different operator), moved (under a different matched
+    ancestor), cost changed, or kept.
+    """
+    def __init__(self, before: PlanTree, after: PlanTree):
+        self.before = before
+        self.after = after
+        self.match_before = array('l', [-1] * len(before))
+        self.match_after = array('l', [-1] * len(after))
+        self.status_before = [REMOVED] * len(before)
+        self.status_after = [ADDED] * len(after)
+        self.self_cost_before = before.self_cost()
+        self.self_cost_after = after.self_cost()
+        self._align()
+        self._classify()
+
+    def _align(self):
+        groups = {}
+        for node, relations in enumerate(relation_sets(self.before)):
+            groups.setdefault(relations, ([], []))[0].append(node)
+        for node, relations in enumerate(relation_sets(self.after)):
+            groups.setdefault(relations, ([], []))[1].append(node)
+
+        for before_nodes, after_nodes in groups.values():
+            # Pair equal operators first so a chain like Sort -> Aggregate lines up even if one node was added
+            unmatched = []
+            for before_node in before_nodes:
+                for after_node in after_nodes:
+                    if (self.match_after[after_node] < 0 and
+                            self.before.node_type[before_node] == self.after.node_type[after_node]):
+                        self._pair(before_node, after_node)
+                        break
+                else:
+                    unmatched.append(before_node)
+            # The rest is paired in plan order, an operator swapped for another: scans with scans first
+            remaining = [node for node in after_nodes if self.match_after[node] < 0]
+            for leaves in (True, False):
+                before_side = [node for node in unmatched if self.before.is_leaf(node) == leaves]
+                after_side = [node for node in remaining if self.after.is_leaf(node) == leaves]
+                for before_node, after_node in zip(before_side, after_side):
+                    self._pair(before_node, after_node)
+                # Unpaired scans fall back to pairing with any operator left over
+                unmatched = [node for node in unmatched if self.match_before[node] < 0]
+                remaining = [node for node in remaining if self.match_after[node] < 0]
+
+    def _pair(self, before_node, after_node):
+        self.match_before[before_node] = after_node
+        self.match_after[after_node] = before_node
+
+    @staticmethod
+    def matched_ancestor(tree, matches, node):
+        """
+        Get the closest ancestor of a node that has a counterpart in the other plan (-1 for none)
+        """
+        node = tree.parent[node]
+        while node >= 0 and matches[node] < 0:
+            node = tree.parent[node]
+        return node
+
+    def _classify(self):
+        for after_node in range(len(self.after)):
+            before_node = self.match_after[after_node]
+            if before_node < 0:
+                continue
+            # Added or removed operators in between do not move a node, a different matched ancestor does
+            before_ancestor = self.matched_ancestor(self.before, self.match_before, before_node)
+            after_ancestor = self.matched_ancestor(self.after, self.match_after, after_node)
+            ancestor_match = self.match_before[before_ancestor] if before_ancestor >= 0 else -1
+            if self.before.node_type[before_node] != self.after.node_type[after_node]:
+                status = CHANGED
+            elif ancestor_match != after_ancestor:
+                status = MOVED
+            elif self.cost_changed(self.before.cost[before_node], self.after.cost[after_node]):
+                status = COST_CHANGED
+            else:
+                status = KEPT
+            self.status_before[before_node] = status
+            self.status_after[after_node] = status
+
+    @staticmethod
+    def cost_changed(before_cost, after_cost):
+        return abs(after_cost - before_cost) > COST_TOLERANCE * max(abs(before_cost), abs(after_cost), 1e-9)
+
+    def summary(self):
+        """
+        Count the nodes of each status; removed nodes are counted in the first plan, all others in the second
+        """
+        counts = {status: 0 for status in STATUSES}
+        for status in self.status_after:
+            counts[status] += 1
+        counts[REMOVED] = self.status_before.count(REMOVED)
+        return counts
+
+    def edit_distance(self):
+        """
+        Number of node insertions, deletions and relabellings that turn the first plan into the second
+        """
+        counts = self.summary()
+        return counts[ADDED] + counts[REMOVED] + counts[CHANGED]
+
+    def changes(self):
+        """
+        List every node that is not kept as a dict with its status, operators, costs and rows,
+        largest change of self cost (the node's own cost, excluding its children) first
+        """
+        changes = []
+        for after_node, status in enumerate(self.status_after):
+            if status != KEPT:
+                changes.append(self._change(self.match_after[after_node], after_node, status))
+        for before_node, status in enumerate(self.status_before):
+            if status == REMOVED:
+                changes.append(self._change(before_node, -1, status))
+        changes.sort(key=lambda change: -abs(change['self_cost_delta']))
+        return changes
+
+    def _change(self, before_node, after_node, status):
+        before_type = self.before.node_type[before_node] if before_node >= 0 else None
+        after_type = self.after.node_type[after_node] if after_node >= 0 else None
+        cost_before = self.before.cost[before_node] if before_node >= 0 else 0.
+        cost_after = self.after.cost[after_node] if after_node >= 0 else 0.
+        self_cost_before = self.self_cost_before[before_node] if before_node >= 0 else 0.
+        self_cost_after = self.self_cost_after[after_node] if after_node >= 0 else 0.
+        return {
+            'status': status,
+            'before_node': before_node,
+            'after_node': after_node,
+            'before_type': before_type,
+            'after_type': after_type,
+            'relation': self.relation_label(before_node, after_node),
+            'cost_before': cost_before,
+            'cost_after': cost_after,
+            'cost_delta': cost_after - cost_before,
+            'self_cost_delta': self_cost_after - self_cost_before,
+            'rows_before': self.before.rows[before_node] if before_node >= 0 else 0.,
+            'rows_after': self.after.rows[after_node] if after_node >= 0 else 0.,
+        }
+
+    def relation_label(self, before_node, after_node):
+        tree, node = (self.after, after_node) if after_node >= 0 else (self.before, before_node)
+        attrs = tree.attrs[node]
+        relation = attrs.get('Relation Name')
+        if relation and attrs.get('Alias', relation) != relation:
+            return f"{relation} {attrs['Alias']}"
+        return relation or ""
+
+    def merged_plan(self):
+        """
+        Build a single plan holding the nodes of both plans: the second plan with every removed node placed
+        under the counterpart of its old parent. Every node carries 'Diff Status' and the costs and rows of
+        both plans, so it can go through PlanTree.from_plan and the regular graph layout.
+        """
+        removed_children = {}
+        for before_node, status in enumerate(self.status_before):
+            if status != REMOVED:
+                continue
+            before_parent = self.before.parent[before_node]
+            if before_parent >= 0 and self.status_before[before_parent] == REMOVED:
+                # Nested under its removed parent, which is placed itself
+                removed_children.setdefault(('before', before_parent), []).append(before_node)
+            else:
+                after_parent = self.match_before[before_parent] if before_parent >= 0 else 0
+                removed_children.setdefault(('after', max(after_parent, 0)), []).append(before_node)
+
+        nodes = [self._merged_node(self.match_after[node], node, self.status_after[node])
+                 for node in range(len(self.after))]
+        removed_nodes = {node: self._merged_node(node, -1, REMOVED)
+                         for node, status in enumerate(self.status_before) if status == REMOVED}
+        for node in range(1, len(self.after)):
+            nodes[self.after.parent[node]]['Plans'].append(nodes[node])
+        for (side, parent), children in removed_children.items():
+            parent_node = nodes[parent] if side == 'after' else removed_nodes[parent]
+            parent_node['Plans'].extend(removed_nodes[child] for child in children)
+        for node in nodes + list(removed_nodes.values()):
+            if not node['Plans']:
+                del node['Plans']
+        return nodes[0] if nodes else removed_nodes.get(0)
+
+    def _merged_node(self, before_node, after_node, status):
+        change = self._change(before_node, after_node, status)
+        if status == CHANGED:
+            node_type = f"{change['before_type']} → {change['after_type']}"
+        else:
+            node_type = change['after_type'] or change['before_type']
+        return {
+            'Node Type': node_type,
+            'Total Cost': change['cost_after'] if after_node >= 0 else change['cost_before'],
+            'Plan Rows': change['rows_after'] if after_node >= 0 else change['rows_before'],
+            'Relation': change['relation'],
+            'Diff Status': status,
+            'Cost Before': change['cost_before'] if before_node >= 0 else None,
+            'Cost After': change['cost_after'] if after_node >= 0 else None,
+            'Self Cost Delta': change['self_cost_delta'],
+            'Rows Before': change['rows_before'] if before_node >= 0 else None,
+            'Rows After': change['rows_after'] if after_node >= 0 else None,
+            'Plans': []
+        }
+
+    def merged_tree(self):
+        """
+        Get the merged plan as a PlanTree
+        """
+        return PlanTree.from_plan(self.merged_plan())
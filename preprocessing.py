@@ -1,64 +1,177 @@
-import networkx as nx
+from metrics import timed, PARSE_QEP, BUILD_GRAPH
+from array import array
+import hashlib
+import math
+
+
+class PlanTree:
+    """
+    Columnar representation of a query execution plan.
+    Nodes are numbered in pre-order (the root is 0) and stored as parallel arrays; the children of
+    node i are children[child_offsets[i]:child_offsets[i + 1]].
+    """
+    __slots__ = ('node_type', 'cost', 'rows', 'parent', 'depth', 'child_offsets', 'children', 'attrs',
+                 'analyzed', 'actual_loops', 'actual_time', 'actual_rows', 'estimated_rows', '_fingerprint')
+
+    def __init__(self):
+        self.node_type = []
+        self.cost = array('d')
+        self.rows = array('d')
+        self.parent = array('l')
+        self.depth = array('l')
+        self.child_offsets = array('l')
+        self.children = array('l')
+        # Per-node plan attributes without the nested 'Plans'
+        self.attrs = []
+        # EXPLAIN ANALYZE measurements over all loops of a node: rows are summed, times are wall-clock, so the
+        # loops run side by side by the processes of a parallel plan are averaged over them
+        self.analyzed = False
+        # Nodes with 0 loops were never executed (e.g. the other side of a short-circuited join)
+        self.actual_loops = array('d')
+        self.actual_time = array('d')
+        self.actual_rows = array('d')
+        self.estimated_rows = array('d')
+        self._fingerprint = None
+
+    @classmethod
+    def from_plan(cls, root_plan):
+        """
+        Build the tree from the root 'Plan' of an EXPLAIN (FORMAT JSON) output without recursion
+        """
+        tree = cls()
+        child_lists = []
+        # Each node comes with the number of processes running it, more than 1 below a Gather (Merge)
+        stack = [(root_plan, -1, 0, 1)]
+        while stack:
+            plan_tree, parent_id, depth, processes = stack.pop()
+            node_id = len(tree.node_type)
+            tree.node_type.append(plan_tree['Node Type'])
+            tree.cost.append(plan_tree.get('Total Cost', 0))
+            tree.rows.append(plan_tree.get('Plan Rows', 0))
+            tree.parent.append(parent_id)
+            tree.depth.append(depth)
+            tree.attrs.append({key: value for key, value in plan_tree.items() if key != 'Plans'})
+            # Actual times and rows are reported per loop, Plan Rows is an estimate per loop
+            loops = plan_tree.get('Actual Loops', 0)
+            tree.analyzed = tree.analyzed or 'Actual Loops' in plan_tree
+            tree.actual_loops.append(loops)
+            tree.actual_time.append(plan_tree.get('Actual Total Time', 0) * loops / processes)
+            tree.actual_rows.append(plan_tree.get('Actual Rows', 0) * loops)
+            tree.estimated_rows.append(plan_tree.get('Plan Rows', 0) * max(loops, 1))
+            child_lists.append([])
+            if parent_id >= 0:
+                child_lists[parent_id].append(node_id)
+            # The workers and the leader run the nodes below a Gather at the same time
+            if plan_tree['Node Type'] in ('Gather', 'Gather Merge'):
+                processes = plan_tree.get('Workers Launched', 0) + 1
+            # Push the subplans in reverse so they are numbered left to right
+            for subplan in reversed(plan_tree.get('Plans', [])):
+                stack.append((subplan, node_id, depth + 1, processes))
+
+        offset = 0
+        for child_list in child_lists:
+            tree.child_offsets.append(offset)
+            tree.children.extend(child_list)
+            offset += len(child_list)
+        tree.child_offsets.append(offset)
+        return tree
+
+    def __len__(self):
+        return len(self.node_type)
+
+    def children_of(self, node):
+        """
+        Get the children of a node
+        """
+        return self.children[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def is_leaf(self, node):
+        return self.child_offsets[node] == self.child_offsets[node + 1]
+
+    def self_cost(self):
+        """
+        Get the cost of each node excluding the cost of its children
+        """
+        costs = array('d', self.cost)
+        for node in range(1, len(self)):
+            costs[self.parent[node]] -= self.cost[node]
+        return costs
+
+    def subtree_end(self, node):
+        """
+        Get the pre-order index just past the last node of a subtree
+        """
+        end = node + 1
+        while end < len(self) and self.depth[end] > self.depth[node]:
+            end += 1
+        return end
+
+    def fingerprint(self):
+        """
+        Hash of the plan shape (node types and parent links), equal for plans drawn the same way
+        """
+        if self._fingerprint is None:
+            shape = "|".join(f"{node_type}:{parent}" for node_type, parent in zip(self.node_type, self.parent))
+            self._fingerprint = hashlib.blake2b(shape.encode(), digest_size=16).hexdigest()
+        return self._fingerprint
+
+    def exclusive_time(self):
+        """
+        Get the actual time (ms) spent in each node excluding the time of its children
+        """
+        times = array('d', self.actual_time)
+        for node in range(1, len(self)):
+            times[self.parent[node]] -= self.actual_time[node]
+        # Times below a Gather are averages over its processes, which can put a child a little above its parent
+        return array('d', (max(time, 0.) for time in times))
+
+    def row_ratio(self):
+        """
+        Get the estimated / actual row ratio of each node (actual rows of 0 count as 1), NaN for nodes that were
+        never executed
+        """
+        return array('d', (estimated / max(actual, 1) if loops else math.nan
+                           for estimated, actual, loops in zip(self.estimated_rows, self.actual_rows,
+                                                               self.actual_loops)))
+
+    def misestimate(self):
+        """
+        Get the factor by which each node's row estimate is off, in either direction (1 is exact).
+        Nodes that were never executed have no actual rows to compare with, so they count as exact.
+        """
+        return array('d', (max(ratio, 1 / ratio) if ratio > 0 else 1. for ratio in self.row_ratio()))
+
+    def edges(self):
+        """
+        Iterate over the (parent, child) edges of the tree
+        """
+        for node in range(1, len(self)):
+            yield self.parent[node], node
 
 
 class Graph:
     def __init__(self):
-        self.G = nx.DiGraph()
-        self.nodes = []
-        self.edges = []
-        self.node_counter = 0  # for ID generation
+        self.tree = None
 
+    @timed(PARSE_QEP)
     def parse_qep(self, qep):
         """
-        Parse the query execution plan (QEP) and build the nodes and edges for the graph.
-        """
-
-        def traverse_plan(plan_tree, parent_id=None):
-            node_id = self.node_counter  # Use the counter as the node ID
-            self.node_counter += 1
-            node_label = plan_tree['Node Type']
-            total_cost = plan_tree.get('Total Cost', 0)
-            rows = plan_tree.get('Plan Rows', 0)
-            node_info = {
-                'id': node_id,
-                'label': node_label,
-                'cost': total_cost,
-                'rows': rows,
-                'info': plan_tree
-            }
-            # print(f"Appending node: {node_info}")
-            self.nodes.append(node_info)
-
-            if parent_id is not None:
-                # print(f"Appending edge: {parent_id} -> {node_id}")
-                self.edges.append((parent_id, node_id))
-
-            if 'Plans' in plan_tree:
-                for subplan in plan_tree['Plans']:
-                    # Recursively traverse the plan tree
-                    # print(f"Traversing subplan: {subplan['Node Type']}")
-                    traverse_plan(subplan, parent_id=node_id)
-
+        Parse the query execution plan (QEP) into a columnar plan tree.
+        """
         # Start traversing from the root plan
         root_plan = qep[0]['Plan']
-        # Traverse the plan tree
-        traverse_plan(root_plan)
+        self.tree = PlanTree.from_plan(root_plan)
 
     def print_graph(self):
         """
         Print the nodes and edges of the graph.
         """
-        print(self.nodes)
-        print(self.edges)
+        print(list(zip(range(len(self.tree)), self.tree.node_type, self.tree.cost, self.tree.rows)))
+        print(list(self.tree.edges()))
 
+    @timed(BUILD_GRAPH)
     def build_graph(self):
         """
-        Build the graph from the nodes and edges.
+        Get the plan tree built by parse_qep.
         """
-
-        for node in self.nodes:
-            self.G.add_node(node['id'], label=node['label'], cost=node['cost'], rows=node['rows'], info=node['info'])
-        for edge in self.edges:
-            self.G.add_edge(edge[0], edge[1])
-
-        return self.G
+        return self.tree
@@ -1,14 +1,22 @@
 from interface import Interface
+from metrics import start_tracemalloc
+import argparse
 
 
 class Project:
     def __init__(self):
         self.interface = Interface()
 
-    def run(self):
-        self.interface.run()
+    def run(self, debug=False):
+        self.interface.run(debug=debug)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the app with the development server")
+    parser.add_argument('--debug', action='store_true', help="turn on the reloader and the debugging tools")
+    parser.add_argument('--trace-malloc', action='store_true',
+                        help="record the bytes allocated by each stage on /metrics (slows the app down)")
+    args = parser.parse_args()
+    start_tracemalloc(force=args.trace_malloc)
     project = Project()
-    project.run()
+    project.run(debug=args.debug)
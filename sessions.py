@@ -0,0 +1,199 @@
+from db.db import Database, DEFAULT_POOL_MIN, DEFAULT_POOL_MAX
+from db.jobs import BackgroundJobs
+from db.plan import QueryPlan
+from preprocessing import Graph
+from collections import OrderedDict
+from cryptography.fernet import Fernet, InvalidToken
+import diskcache
+import os
+import threading
+import time
+import uuid
+
+# Sessions kept in memory per process and how long (in seconds) an idle session is kept
+DEFAULT_MAX_SESSIONS = 64
+DEFAULT_SESSION_TTL = 3600
+# Most connections a process opens for a session it loaded from the shared store, opened only when needed
+SHARED_POOL_MAX = 2
+# Plans and trees of a session, each tree is built from the plan of the same index
+PLAN_ATTRIBUTES = ['qep', 'modified_qep']
+TREE_ATTRIBUTES = ['qep_tree', 'modified_qep_tree']
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+class Session:
+    """
+    The state of one browser session: its connection pool, catalog, background jobs and the plans it works on.
+    Only the connection parameters, catalog, plans and modified query are shared between processes,
+    everything else is rebuilt from them.
+    """
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.db = None
+        # Process that opened the pool, forked copies of the session must leave it to that process
+        self.db_pid = None
+        self.catalog = []
+        self.jobs = BackgroundJobs()
+        self.qep = None
+        self.qep_cost = None
+        self.qep_rows = None
+        self.modified_query = None
+        self.modified_qep = None
+        self.modified_qep_cost = None
+        self.qep_tree = None
+        self.modified_qep_tree = None
+        # Version of the shared copy this session was last saved as or loaded from
+        self.version = 0
+        self.last_used = time.time()
+
+    def connect(self, host, port, dbname, user, password, pool_min=DEFAULT_POOL_MIN, pool_max=DEFAULT_POOL_MAX):
+        """
+        Replace the session's connection pool with a new one
+        """
+        self.close_db()
+        db = Database(host, port, dbname, user, password, pool_min=pool_min, pool_max=pool_max)
+        db.connect()
+        self.db = db
+        self.db_pid = os.getpid()
+
+    def connection(self):
+        """
+        Get the parameters the session connected with, None if it is not connected
+        """
+        if self.db is None:
+            return None
+        return {'host': self.db.db_host, 'port': self.db.db_port, 'dbname': self.db.db_name,
+                'user': self.db.db_user, 'password': self.db.db_password}
+
+    def tree(self, attribute):
+        """
+        Get the PlanTree of the QEP or AQP, building it from the plan if this process has not yet
+        """
+        tree = getattr(self, attribute)
+        plan = getattr(self, PLAN_ATTRIBUTES[TREE_ATTRIBUTES.index(attribute)])
+        if tree is None and plan is not None:
+            graph = Graph()
+            graph.parse_qep(plan)
+            tree = graph.build_graph()
+            setattr(self, attribute, tree)
+        return tree
+
+    def to_shared(self):
+        return {
+            'connection': self.connection(),
+            'catalog': self.catalog,
+            'qep': self.qep.data if self.qep is not None else None,
+            'qep_cost': self.qep_cost,
+            'qep_rows': self.qep_rows,
+            'modified_query': self.modified_query,
+            'modified_qep': self.modified_qep.data if self.modified_qep is not None else None,
+            'modified_qep_cost': self.modified_qep_cost,
+        }
+
+    def load_shared(self, shared, version):
+        """
+        Catch up with a newer copy saved by another process, reconnecting if it connected elsewhere.
+        The connection of a session owned by another process gets a small pool opened lazily.
+        """
+        if shared['connection'] != self.connection():
+            self.close_db()
+            if shared['connection'] is not None:
+                self.connect(**shared['connection'], pool_min=0, pool_max=SHARED_POOL_MAX)
+        self.catalog = shared['catalog']
+        self.qep_cost, self.qep_rows = shared['qep_cost'], shared['qep_rows']
+        self.modified_query, self.modified_qep_cost = shared['modified_query'], shared['modified_qep_cost']
+        for plan_attribute, tree_attribute in zip(PLAN_ATTRIBUTES, TREE_ATTRIBUTES):
+            plan = getattr(self, plan_attribute)
+            if plan is None or plan.data != shared[plan_attribute]:
+                setattr(self, plan_attribute, QueryPlan(shared[plan_attribute]) if shared[plan_attribute] else None)
+                setattr(self, tree_attribute, None)
+        self.version = version
+
+    def close_db(self):
+        if self.db is not None and self.db_pid == os.getpid():
+            self.db.close()
+        self.db = None
+
+    def close(self):
+        self.close_db()
+        self.jobs.executor.shutdown(wait=False)
+
+
+class SessionStore:
+    """
+    Sessions keyed by session ID, kept in an in-process LRU.
+    With a directory, every session is also saved to a diskcache there, shared by all worker processes:
+    a process that does not have a session, or has an older version of it, loads it from there.
+    The password of the shared connection parameters is encrypted with secret, a Fernet key that only the
+    processes of this server know.
+    """
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, ttl=DEFAULT_SESSION_TTL, directory=None, secret=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.shared = None
+        self.fernet = None
+        if directory:
+            if not secret:
+                raise ValueError("A secret is needed to share sessions, the shared copy holds the DB password")
+            self.fernet = Fernet(secret)
+            self.shared = diskcache.Cache(directory)
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """
+        Get the session of an ID, creating it if it is new or has expired
+        """
+        now = time.time()
+        evicted = []
+        with self._lock:
+            for expired_id in [key for key, session in self.sessions.items() if now - session.last_used > self.ttl]:
+                evicted.append(self.sessions.pop(expired_id))
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = Session(session_id)
+            self.sessions.move_to_end(session_id)
+            session.last_used = now
+            while len(self.sessions) > self.max_sessions:
+                evicted.append(self.sessions.popitem(last=False)[1])
+        for old_session in evicted:
+            old_session.close()
+
+        if self.shared is not None:
+            entry = self.shared.get(session_id)
+            if entry is not None and entry[0] > session.version:
+                session.load_shared(self.decrypt(entry[1]), entry[0])
+        return session
+
+    def encrypt(self, shared):
+        connection = shared['connection']
+        if connection is not None and connection['password'] is not None:
+            password = self.fernet.encrypt(connection['password'].encode()).decode()
+            shared = dict(shared, connection=dict(connection, password=password))
+        return shared
+
+    def decrypt(self, shared):
+        connection = shared['connection']
+        if connection is not None and connection['password'] is not None:
+            try:
+                password = self.fernet.decrypt(connection['password'].encode()).decode()
+                shared = dict(shared, connection=dict(connection, password=password))
+            except InvalidToken:
+                # Saved by a server with another secret, the session has to connect again
+                shared = dict(shared, connection=None)
+        return shared
+
+    def save(self, session):
+        """
+        Save a session's shared state after a callback changed it
+        """
+        if self.shared is None:
+            return
+        with self.shared.transact():
+            entry = self.shared.get(session.session_id)
+            version = max(session.version, entry[0] if entry else 0) + 1
+            self.shared.set(session.session_id, (version, self.encrypt(session.to_shared())), expire=self.ttl)
+        session.version = version
@@ -0,0 +1,36 @@
+from advisor import candidate_indexes, predicate_columns
+
+CATALOG = [{'table': 'orders', 'columns': ['o_orderkey', 'o_custkey', 'o_orderdate', 'o_orderstatus']},
+           {'table': 'customer', 'columns': ['c_custkey', 'c_mktsegment', 'c_name']}]
+
+
+def test_aliases_and_unqualified_columns_are_resolved():
+    filters, joins = predicate_columns(
+        "SELECT * FROM customer c JOIN orders AS o ON c.c_custkey = o.o_custkey "
+        "WHERE c_mktsegment = 'BUILDING' AND o.o_orderdate < date '1995-03-15'", CATALOG)
+    assert joins == {'customer': ['c_custkey'], 'orders': ['o_custkey']}
+    assert filters == {'customer': [('c_mktsegment', True)], 'orders': [('o_orderdate', False)]}
+
+
+def test_negated_and_range_predicates_are_not_equalities():
+    filters, _ = predicate_columns(
+        "SELECT * FROM orders WHERE o_orderstatus NOT IN ('F', 'O') AND o_orderdate BETWEEN date '1995-01-01' "
+        "AND date '1995-12-31' AND o_custkey IN (SELECT c_custkey FROM customer WHERE c_name LIKE 'A%')", CATALOG)
+    assert filters == {'orders': [('o_orderstatus', False), ('o_orderdate', False), ('o_custkey', True)],
+                       'customer': [('c_name', False)]}
+
+
+def test_predicates_in_strings_and_comments_are_ignored():
+    filters, joins = predicate_columns(
+        "SELECT 'o_custkey = c_custkey' FROM orders -- o_orderdate < 1\nWHERE o_orderkey = 1", CATALOG)
+    assert filters == {'orders': [('o_orderkey', True)]} and joins == {}
+
+
+def test_equality_columns_lead_the_composite_index():
+    candidates = candidate_indexes(
+        "SELECT * FROM orders WHERE o_orderdate > date '1995-01-01' AND o_orderstatus = 'F'", CATALOG)
+    assert ('orders', ('o_orderstatus', 'o_orderdate')) in candidates
+
+
+def test_unparsable_queries_have_no_candidates():
+    assert candidate_indexes("SELECT FROM WHERE (", CATALOG) == []
@@ -0,0 +1,38 @@
+from calibrate import Sample, suggest_constants, unidentified_constants
+import numpy as np
+
+CONSTANTS = {'seq_page_cost': 1.0, 'random_page_cost': 4.0, 'cpu_tuple_cost': 0.01, 'cpu_index_tuple_cost': 0.005,
+             'cpu_operator_cost': 0.0025}
+
+
+def sample(counts, hit_ratio):
+    return Sample('sample', 'SELECT 1', {}, time=1.0, cost=1.0, hit_ratio=hit_ratio, counts=counts)
+
+
+def test_constants_share_one_scale():
+    ms_per_unit = np.array([0.02, 0.08, 0.0004, 0.0002, 0.0001])
+    suggested = suggest_constants(ms_per_unit, CONSTANTS)
+    assert suggested == {'seq_page_cost': 1.0, 'random_page_cost': 4.0, 'cpu_tuple_cost': 0.02,
+                         'cpu_index_tuple_cost': 0.01, 'cpu_operator_cost': 0.005}
+
+
+def test_unidentified_seq_page_cost_is_left_out_of_the_cpu_tuple_scale():
+    ms_per_unit = np.array([0., 0.08, 0.0004, 0.0002, 0.0001])
+    suggested = suggest_constants(ms_per_unit, CONSTANTS, unidentified_constants(ms_per_unit, [
+        sample([0, 10, 100, 10, 100], 0.5)]))
+    assert 'seq_page_cost' not in suggested
+    assert suggested['cpu_tuple_cost'] == CONSTANTS['cpu_tuple_cost']
+    assert suggested['cpu_operator_cost'] == 0.0025
+
+
+def test_random_page_cost_is_not_below_seq_page_cost():
+    ms_per_unit = np.array([0.02, 0.01, 0.0004, 0.0002, 0.0001])
+    assert suggest_constants(ms_per_unit, CONSTANTS)['random_page_cost'] == 1.0
+
+
+def test_cached_random_reads_do_not_identify_random_page_cost():
+    ms_per_unit = np.array([0.02, 0.01, 0.0004, 0.0002, 0.0001])
+    samples = [sample([100, 0, 1000, 0, 1000], 0.2), sample([0, 50, 50, 50, 100], 1.0)]
+    assert unidentified_constants(ms_per_unit, samples) == ['random_page_cost']
+    samples.append(sample([0, 50, 50, 50, 100], 0.6))
+    assert unidentified_constants(ms_per_unit, samples) == []
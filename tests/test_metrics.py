@@ -0,0 +1,32 @@
+from metrics import Histogram, LATENCY_BUCKETS, ALLOCATION_BUCKETS, RETIRED_KEY, retire_exited
+import os
+import subprocess
+import sys
+
+
+def snapshot(latency):
+    histogram = Histogram(LATENCY_BUCKETS)
+    histogram.observe(latency)
+    return {'callback': {'latency': histogram.snapshot(), 'allocation': Histogram(ALLOCATION_BUCKETS).snapshot()}}
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_exited_processes_are_summed_into_the_retired_entry():
+    first, second = exited_pid(), exited_pid()
+    processes = {os.getpid(): snapshot(0.001), first: snapshot(0.01), second: snapshot(0.1)}
+    retire_exited(processes)
+    assert set(processes) == {os.getpid(), RETIRED_KEY}
+    retired = processes[RETIRED_KEY]['callback']['latency']
+    assert retired['count'] == 2
+    assert abs(retired['sum'] - 0.11) < 1e-9
+
+    third = exited_pid()
+    processes[third] = snapshot(1)
+    retire_exited(processes)
+    assert set(processes) == {os.getpid(), RETIRED_KEY}
+    assert processes[RETIRED_KEY]['callback']['latency']['count'] == 3
@@ -0,0 +1,26 @@
+from db.plan import QueryPlan
+from db.plan_history import PlanHistory
+import os
+import stat
+
+
+def plan(cost):
+    return QueryPlan([{'Plan': {'Node Type': 'Seq Scan', 'Total Cost': cost, 'Plan Rows': 1}}])
+
+
+def test_history_file_is_private(tmp_path):
+    history = PlanHistory(str(tmp_path / 'history' / 'plans.sqlite3'))
+    history.record('db', 'select 1', plan(1.0))
+    assert stat.S_IMODE(os.stat(history.path).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(tmp_path / 'history').st_mode) == 0o700
+
+
+def test_unchanged_plans_are_not_written_again(tmp_path):
+    history = PlanHistory(str(tmp_path / 'plans.sqlite3'))
+    first = history.record('db', 'select 1', plan(1.0))
+    changes = history.connection().total_changes
+    assert history.record('db', 'SELECT  1', plan(1.0)) == first
+    assert history.connection().total_changes == changes
+    # A different plan is written at once and counts the plans seen in memory before it
+    assert history.record('db', 'select 1', plan(2.0)) != first
+    assert [entry['seen'] for entry in history.connection().execute("SELECT seen FROM plans ORDER BY id")] == [2, 1]
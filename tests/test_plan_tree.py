@@ -0,0 +1,44 @@
+from preprocessing import PlanTree
+import json
+import math
+import os
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_plan(name):
+    with open(os.path.join(FIXTURES, name)) as file:
+        return json.load(file)[0]
+
+
+def test_parallel_exclusive_times_sum_to_the_total_time():
+    # EXPLAIN ANALYZE of a parallel hash join with 2 workers launched below a Gather Merge
+    plan = load_plan('parallel_plan.json')
+    tree = PlanTree.from_plan(plan['Plan'])
+    exclusive_time = tree.exclusive_time()
+    assert math.isclose(sum(exclusive_time), tree.actual_time[0], rel_tol=0.01)
+    assert tree.actual_time[0] <= plan['Execution Time']
+    # The Gather Merge waits on its workers, it is not clamped to 0
+    gather = tree.node_type.index('Gather Merge')
+    assert exclusive_time[gather] > 0
+
+
+def test_parallel_rows_are_summed_over_processes():
+    plan = load_plan('parallel_plan.json')
+    tree = PlanTree.from_plan(plan['Plan'])
+    scan = tree.node_type.index('Seq Scan')
+    node = tree.attrs[scan]
+    assert tree.actual_rows[scan] == node['Actual Rows'] * node['Actual Loops']
+
+
+def test_never_executed_nodes_are_not_misestimates():
+    plan = {'Node Type': 'Nested Loop', 'Plan Rows': 40, 'Actual Rows': 0, 'Actual Loops': 1,
+            'Actual Total Time': 0.02, 'Plans': [
+                {'Node Type': 'Seq Scan', 'Plan Rows': 1, 'Actual Rows': 0, 'Actual Loops': 1,
+                 'Actual Total Time': 0.019},
+                {'Node Type': 'Seq Scan', 'Plan Rows': 1000, 'Actual Rows': 0, 'Actual Loops': 0,
+                 'Actual Total Time': 0.0},
+            ]}
+    tree = PlanTree.from_plan(plan)
+    assert math.isnan(tree.row_ratio()[2])
+    assert tree.misestimate()[2] == 1.
@@ -0,0 +1,38 @@
+from db import db as db_module
+from db.db import Database
+from psycopg2 import pool
+from test_settings import RecordingConnection
+import pytest
+import threading
+
+
+class RecordingPool:
+    def getconn(self):
+        connection = RecordingConnection()
+        connection.reset = lambda: None
+        return connection
+
+    def putconn(self, connection, close=False):
+        pass
+
+
+def pooled_database(pool_max):
+    db = Database('localhost', 5432, 'tpch', 'postgres', '', pool_max=pool_max)
+    db.plan_history = None
+    db.pool = RecordingPool()
+    db._slots = threading.BoundedSemaphore(pool_max)
+    return db
+
+
+def test_sessions_share_the_process_connection_budget(monkeypatch):
+    monkeypatch.setattr(db_module, '_connection_budget', threading.BoundedSemaphore(2))
+    monkeypatch.setattr(db_module, 'POOL_WAIT_TIMEOUT', 0.05)
+    first, second = pooled_database(10), pooled_database(10)
+    with first.session(), second.session():
+        # Both pools have connections to spare, the process does not
+        with pytest.raises(pool.PoolError):
+            with first.session():
+                pass
+    # The connection that could not be borrowed gave its pool slot back, returned ones gave the budget back
+    with first.session(), first.session():
+        pass
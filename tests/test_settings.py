@@ -0,0 +1,119 @@
+from db.db import Database, is_setting_command
+import pytest
+
+
+class RecordingCursor:
+    def __init__(self, statements):
+        self.statements = statements
+        self.description = None
+        self.rowcount = 0
+        self.closed = False
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+        self.description = [('QUERY PLAN',)] if 'EXPLAIN' in query else None
+
+    def fetchall(self):
+        return [[[{'Plan': {'Node Type': 'Seq Scan', 'Total Cost': 1.0, 'Plan Rows': 1}}]]]
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RecordingConnection:
+    closed = 0
+
+    def __init__(self):
+        self.statements = []
+
+    def cursor(self):
+        return RecordingCursor(self.statements)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def db():
+    db = Database('localhost', 5432, 'tpch', 'postgres', '')
+    db.plan_history = None
+    db.conn = RecordingConnection()
+    db.cursor = db.conn.cursor()
+    return db
+
+
+@pytest.mark.parametrize('command, name, value', [
+    ("SET search_path TO public, pg_catalog", 'search_path', "public, pg_catalog"),
+    ("SET search_path = \"$user\", public;", 'search_path', "\"$user\", public"),
+    ("set work_mem = '64MB';", 'work_mem', "'64MB'"),
+    ("SET enable_seqscan TO off", 'enable_seqscan', "off"),
+])
+def test_set_value_is_kept_as_typed(db, command, name, value):
+    assert is_setting_command(command)
+    db.execute_statement(command)
+    assert db.settings == {name: value}
+
+
+def test_list_valued_set_is_applied_unquoted(db):
+    db.execute_statement("SET search_path TO public, pg_catalog")
+    connection = RecordingConnection()
+    db.apply_settings(connection)
+    assert connection.statements == ["SET search_path = public, pg_catalog; "]
+
+
+def test_unit_valued_set_is_applied_with_its_quotes(db):
+    db.execute_statement("SET work_mem = '64MB'")
+    connection = RecordingConnection()
+    db.apply_settings(connection)
+    assert connection.statements == ["SET work_mem = '64MB'; "]
+
+
+def test_tracked_settings_key_the_plan_cache(db):
+    db.get_qep("select 1")
+    db.execute_statement("SET work_mem = '64MB'")
+    db.get_qep("select 1")
+    explains = [statement for statement in db.conn.statements if 'EXPLAIN' in statement]
+    # The second plan is made under other settings, so it is not served from the cache
+    assert len(explains) == 2
+
+
+def test_reset_and_default_forget_the_setting(db):
+    db.execute_statement("SET work_mem = '64MB'")
+    db.execute_statement("SET search_path TO public")
+    db.execute_statement("SET work_mem TO DEFAULT")
+    assert db.settings == {'search_path': "public"}
+    db.execute_statement("RESET ALL")
+    assert db.settings == {}
+
+
+def test_multiple_statements_are_not_tracked(db):
+    db.execute_statement("SET work_mem = '64MB'; SELECT 1")
+    assert db.settings == {}
+
+
+class RecordingHistory:
+    def __init__(self):
+        self.queries = []
+
+    def record(self, namespace, query, qep, settings, session_settings):
+        self.queries.append(query)
+
+
+def test_candidate_plans_bypass_the_plan_cache_and_history(db):
+    db.plan_history = RecordingHistory()
+    db.get_qep("select 1", {'join_collapse_limit': 1}, record=False, cache=False)
+    db.get_qep("select 1", {'join_collapse_limit': 1}, record=False, cache=False)
+    assert db.plan_history.queries == []
+    assert db.plan_cache.stats()['size'] == 0
+    db.get_qep("select 1", {'join_collapse_limit': 1})
+    assert db.plan_history.queries == ["select 1"]
+    assert db.plan_cache.stats()['size'] == 1
@@ -1,116 +1,215 @@
 from db.db import Database
-import re
-
-# Commands for default postgresql settings
-reset_commands = [
-    "SET enable_bitmapscan = on;\n",
-    "SET enable_gathermerge = on;\n",
-    "SET enable_hashagg = on;\n",
-    "SET enable_hashjoin = on;\n",
-    "SET enable_indexscan = on;\n",
-    "SET enable_indexonlyscan = on;\n",
-    "SET enable_material = on;\n",
-    "SET enable_mergejoin = on;\n",
-    "SET enable_nestloop = on;\n",
-    "SET enable_seqscan = on;\n",
-    "SET enable_sort = on;\n",
-    "SET enable_tidscan = on;\n",
-    'RESET join_collapse_limit;\n'
-]
-
-
-# Function to execute a list of commands
-def execute_commands(db: Database, commands: list[str]):
-    # return if there are no commands
-    if not commands:
-        return
-    # loop through each command and execute them
-    for command in commands:
-        db.cursor.execute(command)
-    # commit the changes
-    db.conn.commit()
-
-
-# Function to get the list of tables that can be modified
-def get_modifiable_list(query_string: str):
-    regex = r"\bFROM\b\s+([a-zA-Z_][a-zA-Z0-9_]*(?:\s*,\s*[a-zA-Z_][a-zA-Z0-9_]*)*)"
-
-    matches = re.findall(regex, query_string, re.IGNORECASE)
-    print(matches)
-    matches = [match for match in matches if len(re.findall(',', match)) > 0]
-    return matches
-
-
-# Function to modify the join order of the query
-def modify_join_order(query_string: str, join_order: list[list]):
-    regex = r"\bFROM\b\s+([a-zA-Z_][a-zA-Z0-9_]*(?:\s*,\s*[a-zA-Z_][a-zA-Z0-9_]*)*)"
-
-    matches = re.findall(regex, query_string, re.IGNORECASE)
-    matches = [match for match in matches if len(re.findall(',', match)) > 0]
-    join_str = [" NATURAL JOIN ".join(join_order_tables) for join_order_tables in join_order]
-    for i in range(len(matches)):
-        query_string = query_string.replace(matches[i], join_str[i], 1)
-    return query_string
-
-
-    
-
-    
-# Function to execute a whatif query
-def whatif_query(db: Database, query: str, join: str, scan: str, aggregate: str, change_order : bool):
-    commands = []
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import product
+from join_rewrite import get_rewriter
+from preprocessing import PlanTree
+
+# Options of the what-if dropdowns
+join_options = ['none', 'hash', 'merge', 'nested']
+scan_options = ['none', 'seq', 'index', 'bitmap']
+aggregate_options = ['hash', 'no_hash']
+# Resource knobs of the knob sweep and the values each is swept over unless others are given
+knob_grids = {
+    'work_mem': ['1MB', '4MB', '16MB', '64MB', '256MB', '1GB'],
+    'max_parallel_workers_per_gather': [0, 1, 2, 4, 8],
+    'parallel_setup_cost': [0, 10, 100, 1000, 10000],
+    'jit': ['off', 'on'],
+    'effective_cache_size': ['128MB', '512MB', '2GB', '8GB', '32GB'],
+}
+
+# Function to format planner settings as SET commands
+def format_settings(settings: dict, local: bool = False):
+    scope = "LOCAL " if local else ""
+    return [f"SET {scope}{name} = {value};\n" for name, value in settings.items()]
+
+
+# Function to get the relations of every FROM list whose join order can be modified, e.g. "supplier, nation n1"
+def get_modifiable_list(query_string: str, catalog: list[dict] = None):
+    return [", ".join(labels) for labels in get_rewriter(query_string, catalog).labels()]
+
+
+# Function to modify the join order of the query, one order per FROM list (nested lists are joined first)
+def modify_join_order(query_string: str, join_order: list[list], catalog: list[dict] = None):
+    return get_rewriter(query_string, catalog).rewrite(join_order)
+
+
+# Function to build the planner settings of a whatif query
+def build_settings(join: str, scan: str, aggregate: str, change_order: bool):
+    settings = {}
     if change_order:
-        commands.append('SET join_collapse_limit = 1;\n')
+        settings['join_collapse_limit'] = 1
     # check for whatif queries regarding join
     if join != 'none':
         # disable all other joins apart from hash join
         if join == "hash":
-            commands.extend(["SET enable_mergejoin = off;\n", "SET enable_nestloop = off;\n"])
+            settings.update(enable_mergejoin='off', enable_nestloop='off')
         # disable all other joins apart from merge join
         elif join == "merge":
-            commands.extend(["SET enable_hashjoin = off;\n", "SET enable_nestloop = off;\n"])
+            settings.update(enable_hashjoin='off', enable_nestloop='off')
         # disable all other joins apart from nested loop join
         elif join == "nested":
-            commands.extend(["SET enable_mergejoin = off;\n", "SET enable_hashjoin = off;\n"])
+            settings.update(enable_mergejoin='off', enable_hashjoin='off')
     # check for whatif queries regarding scan
     if scan != 'none':
         # disable all other scan options apart from seqscan
         if scan == "seq":
-            commands.extend(
-                ["SET enable_indexscan = off;\n", "SET enable_indexonlyscan = off;\n", "SET enable_bitmapscan = off;\n",
-                 "SET enable_tidscan = off;\n"])
+            settings.update(enable_indexscan='off', enable_indexonlyscan='off', enable_bitmapscan='off',
+                            enable_tidscan='off')
         # disable all other scan options apart from index scan
         elif scan == "index":
-            commands.extend(["SET enable_seqscan = off;\n", "SET enable_bitmapscan = off;\n", "SET enable_tidscan = off;\n"])
+            settings.update(enable_seqscan='off', enable_bitmapscan='off', enable_tidscan='off')
         # disable all other scan options apart from bitmap scan
         elif scan == "bitmap":
-            commands.extend(
-                ["SET enable_indexscan = off;\n", "SET enable_indexonlyscan = off;\n", "SET enable_seqscan = off;\n",
-                 "SET enable_tidscan = off;\n"])
+            settings.update(enable_indexscan='off', enable_indexonlyscan='off', enable_seqscan='off',
+                            enable_tidscan='off')
     # check for whatif queries regarding aggregation
     if aggregate != 'hash':
         # disable hash aggregation
         if aggregate == "no_hash":
-            commands.append("SET enable_hashagg = off;\n")
-    # configure the new settings
-    execute_commands(db, commands)
+            settings['enable_hashagg'] = 'off'
+    return settings
+
 
-    # Get qep with the new configurations
-    try:
-        qep, qep_cost, qep_rows, execution_time, error = db.get_qep(query)
-    except Exception as e:
-        raise(e)
+# Function to execute a whatif query
+def whatif_query(db: Database, query: str, join: str, scan: str, aggregate: str, change_order : bool,
+                 record: bool = True):
+    settings = build_settings(join, scan, aggregate, change_order)
 
-    # restore default settings
-    execute_commands(db, reset_commands)
-    new_query = "".join(commands) + query
+    # Get qep with the new configurations, the settings are scoped to the EXPLAIN's transaction.
+    # Plans that are not recorded (the candidates of a sweep) are not cached either
+    qep, qep_cost, qep_rows, execution_time, error = db.get_qep(query, settings, record=record, cache=record)
+    new_query = "".join(format_settings(settings)) + query
 
     return qep, qep_cost, qep_rows, execution_time, error, new_query
 
 
+# Function to plan every combination of what-if options concurrently
+def sweep_whatif(db: Database, query: str, join_orders: list[list[list]] = None, max_workers: int = None,
+                 catalog: list[dict] = None):
+    # the original query plus one variant per user-supplied join order, all rewritten from one parse
+    variants = [(query, None, False)]
+    rewriter = get_rewriter(query, catalog)
+    results = []
+    for join_order in join_orders or []:
+        try:
+            variants.append((rewriter.rewrite(join_order), join_order, True))
+        except ValueError as e:
+            results.append({'join': None, 'scan': None, 'aggregate': None, 'join_order': join_order, 'cost': None,
+                            'rows': None, 'time': 0, 'error': str(e), 'query': None})
+
+    # every EXPLAIN borrows its own pooled connection, so a shared connection can only run one at a time
+    if db.pool is None:
+        max_workers = 1
+    max_workers = max_workers or db.pool_max
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for (variant_query, join_order, change_order), join, scan, aggregate in product(
+                variants, join_options, scan_options, aggregate_options):
+            future = executor.submit(whatif_query, db, variant_query, join, scan, aggregate, change_order,
+                                     record=False)
+            futures[future] = (join_order, join, scan, aggregate)
+
+        for future in as_completed(futures):
+            join_order, join, scan, aggregate = futures[future]
+            try:
+                _, cost, rows, execution_time, error, new_query = future.result()
+            except Exception as e:
+                cost, rows, execution_time, error, new_query = None, None, 0, str(e), None
+            results.append({
+                'join': join,
+                'scan': scan,
+                'aggregate': aggregate,
+                'join_order': join_order,
+                'cost': cost,
+                'rows': rows,
+                'time': execution_time,
+                'error': error,
+                'query': new_query
+            })
+
+    # cheapest plans first, failed ones last
+    results.sort(key=lambda result: (result['cost'] is None, result['cost'] or 0))
+    return results
+
+
+# Function to parse comma-separated knob values, e.g. "4MB, 64MB" or "0, 2, 4"
+def parse_knob_values(text: str):
+    values = []
+    for value in text.split(','):
+        value = value.strip().strip("'")
+        if not value:
+            continue
+        try:
+            values.append(int(value))
+        except ValueError:
+            try:
+                values.append(float(value))
+            except ValueError:
+                values.append(value)
+    return values
+
+
+# Function to format a knob value for SET, quoting values with units such as 64MB
+def format_knob_value(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return value
+
+
+# Function to plan (or run) a query at every point of a grid of one or two resource knobs
+def sweep_knobs(db: Database, query: str, knobs: dict[str, list], analyze: bool = False, timeout: float = None,
+                max_workers: int = None):
+    # knob names go unquoted into SET LOCAL, so only the knobs of knob_grids can be swept
+    unknown = [name for name in knobs if name not in knob_grids]
+    if unknown:
+        raise ValueError(f"Unknown resource knob: {', '.join(map(str, unknown))}")
+    # the first knob varies along the x axis, the second one (if any) gives one series per value
+    names = list(knobs)
+    grid = list(product(*knobs.values()))
+
+    def plan_point(point):
+        settings = {name: format_knob_value(value) for name, value in zip(names, point)}
+        if analyze and timeout:
+            settings['statement_timeout'] = int(timeout * 1000)
+        qep, cost, rows, execution_time, error = db.get_qep(query, settings, analyze=analyze, record=False,
+                                                            cache=False)
+        tree = PlanTree.from_plan(qep.plan) if qep is not None else None
+        return {
+            'settings': dict(zip(names, point)),
+            'cost': cost,
+            'rows': rows,
+            'time': execution_time,
+            'actual_time': qep.execution_time if qep is not None else None,
+            'shape': tree.fingerprint() if tree is not None else None,
+            'nodes': ", ".join(dict.fromkeys(tree.node_type)) if tree is not None else None,
+            'error': error
+        }
+
+    # every EXPLAIN borrows its own pooled connection, measured runs go one at a time so they do not compete
+    if db.pool is None or analyze:
+        max_workers = 1
+    max_workers = max_workers or db.pool_max
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(plan_point, grid))
+
+    # number the plan shapes in grid order and flag the points whose plan differs from the one at the
+    # previous value of the first knob
+    labels = {}
+    stride = len(grid) // len(knobs[names[0]]) if grid else 1
+    for index, result in enumerate(results):
+        if result['shape'] is not None and result['shape'] not in labels:
+            labels[result['shape']] = len(labels) + 1
+        result['plan'] = labels.get(result['shape'])
+        previous = results[index - stride] if index >= stride else None
+        result['shape_changed'] = (previous is not None and result['shape'] is not None
+                                   and previous['shape'] is not None and previous['shape'] != result['shape'])
+    return results
+
+
 if __name__ == '__main__':
-    query = 'SELECT * FROM a, b, c WHERE a.id = b.id AND b.name > (SELECT c.name FROM c , d JOIN e where c.id = d.id)'
-    #query = 'SELECT * FROM customer C, orders O WHERE C.c_custkey = O.o_custkey'
-    join_order = [['b', 'c', 'a'], ['c', 'd']]
-    modified_query = modify_join_order(query, join_order)
-    print(get_modifiable_list(query))
\ No newline at end of file
+    query = ('SELECT * FROM a, b x, c WHERE a.id = x.id AND x.name > '
+             '(SELECT c.name FROM c JOIN d ON c.id = d.id, e WHERE d.id = e.id)')
+    join_order = [['c', ['x', 'a']], ['e', 'd', 'c']]
+    print(get_modifiable_list(query))
+    print(modify_join_order(query, join_order))
@@ -0,0 +1,30 @@
+from db.shared_cache import configure_shared_cache, private_directory, CACHE_DIR_ENV
+from db.plan_history import configure_plan_history, HISTORY_FILE
+from interface import Interface
+from metrics import start_tracemalloc
+from cryptography.fernet import Fernet
+import os
+
+# Fernet key encrypting the DB passwords of the shared sessions, generated for each server if it is not set
+SECRET_KEY_ENV = "QEP_SECRET_KEY"
+
+
+def create_app(cache_dir=None, secret_key=None):
+    """
+    Build the Dash app for a WSGI server and return its Flask server.
+    Meant to be preloaded by the server before it forks its workers (see gunicorn.conf.py), so the app is built
+    once and every worker shares the sessions, caches and plan history in cache_dir (or $QEP_CACHE_DIR).
+    The key generated without secret_key (or $QEP_SECRET_KEY) is only known to the workers forked from here.
+    The workers' metrics are summed on /metrics, with allocation sizes if $QEP_TRACEMALLOC is set.
+    """
+    # The directory shared by all worker processes is named explicitly rather than left to the user's default
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        raise RuntimeError(f"Set ${CACHE_DIR_ENV} to a private directory for the caches shared by the workers")
+    private_directory(cache_dir)
+    secret_key = secret_key or os.environ.get(SECRET_KEY_ENV) or Fernet.generate_key()
+    configure_shared_cache(os.path.join(cache_dir, "cache"))
+    configure_plan_history(os.path.join(cache_dir, HISTORY_FILE))
+    start_tracemalloc()
+    interface = Interface(session_directory=os.path.join(cache_dir, "sessions"), session_secret=secret_key)
+    return interface.app.server